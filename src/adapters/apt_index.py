@@ -0,0 +1,249 @@
+import gzip
+import logging
+import lzma
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+APT_LISTS = Path("/var/lib/apt/lists")
+# Зависимость: имя[:arch] [(op версия)]
+DEPENDENCY_RE = re.compile(r"^\s*([^\s:(]+)(?::\S+)?\s*(?:\(\s*(<<|<=|=|>=|>>|<|>)\s*([^)\s]+)\s*\))?")
+
+
+@dataclass(frozen=True)
+class DebPackage:
+    """Пакет из индекса Packages."""
+    name: str
+    version: str
+    arch: str
+    filename: str
+    sha256: str
+    size: int
+    depends: str = ""
+    pre_depends: str = ""
+    provides: str = ""
+
+
+def _order(c: str) -> int:
+    if c == "~":
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_fragment(a: str, b: str) -> int:
+    """Сравнение upstream/revision по алгоритму dpkg."""
+    i = j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) and not a[i].isdigit() else 0
+            bc = _order(b[j]) if j < len(b) and not b[j].isdigit() else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _split_version(version: str) -> Tuple[int, str, str]:
+    epoch, _, rest = version.partition(":") if ":" in version else ("0", "", version)
+    upstream, _, revision = rest.rpartition("-") if "-" in rest else (rest, "", "0")
+    return int(epoch or 0), upstream, revision
+
+
+def compare_versions(a: str, b: str) -> int:
+    """<0, 0 или >0, как dpkg --compare-versions."""
+    ea, ua, ra = _split_version(a)
+    eb, ub, rb = _split_version(b)
+    if ea != eb:
+        return ea - eb
+    return _compare_fragment(ua, ub) or _compare_fragment(ra, rb)
+
+
+class _VersionKey:
+    """Ключ сортировки пакетов по версии dpkg."""
+    __slots__ = ("version",)
+
+    def __init__(self, package: DebPackage):
+        self.version = package.version
+
+    def __lt__(self, other: "_VersionKey") -> bool:
+        return compare_versions(self.version, other.version) < 0
+
+
+def version_satisfies(version: str, op: Optional[str], wanted: Optional[str]) -> bool:
+    if op is None:
+        return True
+    cmp = compare_versions(version, wanted)
+    return {
+        "<<": cmp < 0,
+        "<": cmp <= 0,
+        "<=": cmp <= 0,
+        "=": cmp == 0,
+        ">=": cmp >= 0,
+        ">": cmp >= 0,
+        ">>": cmp > 0,
+    }[op]
+
+
+def parse_relations(text: str) -> List[List[Tuple[str, Optional[str], Optional[str]]]]:
+    """'a (>= 1) | b, c' -> [[(a, >=, 1), (b, None, None)], [(c, None, None)]]."""
+    clauses = []
+    for clause in text.split(","):
+        alternatives = []
+        for alternative in clause.split("|"):
+            match = DEPENDENCY_RE.match(alternative)
+            if match and match.group(1):
+                alternatives.append((match.group(1), match.group(2), match.group(3)))
+        if alternatives:
+            clauses.append(alternatives)
+    return clauses
+
+
+def _open_index(path: Path):
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    if path.suffix == ".xz":
+        return lzma.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def iter_stanzas(path: Path) -> Iterator[Dict[str, str]]:
+    """Абзацы файла Packages; многострочные поля (Description) не нужны и пропускаются."""
+    fields: Dict[str, str] = {}
+    with _open_index(path) as f:
+        for line in f:
+            if line == "\n":
+                if fields:
+                    yield fields
+                fields = {}
+                continue
+            if line[0] in " \t":
+                continue
+            key, _, value = line.partition(":")
+            fields[key] = value.strip()
+    if fields:
+        yield fields
+
+
+def index_files(arch: str, lists_dir: Path = APT_LISTS) -> List[Path]:
+    """Индексы Packages целевой архитектуры из локального кэша apt."""
+    files = []
+    for path in sorted(lists_dir.glob(f"*_binary-{arch}_Packages*")):
+        # Имя начинается с хоста (deb.debian.org_...): Path.suffix здесь не расширение
+        if path.name.endswith(("_Packages", "_Packages.gz", "_Packages.xz")):
+            files.append(path)
+        else:
+            logging.warning(f"Пропущен индекс в неподдерживаемом формате: {path}")
+    return files
+
+
+class AptIndex:
+    """Пакеты из индексов apt: все версии каждого имени и виртуальные пакеты."""
+
+    def __init__(self, arch: str, lists_dir: Path = APT_LISTS):
+        self.arch = arch
+        self.packages: Dict[str, List[DebPackage]] = {}
+        self.providers: Dict[str, List[str]] = {}
+        files = index_files(arch, lists_dir)
+        if not files:
+            raise FileNotFoundError(
+                f"Нет индексов apt для {arch} в {lists_dir}: "
+                f"выполните dpkg --add-architecture {arch} && apt-get update"
+            )
+        for path in files:
+            for fields in iter_stanzas(path):
+                if fields.get("Architecture") not in (arch, "all") or "SHA256" not in fields:
+                    continue
+                package = DebPackage(
+                    name=fields["Package"],
+                    version=fields["Version"],
+                    arch=fields["Architecture"],
+                    filename=fields.get("Filename", ""),
+                    sha256=fields["SHA256"],
+                    size=int(fields.get("Size", 0)),
+                    depends=fields.get("Depends", ""),
+                    pre_depends=fields.get("Pre-Depends", ""),
+                    provides=fields.get("Provides", ""),
+                )
+                self.packages.setdefault(package.name, []).append(package)
+                for (virtual, _, _), in parse_relations(package.provides):
+                    self.providers.setdefault(virtual, []).append(package.name)
+        for versions in self.packages.values():
+            versions.sort(key=_VersionKey, reverse=True)
+
+    def candidate(self, name: str, op: Optional[str] = None, version: Optional[str] = None) -> Optional[DebPackage]:
+        """Самая новая версия name, удовлетворяющая ограничению."""
+        for package in self.packages.get(name, []):
+            if version_satisfies(package.version, op, version):
+                return package
+        return None
+
+    def resolve(self, names: Iterable[str], skip: Iterable[str] = ()) -> List[DebPackage]:
+        """
+        Замыкание Depends/Pre-Depends для names.
+
+        Returns:
+            Пакеты в порядке «зависимости раньше зависящих».
+        """
+        skip = set(skip)
+        chosen: Dict[str, DebPackage] = {}
+        order: List[DebPackage] = []
+        visiting: Set[str] = set()
+
+        def visit(package: DebPackage):
+            if package.name in chosen or package.name in visiting:
+                return
+            visiting.add(package.name)
+            for clause in parse_relations(package.pre_depends) + parse_relations(package.depends):
+                dependency = self._pick(clause, chosen, skip)
+                if dependency is not None:
+                    visit(dependency)
+            visiting.discard(package.name)
+            chosen[package.name] = package
+            order.append(package)
+
+        for name in names:
+            package = self.candidate(name)
+            if package is None and self.providers.get(name):
+                package = self.candidate(self.providers[name][0])
+            if package is None:
+                raise LookupError(f"Пакет {name} не найден в индексах apt для {self.arch}")
+            visit(package)
+        return order
+
+    def _pick(self, clause, chosen: Dict[str, DebPackage], skip: Set[str]) -> Optional[DebPackage]:
+        """Пакет для одной зависимости «a | b»; None, если она уже выполнена или пропущена."""
+        for name, _, _ in clause:
+            if name in skip or name in chosen:
+                return None
+            if any(provider in chosen or provider in skip for provider in self.providers.get(name, [])):
+                return None
+        for name, op, version in clause:
+            package = self.candidate(name, op, version)
+            if package is not None:
+                return package
+            if op is None and self.providers.get(name):
+                return self.candidate(self.providers[name][0])
+        wanted = " | ".join(name for name, _, _ in clause)
+        logging.warning(f"Зависимость {wanted} не найдена в индексах apt для {self.arch}")
+        return None
+
@@ -0,0 +1,145 @@
+import logging
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+FRAGMENTS_DIR = Path(__file__).parent.parent / "kernel" / "fragments"
+# Профиль узла -> фрагменты конфигурации в порядке применения
+PROFILES = {
+    "hypervisor": ["base", "hypervisor"],
+    "storage": ["base", "storage"],
+    "full": ["base", "hypervisor", "storage"],
+}
+OPTION_RE = re.compile(r"^(CONFIG_[A-Za-z0-9_]+)=(.*)$")
+NOT_SET_RE = re.compile(r"^# (CONFIG_[A-Za-z0-9_]+) is not set$")
+HEADER_RE = re.compile(r"^#\s*(fragment|version):\s*(\S+)")
+
+
+class ConfigConflictError(ValueError):
+    """Два фрагмента задают одной опции разные значения."""
+
+
+class ConfigCheckError(ValueError):
+    """Опции фрагментов не сохранились после olddefconfig."""
+
+
+@dataclass(frozen=True)
+class ConfigFragment:
+    """Фрагмент .config: имя, версия и опции (значение "n" — «is not set»)."""
+    name: str
+    version: str
+    options: Tuple[Tuple[str, str], ...]
+
+    @property
+    def label(self) -> str:
+        return f"{self.name} v{self.version}"
+
+
+def parse_config_line(line: str) -> Optional[Tuple[str, str]]:
+    """'CONFIG_X=y' -> (CONFIG_X, y); '# CONFIG_X is not set' -> (CONFIG_X, n)."""
+    line = line.strip()
+    match = OPTION_RE.match(line)
+    if match:
+        return match.group(1), match.group(2)
+    match = NOT_SET_RE.match(line)
+    if match:
+        return match.group(1), "n"
+    return None
+
+
+def read_config(path: Path) -> Dict[str, str]:
+    options = {}
+    for line in path.read_text().splitlines():
+        parsed = parse_config_line(line)
+        if parsed:
+            options[parsed[0]] = parsed[1]
+    return options
+
+
+def load_fragment(path: Path) -> ConfigFragment:
+    """
+    Читает фрагмент. Шапка «# fragment: имя» и «# version: N» необязательна.
+
+    Raises:
+        ConfigConflictError: опция задана во фрагменте дважды с разными значениями.
+    """
+    name, version = path.stem, "0"
+    options: Dict[str, str] = {}
+    for line in path.read_text().splitlines():
+        header = HEADER_RE.match(line)
+        if header:
+            if header.group(1) == "fragment":
+                name = header.group(2)
+            else:
+                version = header.group(2)
+            continue
+        parsed = parse_config_line(line)
+        if parsed is None:
+            continue
+        option, value = parsed
+        if options.get(option, value) != value:
+            raise ConfigConflictError(f"{path}: {option} задана как {options[option]} и {value}")
+        options[option] = value
+    return ConfigFragment(name, version, tuple(options.items()))
+
+
+def profile_fragments(profile: str, fragments_dir: Path = FRAGMENTS_DIR) -> List[Path]:
+    if profile not in PROFILES:
+        raise ValueError(f"Неизвестный профиль ядра {profile}; доступны: {', '.join(sorted(PROFILES))}")
+    return [fragments_dir / f"{name}.config" for name in PROFILES[profile]]
+
+
+def merge_fragments(paths: List[Path]) -> Dict[str, str]:
+    """
+    Объединяет фрагменты.
+
+    Raises:
+        ConfigConflictError: со списком всех опций, которым фрагменты задают разные значения.
+    """
+    merged: Dict[str, Tuple[str, str]] = {}
+    conflicts = []
+    for path in paths:
+        fragment = load_fragment(path)
+        logging.info(f"Фрагмент конфигурации ядра: {fragment.label} ({len(fragment.options)} опций)")
+        for option, value in fragment.options:
+            if option in merged and merged[option][0] != value:
+                previous_value, previous_label = merged[option]
+                conflicts.append(f"{option}: {previous_label} = {previous_value}, {fragment.label} = {value}")
+                continue
+            merged.setdefault(option, (value, fragment.label))
+    if conflicts:
+        raise ConfigConflictError("Конфликт фрагментов конфигурации ядра:\n  " + "\n  ".join(conflicts))
+    return {option: value for option, (value, _) in merged.items()}
+
+
+def format_option(option: str, value: str) -> str:
+    return f"# {option} is not set" if value == "n" else f"{option}={value}"
+
+
+def apply_options(config_path: Path, options: Dict[str, str]):
+    """Заменяет в .config строки опций на значения фрагментов (прежние строки удаляются)."""
+    lines = [
+        line for line in config_path.read_text().splitlines()
+        if (parse_config_line(line) or (None,))[0] not in options
+    ]
+    lines.append("# Фрагменты профиля")
+    lines.extend(format_option(option, value) for option, value in options.items())
+    config_path.write_text("\n".join(lines) + "\n")
+
+
+def check_options(config_path: Path, options: Dict[str, str]) -> List[str]:
+    """
+    Опции фрагментов, которых нет в итоговом .config с нужным значением
+    (обычно — не выполнены зависимости в Kconfig). Отсутствующая опция равна n.
+    """
+    actual = read_config(config_path)
+    return [
+        f"{option}: ожидалось {value}, получено {actual.get(option, 'n')}"
+        for option, value in options.items()
+        if actual.get(option, "n") != value
+    ]
+
+
+def module_options(config_path: Path) -> List[str]:
+    return sorted(option for option, value in read_config(config_path).items() if value == "m")
@@ -1,27 +1,119 @@
+import hashlib
 import logging
 import os
+import platform
 import shutil
 import subprocess
+import tarfile
 from pathlib import Path
-from typing import Union
+from typing import Dict, List, Optional, Set, Union
+
+from adapters.kernel_config import (
+    ConfigCheckError,
+    apply_options,
+    check_options,
+    merge_fragments,
+    module_options,
+    profile_fragments,
+)
+from core.build_stages import stage_output
 
 
 RPI_REPO_URL = "https://github.com/raspberrypi/linux.git"
+KERNEL_ARCH = "arm64"
+# Сколько последних сборок ядра хранить в кэше
+KERNEL_CACHE_KEEP = int(os.environ.get("KERNEL_CACHE_KEEP", "3"))
+# Хосты, на которых ядро arm64 собирается родным компилятором
+NATIVE_MACHINES = ("aarch64", "arm64")
+DEFAULT_CROSS_COMPILE = "aarch64-linux-gnu-"
+# Префикс кросс-компилятора; по умолчанию выбирается по архитектуре хоста
+CROSS_COMPILE = os.environ.get("KERNEL_CROSS_COMPILE")
+# KERNEL_CCACHE=0 — собирать без ccache, даже если он установлен
+USE_CCACHE = os.environ.get("KERNEL_CCACHE", "1") not in ("", "0")
+# Модули из кэша распаковываются как есть: архив собран этой же сборкой
+TAR_EXTRACT_ARGS = {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
 
 class LinuxKernel:
     rpi_model: str
     temp_path: Path
     rpi_repo_path: Path
+    build_path: Path
+    cache_path: Path
+    artifacts_path: Path
     kernel_image: Path
     rootfs_path: Path
 
-    def __init__(self, temp_path: str, rpi_model: str, rootfs_path: Union[Path, str]):
+    def __init__(
+        self,
+        temp_path: str,
+        rpi_model: str,
+        rootfs_path: Union[Path, str],
+        dtbs: Optional[List[str]] = None,
+        overlays: Optional[List[str]] = None,
+        profile: str = "full",
+        module_manifest: Optional[Union[Path, str]] = None,
+    ):
+        """
+        Args:
+            temp_path: Каталог исходников, сборки и кэша.
+            rpi_model: defconfig платы (bcm2711_defconfig).
+            rootfs_path: rootfs, куда ставятся модули и /boot.
+            dtbs: Шаблоны DTB относительно arch/arm64/boot/dts без расширения
+                (по умолчанию — все платы семейства rpi_model: broadcom/bcm2711-*).
+            overlays: Имена оверлеев (.dtbo), которые нужны в config.txt.
+            profile: Профиль узла (hypervisor, storage, full) — набор фрагментов конфигурации.
+            module_manifest: Список загруженных модулей эталонной загрузки (lsmod);
+                если задан, остальные модули отключаются.
+        """
         self.temp_path = Path(temp_path)
         self.rpi_model = rpi_model
+        family = rpi_model.split("_")[0]
+        self.dtbs = list(dtbs) if dtbs is not None else [f"broadcom/{family}-*"]
+        self.overlays = list(overlays or [])
+        self._missing_dtbs: Set[str] = set()
+        self.profile = profile
+        self.fragments = profile_fragments(profile)
+        self.module_manifest = Path(module_manifest).absolute() if module_manifest else None
+        if CROSS_COMPILE is not None:
+            self.cross_compile = CROSS_COMPILE
+        else:
+            self.cross_compile = "" if platform.machine() in NATIVE_MACHINES else DEFAULT_CROSS_COMPILE
         self.rpi_repo_path = self.temp_path / "rpi_linux"
-        self.kernel_image = self.rpi_repo_path / "arch/arm64/boot/Image"
+        # Сборка вне дерева исходников (O=): git pull не трогает объектные файлы
+        self.build_path = self.temp_path / "kernel-build"
+        self.config_path = self.build_path / ".config"
+        # Артефакты по ключу «коммит + конфигурация»; temp/kernel — ссылка на текущую сборку
+        self.cache_path = self.temp_path / "kernel-cache"
+        self.artifacts_path = self.temp_path / "kernel"
+        self.kernel_image = self.artifacts_path / "Image"
+        self.dtb_path = self.artifacts_path / "dts"
+        self.modules_tarball = self.artifacts_path / "modules.tar.gz"
+        self.cache_key: Optional[str] = None
         self.rootfs_path = Path(rootfs_path)
 
+    def _run(self, args, cwd: Path, env: Optional[dict] = None):
+        """Запускает команду сборки; вывод — в лог текущего этапа, если он есть."""
+        log = stage_output()
+        subprocess.run(args, check=True, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT if log else None)
+
+    def check_toolchain(self):
+        """Проверяет, что компилятор для arm64 есть в PATH."""
+        compiler = f"{self.cross_compile}gcc"
+        if shutil.which(compiler) is None:
+            raise EnvironmentError(
+                f"Компилятор {compiler} не найден: установите gcc-aarch64-linux-gnu "
+                "или задайте префикс в KERNEL_CROSS_COMPILE"
+            )
+
+    def _make(self, *targets: str):
+        """make в дереве исходников с выводом в build_path; с ccache, если он доступен."""
+        args = ["make", f"ARCH={KERNEL_ARCH}", f"CROSS_COMPILE={self.cross_compile}", f"O={self.build_path}"]
+        env = None
+        if USE_CCACHE and shutil.which("ccache"):
+            args.append(f"CC=ccache {self.cross_compile}gcc")
+            env = dict(os.environ, CCACHE_DIR=str(self.temp_path / "ccache"))
+        self._run(args + list(targets), self.rpi_repo_path, env)
+
     def download_kernel(self):
         """Клонирует или обновляет исходники ядра Raspberry Pi."""
         logging.info("Готовим исходники ядра Raspberry Pi...")
@@ -30,15 +122,11 @@ class LinuxKernel:
         git_dir = self.rpi_repo_path / ".git"
         if not git_dir.exists():
             logging.info(f"Клонируем {RPI_REPO_URL} в {self.rpi_repo_path}")
-            subprocess.run(
-                ["git", "clone", "--depth=1", RPI_REPO_URL, str(self.rpi_repo_path)],
-                check=True,
-                cwd=self.temp_path,
-            )
+            self._run(["git", "clone", "--depth=1", RPI_REPO_URL, str(self.rpi_repo_path)], self.temp_path)
             return
 
         logging.info("Репозиторий уже клонирован, обновляем...")
-        subprocess.run(["git", "pull", "--ff-only"], check=True, cwd=self.rpi_repo_path)
+        self._run(["git", "pull", "--ff-only"], self.rpi_repo_path)
 
     def unpack_kernel(self):
         """Совместимость с прежним API: исходники уже в git-репозитории."""
@@ -59,62 +147,191 @@ class LinuxKernel:
                 raise FileNotFoundError(f"Конфигурация {self.rpi_model} не найдена в репозитории Raspberry Pi!")
 
         logging.info("Используем конфигурацию для настройки ядра...")
-        subprocess.run(["make", "ARCH=arm64", self.rpi_model], check=True, cwd=self.rpi_repo_path)
+        self._make(self.rpi_model)
+
+    def _prepare_tree(self):
+        """Сборка с O= требует чистого дерева исходников: убираем следы прежней сборки в дереве."""
+        self.build_path.mkdir(parents=True, exist_ok=True)
+        if (self.rpi_repo_path / ".config").exists():
+            logging.info("В дереве исходников осталась сборка без O=, выполняем make mrproper...")
+            self._run(["make", f"ARCH={KERNEL_ARCH}", "mrproper"], self.rpi_repo_path)
 
     def configure_kernel(self):
         """
-        Настраиваем ядро для ARM64 с использованием либо стандартной конфигурации,
-        либо конфигурации Raspberry Pi.
+        Настраиваем ядро для ARM64: defconfig платы (или стандартный), поверх него
+        фрагменты профиля, olddefconfig, при наличии манифеста модулей — обрезка
+        неиспользуемых модулей, и проверка, что все опции фрагментов сохранились.
         """
-        logging.info("Настраиваем параметры ядра для ARM64...")
+        logging.info(f"Настраиваем параметры ядра для ARM64 (профиль {self.profile})...")
+        self.check_toolchain()
+        if self.cross_compile:
+            logging.info(f"Кросс-компиляция: CROSS_COMPILE={self.cross_compile}")
+        self._prepare_tree()
+        previous = self.config_path.read_bytes() if self.config_path.exists() else None
+        previous_stat = self.config_path.stat() if previous is not None else None
 
         try:
             self._use_rpi_config()
         except FileNotFoundError as e:
             logging.error(f"Ошибка: {e}. Переходим к стандартной конфигурации.")
-            subprocess.run(["make", "ARCH=arm64", "defconfig"], check=True, cwd=self.rpi_repo_path)
-
-        # Применяем дополнительные изменения
-        config_path = self.rpi_repo_path / ".config"
-        with config_path.open("a") as config_file:
-            config_file.write("\n")
-            config_file.write("# Custom kernel configuration for Raspberry Pi\n")
-            config_file.write("CONFIG_CGROUPS=y\n")
-            config_file.write("CONFIG_NAMESPACES=y\n")
-            config_file.write("CONFIG_OVERLAY_FS=y\n")
-            config_file.write("CONFIG_TMPFS=y\n")
-            config_file.write("CONFIG_IPV6=y\n")
-            config_file.write("CONFIG_KVM=y\n")
-            config_file.write("CONFIG_VHOST_NET=y\n")
-            config_file.write("CONFIG_VFIO=y\n")
-            config_file.write("CONFIG_VFIO_PCI=y\n")
-            config_file.write("CONFIG_ISCSI_TCP=y\n")
-            config_file.write("CONFIG_MULTIPATH=y\n")
-            config_file.write("CONFIG_WATCHDOG=y\n")
-        subprocess.run(["make", "ARCH=arm64", "olddefconfig"], check=True, cwd=self.rpi_repo_path)
+            self._make("defconfig")
+
+        # Опции профиля из фрагментов (конфликты между фрагментами — ошибка)
+        config_path = self.config_path
+        options = merge_fragments(self.fragments)
+        apply_options(config_path, options)
+        self._make("olddefconfig")
+        if self.module_manifest is not None:
+            self._trim_modules(options)
+        dropped = check_options(config_path, options)
+        if dropped:
+            raise ConfigCheckError(
+                "Опции фрагментов не сохранились после olddefconfig (проверьте зависимости в Kconfig):\n  "
+                + "\n  ".join(dropped)
+            )
+        logging.info(f"Конфигурация ядра: {len(options)} опций профиля на месте, модулей: {len(module_options(config_path))}")
+        if previous is not None and config_path.read_bytes() == previous:
+            # Та же конфигурация: возвращаем прежний mtime, чтобы make не пересобирал лишнего
+            os.utime(config_path, ns=(previous_stat.st_atime_ns, previous_stat.st_mtime_ns))
+
+    def _trim_modules(self, options: Dict[str, str]):
+        """
+        Отключает модули, которых нет в манифесте эталонной загрузки (lsmod или /proc/modules):
+        make localmodconfig, затем снова опции профиля, чтобы обязательное не пропало.
+        """
+        before = module_options(self.config_path)
+        logging.info(f"Обрезаем неиспользуемые модули по {self.module_manifest}...")
+        self._make(f"LSMOD={self.module_manifest}", "localmodconfig")
+        apply_options(self.config_path, options)
+        self._make("olddefconfig")
+        after = module_options(self.config_path)
+        logging.info(f"Модулей в конфигурации: {len(before)} -> {len(after)}")
+
+    def source_revision(self) -> str:
+        """Коммит исходников; при локальных правках — ещё и хеш diff."""
+        head = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=self.rpi_repo_path, check=True, capture_output=True, text=True
+        ).stdout.strip()
+        diff = subprocess.run(["git", "diff", "HEAD"], cwd=self.rpi_repo_path, check=True, capture_output=True).stdout
+        return f"{head}+{hashlib.sha256(diff).hexdigest()[:16]}" if diff else head
 
+    def normalized_config(self) -> List[str]:
+        """
+        Значимые строки .config: без комментариев и порядка, «is not set» как =n.
+
+        Returns:
+            Отсортированный список CONFIG_X=значение.
+        """
+        options = []
+        for line in self.config_path.read_text().splitlines():
+            line = line.strip()
+            if line.startswith("# CONFIG_") and line.endswith(" is not set"):
+                options.append(line[2:-len(" is not set")] + "=n")
+            elif line and not line.startswith("#"):
+                options.append(line)
+        return sorted(options)
+
+    def build_key(self) -> str:
+        """Ключ кэша: коммит исходников + нормализованная конфигурация."""
+        digest = hashlib.sha256()
+        digest.update(f"{self.source_revision()}\n{KERNEL_ARCH}\n{self.cross_compile}\n".encode())
+        digest.update("\n".join(self.build_targets()).encode() + b"\n")
+        digest.update("\n".join(self.normalized_config()).encode())
+        return digest.hexdigest()[:32]
+
+    def dtb_targets(self) -> List[str]:
+        """DTB выбранного семейства плат и оверлеи — цели make относительно arch/arm64/boot/dts."""
+        dts_root = self.rpi_repo_path / "arch" / KERNEL_ARCH / "boot" / "dts"
+        targets = []
+        for pattern in self.dtbs:
+            matches = sorted(dts_root.glob(f"{pattern}.dts"))
+            if not matches and pattern not in self._missing_dtbs:
+                self._missing_dtbs.add(pattern)
+                logging.warning(f"Нет исходников DTB по шаблону {pattern} в {dts_root}")
+            targets.extend(str(m.relative_to(dts_root).with_suffix(".dtb")) for m in matches)
+        targets.extend(f"overlays/{name}.dtbo" for name in self.overlays)
+        return targets
+
+    def build_targets(self) -> List[str]:
+        """Только то, что ставится: Image, модули и DTB платы (без vmlinuz.efi и DTB чужих плат)."""
+        return ["Image", "modules"] + self.dtb_targets()
+
+    def _activate(self, entry: Path):
+        """Переключает temp/kernel на запись кэша."""
+        link = self.artifacts_path.with_name(self.artifacts_path.name + ".new")
+        if link.is_symlink() or link.exists():
+            link.unlink()
+        os.symlink(os.path.relpath(entry, self.artifacts_path.parent), link)
+        if self.artifacts_path.exists() and not self.artifacts_path.is_symlink():
+            shutil.rmtree(self.artifacts_path)
+        os.replace(link, self.artifacts_path)
+        (entry / ".complete").touch()
+
+    def _prune_cache(self):
+        entries = sorted(
+            (e for e in self.cache_path.iterdir() if (e / ".complete").exists()),
+            key=lambda e: (e / ".complete").stat().st_mtime,
+            reverse=True,
+        )
+        for entry in entries[KERNEL_CACHE_KEEP:]:
+            logging.info(f"Удаляем старую сборку ядра из кэша: {entry.name}")
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def _store_artifacts(self, key: str) -> Path:
+        """Складывает Image, выбранные DTB и архив модулей сборки в кэш."""
+        entry = self.cache_path / key
+        staging = self.cache_path / f"{key}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        shutil.copy2(self.build_path / "arch" / KERNEL_ARCH / "boot" / "Image", staging / "Image")
+        shutil.copy2(self.config_path, staging / "config")
+        built_dts = self.build_path / "arch" / KERNEL_ARCH / "boot" / "dts"
+        for target in self.dtb_targets():
+            (staging / "dts" / target).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(built_dts / target, staging / "dts" / target)
+        modules_root = staging / "modules-root"
+        self._make(f"INSTALL_MOD_PATH={modules_root}", "modules_install")
+        with tarfile.open(staging / "modules.tar.gz", "w:gz", compresslevel=1) as tar:
+            for item in sorted(modules_root.iterdir()):
+                tar.add(item, arcname=item.name)
+        shutil.rmtree(modules_root)
+        (staging / ".complete").touch()
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(staging, entry)
+        return entry
 
     def compile_kernel(self):
-        """Компилируем ядро, если оно не скомпилировано."""
-        kernel_path = self.kernel_image  # Путь к скомпилированному ядру
-        if not kernel_path.exists():
-            logging.info("Ядро не найдено, начинаем компиляцию...")
-            # Получаем количество доступных процессоров для оптимизации сборки
-            nproc = os.cpu_count() or 1
+        """
+        Собирает ядро или восстанавливает его из кэша.
 
-            # Запускаем команду make с использованием параллельной сборки
-            subprocess.run(["make", f"-j{nproc}"], check=True, cwd=self.rpi_repo_path)
+        Если для текущих коммита и конфигурации уже есть артефакты, make не
+        запускается. Иначе сборка идёт инкрементально в build_path, а Image, DTB и
+        модули сохраняются в кэш под новым ключом.
+        """
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        key = self.build_key()
+        entry = self.cache_path / key
+        if (entry / ".complete").exists():
+            logging.info(f"Ядро {key} найдено в кэше, компиляция не нужна.")
         else:
-            logging.info("Ядро уже скомпилировано, пропускаем компиляцию.")
+            logging.info(f"Ядра {key} нет в кэше, собираем в {self.build_path}...")
+            nproc = os.cpu_count() or 1
+            # Параллельная сборка; -l не даёт make перегрузить ядра, пока
+            # параллельно идут распаковка пакетов и копирование в rootfs
+            self._make(f"-j{nproc}", f"-l{nproc}", *self.build_targets())
+            entry = self._store_artifacts(key)
+        self._activate(entry)
+        self.cache_key = key
+        self._prune_cache()
 
     def install_kernel(self):
-        """Устанавливаем модули в rootfs и копируем Image/DTB в /boot."""
+        """Распаковываем модули из кэша в rootfs и копируем Image/DTB в /boot."""
         logging.info("Устанавливаем модули ядра в rootfs...")
-        subprocess.run(
-            ["make", "ARCH=arm64", f"INSTALL_MOD_PATH={self.rootfs_path}", "modules_install"],
-            check=True,
-            cwd=self.rpi_repo_path,
-        )
+        if self.modules_tarball.exists():
+            with tarfile.open(self.modules_tarball, "r:gz") as tar:
+                tar.extractall(self.rootfs_path, **TAR_EXTRACT_ARGS)
+        else:
+            logging.error(f"Архив модулей не найден: {self.modules_tarball}")
 
         boot_dir = self.rootfs_path / "boot"
         boot_dir.mkdir(parents=True, exist_ok=True)
@@ -126,12 +343,11 @@ class LinuxKernel:
         else:
             logging.error(f"Image не найден: {self.kernel_image}")
 
-        dtb_src_dir = self.rpi_repo_path / "arch" / "arm64" / "boot" / "dts"
-        if dtb_src_dir.exists():
+        if self.dtb_path.exists():
             dest_dtb_dir = boot_dir / "dts"
             if dest_dtb_dir.exists():
                 shutil.rmtree(dest_dtb_dir)
-            shutil.copytree(dtb_src_dir, dest_dtb_dir)
+            shutil.copytree(self.dtb_path, dest_dtb_dir)
             logging.info(f"Скопированы DTB-файлы в {dest_dtb_dir}")
         else:
-            logging.error(f"DTB директория не найдена: {dtb_src_dir}")
+            logging.error(f"DTB директория не найдена: {self.dtb_path}")
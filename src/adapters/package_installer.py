@@ -1,132 +1,455 @@
+import io
 import os
 import sys
+import glob
+import json
+import platform
+import shutil
+import hashlib
+import fnmatch
 import tarfile
 import logging
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from adapters.apt_index import AptIndex, DebPackage
+from core.build_stages import stage_output
+
+# Сколько пакетов распаковывается одновременно
+EXTRACT_WORKERS = os.cpu_count() or 1
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+STREAM_CHUNK = 1 << 20
+# Распаковка без фильтров безопасности tarfile: пакеты берутся из подписанного репозитория
+TAR_EXTRACT_ARGS = {"filter": "fully_trusted"} if hasattr(tarfile, "fully_trusted_filter") else {}
+
+
+class _BoundedReader(io.RawIOBase):
+    """Читает не больше size байт из f — член ar-архива без копирования на диск."""
+
+    def __init__(self, f, size: int):
+        self.f = f
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.remaining)
+        if n == 0:
+            return 0
+        data = self.f.read(n)
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def iter_ar_members(f):
+    """Члены ar-архива: (имя, размер); после каждого f стоит на начале данных члена."""
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise tarfile.ReadError("не ar-архив")
+    while True:
+        header = f.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return
+        name = header[:16].decode().strip().rstrip("/")
+        size = int(header[48:58].decode().strip())
+        start = f.tell()
+        yield name, size
+        # Данные члена выровнены на 2 байта
+        f.seek(start + size + (size & 1))
+
+
+def _feed(reader, stdin):
+    try:
+        while True:
+            chunk = reader.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            stdin.write(chunk)
+    except BrokenPipeError:
+        pass
+    finally:
+        stdin.close()
+
+
+@contextmanager
+def open_data_tar(name: str, reader):
+    """Потоковый tarfile для data.tar.* с нужным декомпрессором."""
+    if name.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+        if zstandard is not None:
+            with tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(reader), mode="r|") as tar:
+                yield tar
+            return
+        proc = subprocess.Popen(["zstd", "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        feeder = threading.Thread(target=_feed, args=(reader, proc.stdin), daemon=True)
+        feeder.start()
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                yield tar
+        finally:
+            proc.stdout.close()
+            feeder.join()
+            proc.wait()
+        # Код zstd проверяется, только если чтение архива прошло без ошибок: иначе
+        # исходное исключение (StreamError, OSError при нехватке места) важнее
+        if proc.returncode != 0:
+            raise tarfile.ReadError(f"zstd завершился с кодом {proc.returncode}")
+        return
+    modes = {".gz": "r|gz", ".xz": "r|xz", ".bz2": "r|bz2", ".tar": "r|"}
+    mode = modes.get(os.path.splitext(name)[1])
+    if mode is None:
+        raise tarfile.ReadError(f"Неизвестный формат архива данных: {name}")
+    with tarfile.open(fileobj=reader, mode=mode) as tar:
+        yield tar
+
+
+def path_filter(include: Optional[Iterable[str]] = None, exclude: Optional[Iterable[str]] = None):
+    """Предикат по пути члена (без «./»): шаблоны fnmatch, exclude важнее include."""
+    include = list(include) if include is not None else None
+    exclude = list(exclude or [])
+
+    def accept(path: str) -> bool:
+        if include is not None and not any(fnmatch.fnmatchcase(path, p) for p in include):
+            return False
+        return not any(fnmatch.fnmatchcase(path, p) for p in exclude)
+
+    return accept
+
+
+def extract_deb(
+    deb_path: Path,
+    dest: Path,
+    include: Optional[Iterable[str]] = None,
+    exclude: Optional[Iterable[str]] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Распаковывает data.tar пакета в dest за один проход, без временных файлов.
+
+    ar-контейнер разбирается в процессе, член data.tar.* идёт потоком через
+    декомпрессор прямо в tarfile. Жёсткая ссылка на файл, который не распакован
+    (отброшен exclude или include), пропускается: в потоке его данные уже не перечитать.
+
+    Args:
+        deb_path: Путь к .deb файлу.
+        dest: Куда распаковывать (rootfs).
+        include: Шаблоны путей, которые распаковывать (по умолчанию все).
+        exclude: Шаблоны путей, которые пропускать.
+
+    Returns:
+        Члены, прошедшие фильтр: (нормализованный путь, тип: "dir", "symlink" или "file").
+    """
+    accept = path_filter(include, exclude)
+    members = []
+    with open(deb_path, "rb") as f:
+        for name, size in iter_ar_members(f):
+            if not name.startswith("data.tar"):
+                continue
+            reader = io.BufferedReader(_BoundedReader(f, size), STREAM_CHUNK)
+            with open_data_tar(name, reader) as tar:
+                for member in tar:
+                    path = os.path.normpath(member.name.lstrip("/"))
+                    if path == "." or not accept(path):
+                        continue
+                    if member.islnk() and not os.path.lexists(dest / os.path.normpath(member.linkname.lstrip("/"))):
+                        logging.debug(f"{deb_path.name}: {path} ссылается на нераспакованный {member.linkname}, пропущен")
+                        continue
+                    target = dest / path
+                    try:
+                        # Пакеты распаковываются параллельно: родитель создаётся без гонки
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        # Файл другого пакета (или ссылка) на этом месте заменяется, а не пишется сквозь ссылку
+                        if not member.isdir() and (target.is_symlink() or (target.exists() and not target.is_dir())):
+                            target.unlink(missing_ok=True)
+                        tar.extract(member, path=dest, **TAR_EXTRACT_ARGS)
+                    except (OSError, tarfile.ExtractError) as e:
+                        logging.warning(f"{deb_path.name}: не удалось распаковать {path}: {e}")
+                    # Член учитывается и при ошибке: ссылка, не ставшая поверх каталога
+                    # другого пакета, — это конфликт, который разбирает установщик
+                    kind = "dir" if member.isdir() else "symlink" if member.issym() else "file"
+                    members.append((path, kind))
+            return members
+    raise tarfile.ReadError(f"Файл data.tar.* не найден в {deb_path}!")
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def host_arch() -> str:
+    """Архитектура dpkg хоста сборки (amd64, arm64, ...)."""
+    return subprocess.run(
+        ["dpkg", "--print-architecture"], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
 
 class PackageInstaller:
     """
     Установщик пакетов в контейнер.
+
+    Пакеты ставятся вместе с замыканием зависимостей из индексов apt. Загруженные
+    .deb хранятся в кэше по sha256 (temp/debs), выбранные версии записываются в
+    lock-файл: повторная сборка с тем же списком пакетов не обращается ни к индексам,
+    ни к сети.
     """
     temp_path: Path
     rootfs_path: Path
 
-    def __init__(self, temp_path: str, rootfs_path: str):
+    def __init__(
+        self,
+        temp_path: str,
+        rootfs_path: str,
+        exclude: Optional[List[str]] = None,
+        arch: Optional[str] = None,
+        lock_path: Optional[str] = None,
+        skip_packages: Optional[List[str]] = None,
+    ):
         """
         Инициализирует установщик пакетов.
 
         Args:
             temp_path: Путь к временной директории.
             rootfs_path: Путь к директории rootfs контейнера.
+            exclude: Шаблоны путей пакетов, которые не ставятся в rootfs (документация и т.п.).
+            arch: Архитектура пакетов (по умолчанию — архитектура хоста).
+            lock_path: Lock-файл с выбранными версиями (по умолчанию temp/packages.lock.json).
+            skip_packages: Зависимости, которые не тянутся в rootfs (dpkg, debconf и т.п.).
         """
         self.temp_path = Path(temp_path)
         self.rootfs_path = Path(rootfs_path)
-        self.temp_path.mkdir(parents=True, exist_ok=True)
+        self.exclude = list(exclude or [])
+        self.arch = arch or host_arch()
+        self.cache_path = self.temp_path / "debs"
+        self.lock_path = Path(lock_path) if lock_path else self.temp_path / "packages.lock.json"
+        self.skip_packages = sorted(skip_packages or [])
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+
+    def _cached_deb(self, package: DebPackage) -> Path:
+        return self.cache_path / f"{package.sha256}.deb"
 
-    def _install_deb(self, deb_path: Path):
+    def _is_cached(self, package: DebPackage) -> bool:
         """
-        Устанавливает .deb пакет в директорию rootfs контейнера.
+        Лежит ли в кэше целый .deb: совпадают размер и sha256 из индекса.
 
-        Args:
-            deb_path: Путь к .deb файлу.
+        Повреждённый файл того же размера удаляется, чтобы загрузиться заново,
+        а не попасть в rootfs.
         """
-        if not deb_path.exists():
-            logging.error(f"Файл {deb_path} не найден!")
-            return
+        path = self._cached_deb(package)
+        if not path.exists():
+            return False
+        if path.stat().st_size == package.size and file_sha256(path) == package.sha256:
+            return True
+        logging.warning(f"Повреждённый .deb в кэше: {path.name} ({package.name}), загружаем заново")
+        path.unlink()
+        return False
 
-        try:
-            subprocess.run(["ar", "x", str(deb_path)], cwd=self.temp_path, check=True)
-
-            data_archives = list(self.temp_path.glob("data.tar.*"))
-            if not data_archives:
-                logging.error(f"Файл data.tar.* не найден в {deb_path}!")
-                return
-
-            data_file = data_archives[0]
-            suffix = "".join(data_file.suffixes)
-
-            if suffix.endswith(".tar.zst"):
-                subprocess.run(
-                    ["tar", "--zstd", "-xf", str(data_file), "-C", str(self.rootfs_path)],
-                    check=True,
-                )
-            else:
-                mode = "r:xz" if suffix.endswith(".tar.xz") else "r:gz" if suffix.endswith(".tar.gz") else None
-                if not mode:
-                    logging.error(f"Неизвестный формат архива данных: {data_file}")
-                    return
-                with tarfile.open(data_file, mode=mode) as tar:
-                    tar.extractall(path=self.rootfs_path)
-
-            logging.info(f"Пакет {deb_path.name} успешно установлен.")
+    def resolve(self, packages: List[str]) -> List[DebPackage]:
+        """
+        Пакеты для установки с зависимостями: из lock-файла, если он составлен для
+        того же списка, иначе из индексов apt (с записью нового lock-файла).
 
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Ошибка при распаковке пакета {deb_path.name}: {e}")
-        except tarfile.ReadError as e:
-            logging.error(f"Ошибка при чтении tar архива {data_file}: {e}")
-        finally:
-            # Очистка временных файлов
-            for tarball in self.temp_path.glob("data.tar.*"):
-                tarball.unlink()
-            for file in self.temp_path.glob("*.deb"):
-                file.unlink()
+        Args:
+            packages: Имена пакетов.
 
-    def _download_and_install_package(self, package_name: str):
+        Returns:
+            Пакеты в порядке «зависимости раньше зависящих».
         """
-        Загружает и устанавливает пакет из репозитория.
+        request = {"arch": self.arch, "requested": sorted(packages), "skip": self.skip_packages}
+        if self.lock_path.exists():
+            lock = json.loads(self.lock_path.read_text())
+            if {key: lock.get(key) for key in request} == request:
+                logging.info(f"Версии пакетов взяты из {self.lock_path}")
+                return [DebPackage(filename="", **entry) for entry in lock["packages"]]
+
+        logging.info(f"Разрешаем зависимости пакетов по индексам apt ({self.arch})...")
+        resolved = AptIndex(self.arch).resolve(packages, skip=self.skip_packages)
+        lock = dict(request)
+        lock["packages"] = [
+            {"name": p.name, "version": p.version, "arch": p.arch, "sha256": p.sha256, "size": p.size}
+            for p in resolved
+        ]
+        self.lock_path.write_text(json.dumps(lock, indent=2) + "\n")
+        logging.info(f"{len(resolved)} пакетов с зависимостями, lock-файл: {self.lock_path}")
+        return resolved
+
+    def _download_packages(self, packages: List[DebPackage]):
+        """
+        Загружает пакеты одним вызовом apt-get download и кладёт их в кэш по sha256.
 
         Args:
-            package_name: Имя пакета.
+            packages: Пакеты с точными версиями и контрольными суммами.
         """
-        logging.info(f"Загружаем и устанавливаем пакет {package_name}...")
+        logging.info(f"Загружаем пакеты: {', '.join(p.name for p in packages)}...")
+        partial = self.cache_path / "partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        partial.mkdir(parents=True)
         try:
             if not self._is_apt_get_available():
                 raise EnvironmentError("apt-get не найден. Убедитесь, что он установлен и доступен в PATH.")
+            specs = [f"{p.name}={p.version}" if p.arch == "all" else f"{p.name}:{p.arch}={p.version}" for p in packages]
             subprocess.run(
-                ["apt-get", "download", package_name],
-                cwd=self.temp_path,
+                ["apt-get", "download", *specs],
+                cwd=partial,
                 check=True,
                 capture_output=True,
                 text=True
             )
-
-            deb_files = list(self.temp_path.glob(f"{package_name}*.deb"))
-            if not deb_files:
-                raise FileNotFoundError(f"Не найден .deb файл для пакета {package_name}")
-            for deb_file in deb_files:
-                self._install_deb(deb_file)
-            
-
+            expected = {p.sha256: p for p in packages}
+            for deb_file in partial.glob("*.deb"):
+                digest = file_sha256(deb_file)
+                if digest in expected:
+                    os.replace(deb_file, self._cached_deb(expected.pop(digest)))
+                else:
+                    logging.error(f"Контрольная сумма {deb_file.name} не совпадает с индексом")
+            if expected:
+                names = ", ".join(sorted(p.name for p in expected.values()))
+                raise FileNotFoundError(f"Не загружены или повреждены пакеты: {names}")
         except subprocess.CalledProcessError as e:
-            logging.error(f"Ошибка при загрузке пакета {package_name}: {e.stderr}")
+            logging.error(f"Ошибка при загрузке пакетов: {e.stderr}")
             raise
         except EnvironmentError as e:
             logging.error(f"Ошибка окружения: {e}")
             raise
-        except FileNotFoundError as e:
-            logging.error(f"Ошибка: {e}")
-            raise
+        finally:
+            shutil.rmtree(partial, ignore_errors=True)
+
+    def _find_conflicts(self, listings: Dict[str, List[Tuple[str, str]]]) -> Dict[str, List[str]]:
+        """
+        Файлы (не директории), которые ставят несколько пакетов.
+
+        Args:
+            listings: Списки членов архивов в порядке установки пакетов.
+
+        Returns:
+            Путь -> пакеты в порядке установки.
+        """
+        owners: Dict[str, List[str]] = {}
+        for package, members in listings.items():
+            for name, kind in members:
+                if kind != "dir":
+                    owners.setdefault(name, []).append(package)
+        return {path: pkgs for path, pkgs in sorted(owners.items()) if len(pkgs) > 1}
+
+    def _find_type_conflicts(self, listings: Dict[str, List[Tuple[str, str]]]) -> Dict[str, List[str]]:
+        """
+        Пути, которые одни пакеты ставят директорией, а другие — ссылкой или файлом
+        (merged-/usr: ссылка lib -> usr/lib в одном пакете и каталог lib/ в другом).
+        При параллельной распаковке итог на таком пути зависит от того, кто успел первым.
+
+        Args:
+            listings: Списки членов архивов в порядке установки пакетов.
+
+        Returns:
+            Путь -> пакеты, которые ставят сам путь или пути под ним, в порядке установки.
+            Конфликты внутри уже конфликтующего пути не перечисляются отдельно.
+        """
+        kinds: Dict[str, set] = {}
+        for members in listings.values():
+            for name, kind in members:
+                kinds.setdefault(name, set()).add(kind)
+        roots: List[str] = []
+        for path in sorted(path for path, found in kinds.items() if "dir" in found and len(found) > 1):
+            if not any(path.startswith(root + "/") for root in roots):
+                roots.append(path)
+        return {
+            root: [
+                package for package, members in listings.items()
+                if any(name == root or name.startswith(root + "/") for name, _ in members)
+            ]
+            for root in roots
+        }
+
+    def _replay_in_order(self, debs: Dict[str, Path], path: str, packages: List[str]):
+        """
+        Заново распаковывает path со всем содержимым из packages по одному, в порядке
+        установки: итог тот же, что при последовательной установке.
+        """
+        target = self.rootfs_path / path
+        if target.is_dir() and not target.is_symlink():
+            shutil.rmtree(target)
+        elif target.is_symlink() or target.exists():
+            target.unlink()
+        patterns = [glob.escape(path), glob.escape(path) + "/*"]
+        for package in packages:
+            extract_deb(debs[package], self.rootfs_path, include=patterns)
+
+    def fetch_packages(self, packages: List[str]) -> Dict[str, Path]:
+        """
+        Разрешает зависимости и догружает в кэш недостающие .deb; rootfs не трогает.
+
+        Args:
+            packages: Список имен пакетов.
+
+        Returns:
+            Имя пакета -> .deb в кэше, в порядке установки.
+        """
+        resolved = self.resolve(packages)
+        missing = [p for p in resolved if not self._is_cached(p)]
+        if missing:
+            self._download_packages(missing)
+        return {p.name: self._cached_deb(p) for p in resolved}
 
     def install_base_packages(self, packages: List[str]):
         """
         Устанавливает базовые пакеты в контейнер.
 
+        Пакеты берутся вместе с зависимостями (resolve), недостающие в кэше .deb
+        загружаются одним вызовом apt-get, затем пакеты распаковываются параллельно
+        потоком прямо в rootfs. Файл, который ставят несколько пакетов, достаётся
+        последнему в порядке установки (зависимости раньше зависящих): после общей
+        распаковки такие пути распаковываются ещё раз из пакета-победителя.
+        Путь, который одни пакеты ставят директорией, а другие ссылкой или файлом,
+        распаковывается заново из всех этих пакетов по очереди в порядке установки.
+        Конфликты перечисляются в логе; если хоть один пакет не распаковался,
+        этап завершается ошибкой, когда закончат остальные.
+
         Args:
             packages: Список имен пакетов.
         """
         logging.info("Устанавливаем базовые пакеты в контейнер...")
 
-        for package in packages:
-            deb_files = list(self.temp_path.glob(f"{package}_*.deb"))
-            if deb_files:
-                #берем последний скаченный файл
-                deb_file = sorted(deb_files, key=os.path.getmtime)[-1]
-                logging.info(f"Пакет {package} найден в {self.temp_path}, установка")
-                self._install_deb(deb_file)
-            else:
-                self._download_and_install_package(package)
+        debs = self.fetch_packages(packages)
+
+        listings: Dict[str, List[Tuple[str, str]]] = {}
+        failed: Dict[str, Exception] = {}
+        with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as pool:
+            futures = {
+                package: pool.submit(extract_deb, deb, self.rootfs_path, exclude=self.exclude)
+                for package, deb in debs.items()
+            }
+            for package, future in futures.items():
+                try:
+                    listings[package] = future.result()
+                    logging.info(f"Пакет {package} успешно установлен.")
+                except (OSError, tarfile.TarError) as e:
+                    logging.error(f"Ошибка при распаковке пакета {package}: {e}")
+                    failed[package] = e
+        if failed:
+            # rootfs без этих пакетов неполон: этап не должен попасть в манифест как успешный
+            raise RuntimeError(f"Не удалось распаковать пакеты: {', '.join(failed)}") from next(iter(failed.values()))
+
+        for path, owners in self._find_type_conflicts(listings).items():
+            logging.warning(f"Конфликт типов: {path} ставят {', '.join(owners)}; распаковывается по порядку установки")
+            self._replay_in_order(debs, path, owners)
+
+        winners: Dict[str, List[str]] = {}
+        for path, owners in self._find_conflicts(listings).items():
+            logging.warning(f"Конфликт файлов: {path} ставят {', '.join(owners)}; оставлен из {owners[-1]}")
+            winners.setdefault(owners[-1], []).append(glob.escape(path))
+        for package, paths in winners.items():
+            extract_deb(debs[package], self.rootfs_path, include=paths)
 
         logging.info("Базовые пакеты установлены.")
 
@@ -143,10 +466,13 @@ class PackageInstaller:
 def install_dependencies():
     """Устанавливаем необходимые зависимости для сборки ядра."""
     logging.info("Устанавливаем зависимости...")
+    # Вывод apt — в лог этапа сборки, если он есть
+    log = stage_output()
+    stderr = subprocess.STDOUT if log else None
     
     # Сначала устанавливаем gpgv
     try:
-        subprocess.run(["sudo", "apt-get", "install", "-y", "gpgv2"], check=True)
+        subprocess.run(["sudo", "apt-get", "install", "-y", "gpgv2"], check=True, stdout=log, stderr=stderr)
     except subprocess.CalledProcessError:
         logging.error("Ошибка при установке gpgv")
         sys.exit(1)
@@ -160,11 +486,14 @@ def install_dependencies():
         "bc",
         "git",
     ]
+    # Ядро arm64 на x86-хосте собирается кросс-компилятором
+    if platform.machine() not in ("aarch64", "arm64"):
+        dependencies.append("gcc-aarch64-linux-gnu")
     
     # Затем устанавливаем остальные зависимости
     try:
         # subprocess.run(["sudo", "apt", "update"], check=True)
-        subprocess.run(["sudo", "apt", "install", "-y"] + dependencies, check=True)
+        subprocess.run(["sudo", "apt", "install", "-y"] + dependencies, check=True, stdout=log, stderr=stderr)
     except subprocess.CalledProcessError as e:
         logging.error(f"Ошибка при установке зависимостей: {e}")
         sys.exit(1)
@@ -2,12 +2,13 @@
 import logging
 import subprocess
 import sys
-import time
 from pathlib import Path
 
 import ovs.db.idl
 import ovs.poller
 
+from sysdb import ChangeDebouncer, SysdbIdl, publish_agent_stats
+
 SCHEMA = "/etc/openvswitch/system.ovsschema"
 REMOTE = "unix:/var/run/openvswitch/db.sock"
 POLL_INTERVAL = 1.0
@@ -69,11 +70,13 @@ def apply_interface(row):
         run_cmd(["ip", "addr", "replace", ip_addr, "dev", name])
 
 
-def apply_interfaces(idl):
+def apply_interfaces(idl, uuids=None):
+    """Применяет строки Interface; uuids — только изменившиеся (удалённые пропускаются)."""
     iface_table = idl.tables.get("Interface")
     if not iface_table:
         return
-    for row in iface_table.rows.values():
+    rows = iface_table.rows.values() if uuids is None else (iface_table.rows[u] for u in uuids if u in iface_table.rows)
+    for row in rows:
         if not getattr(row, "name", None):
             continue
         apply_interface(row)
@@ -91,22 +94,26 @@ def main():
 
     helper = ovs.db.idl.SchemaHelper(location=SCHEMA)
     helper.register_all()
-    idl = ovs.db.idl.Idl(REMOTE, helper)
+    idl = SysdbIdl(REMOTE, helper)
 
     poller = ovs.poller.Poller()
+    debouncer = ChangeDebouncer(("System", "Interface"))
     logging.info("net_agent запущен, ждём данные из OVSDB...")
 
     while True:
-        seqno = idl.change_seqno
         idl.run()
-        if idl.change_seqno != seqno:
+        debouncer.add(idl.take_changes())
+        changes = debouncer.take_ready()
+        if "System" in changes:
             apply_system_settings(idl)
-            apply_interfaces(idl)
+        if "Interface" in changes:
+            apply_interfaces(idl, changes["Interface"])
+        # Не чаще AGENT_STATS_INTERVAL, поэтому и последний проход пачки попадёт в AgentStats
+        publish_agent_stats(idl, "net_agent", debouncer)
 
         idl.wait(poller)
-        poller.timer_wait(POLL_INTERVAL * 1000)
+        poller.timer_wait(int(min(POLL_INTERVAL, debouncer.timeout()) * 1000))
         poller.block()
-        time.sleep(POLL_INTERVAL)
 
 
 if __name__ == "__main__":
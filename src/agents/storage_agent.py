@@ -1,16 +1,67 @@
 #!/usr/bin/env python3
 import logging
+import os
+import re
+import socket
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Dict, List, Set, Tuple
 
 import ovs.db.idl
 import ovs.poller
 
+from sysdb import ChangeDebouncer, SysdbIdl, agent_stats_txn
+
 SCHEMA = "/etc/openvswitch/system.ovsschema"
 REMOTE = "unix:/var/run/openvswitch/db.sock"
 POLL_INTERVAL = 2.0
+ISCSI_PORT = 3260
+ISCSI_SESSIONS = Path("/sys/class/iscsi_session")
+ISCSI_CONNECTIONS = Path("/sys/class/iscsi_connection")
+DEV_DIR = Path("/dev")
+SYS_BLOCK = Path("/sys/class/block")
+ISCSI_NODES = Path("/etc/iscsi/nodes")
+# Строка iscsiadm -m session: номер сессии и портал (IPv6 — в скобках)
+SESSION_LINE_RE = re.compile(r"\[(\d+)\]\s+(\[[^\]]+\](?::\d+)?|[^\s,]+),\d+")
+MOUNTINFO = Path("/proc/self/mountinfo")
+NETLINK_KOBJECT_UEVENT = 15
+# Сколько ждать появления блочного устройства после логина
+DEVICE_TIMEOUT = 15.0
+# Пауза перед повторной попыткой для цели в состоянии degraded
+RETRY_INTERVAL = 10.0
+MAX_WORKERS = 16
+# Селектор пути dm-multipath -> аргументы каждого пути (repeat_count[, relative_throughput])
+PATH_SELECTORS = {
+    "round-robin": ("1",),
+    "queue-length": ("1",),
+    "service-time": ("1", "1"),
+}
+DEFAULT_PATH_SELECTOR = "service-time"
+# Период публикации I/O-телеметрии в Storage.io_stats и относительный порог (deadband),
+# ниже которого изменение метрики не записывается
+STATS_INTERVAL = float(os.environ.get("STORAGE_STATS_INTERVAL", "5"))
+STATS_DEADBAND = float(os.environ.get("STORAGE_STATS_DEADBAND", "0.05"))
+# Колонки Storage, которые пишет сам агент: их изменение не запускает согласование
+STATUS_COLUMNS = {"Storage": {"path_status", "io_stats", "cache_stats"}}
+SECTOR_SIZE = 512
+CACHE_STATE_DIR = Path("/var/lib/litainer/cache")
+# writecache — dm-writecache, writethrough/writeback — режимы dm-cache
+CACHE_MODES = ("writecache", "writethrough", "writeback")
+CACHE_BLOCK_SECTORS = 512  # блок dm-cache 256 КиБ
+CACHE_FLUSH_TIMEOUT = 600.0
+# Опции монтирования профиля -> обратные: ими remount снимает опцию, убранную из профиля
+MOUNT_OPTION_INVERSE = {"noatime": "relatime", "discard": "nodiscard", "commit": "commit=0"}
+
+STATE_DISCOVER = "discover"
+STATE_LOGIN = "login"
+STATE_DEVICE_READY = "device-ready"
+STATE_MOUNTED = "mounted"
+STATE_DEGRADED = "degraded"
 
 
 def run_cmd(cmd):
@@ -26,42 +77,1005 @@ def run_cmd(cmd):
         return False
 
 
-def ensure_session(row):
-    target = row.target_iqn
-    portal = row.portal_ip
-    lun = getattr(row, "lun", None)
-    mount_point = getattr(row, "mount_point", "") or f"/mnt/{target.replace(':', '_')}"
+def optional_value(value, default=None):
+    # Необязательные колонки (min 0, max 1) IDL отдаёт списком из 0 или 1 элемента
+    if isinstance(value, list):
+        return value[0] if value else default
+    return default if value is None else value
 
-    if not target or not portal:
-        logging.error("Строка Storage не содержит target_iqn или portal_ip")
-        return
 
-    # Логин в iSCSI
-    login_cmd = ["iscsiadm", "-m", "node", "-T", target, "-p", portal, "--login"]
-    run_cmd(login_cmd)
+def read_attr(path: Path) -> str:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return ""
+
+
+def portal_address(portal: str) -> str:
+    """Адрес портала без порта: 10.0.0.1:3260 -> 10.0.0.1, [fe80::1]:3260 -> fe80::1."""
+    match = re.fullmatch(r"\[([^\]]+)\](?::\d+)?", portal)
+    if match:
+        return match.group(1)
+    if portal.count(":") == 1:
+        return portal.split(":", 1)[0]
+    return portal
+
+
+def portal_port(portal: str) -> int:
+    """Порт портала: 10.0.0.1:3261 -> 3261, без порта — стандартный ISCSI_PORT."""
+    match = re.fullmatch(r"\[[^\]]+\]:(\d+)|[^:]+:(\d+)", portal)
+    if match:
+        return int(match.group(1) or match.group(2))
+    return ISCSI_PORT
+
+
+def iscsiadm_session_portals() -> Dict[str, str]:
+    """Номер сессии -> адрес портала по iscsiadm -m session."""
+    try:
+        result = subprocess.run(["iscsiadm", "-m", "session"], capture_output=True, text=True)
+    except OSError:
+        return {}
+    portals = {}
+    # tcp: [3] 10.0.0.1:3260,1 iqn.2024-01.example:disk (non-flash)
+    for match in SESSION_LINE_RE.finditer(result.stdout):
+        portals[match.group(1)] = portal_address(match.group(2))
+    return portals
+
+
+def find_sessions(target: str, portal: str) -> List[Path]:
+    """
+    Ищет установленные iSCSI-сессии цели через портал в sysfs.
+
+    Сессия сопоставляется по цели и адресу портала всегда: иначе при нескольких
+    порталах одна сессия попала бы в пути каждого из них. Адрес берётся из
+    persistent_address (или address) соединения, а если ядро их не публикует —
+    из iscsiadm -m session.
+    """
+    if not ISCSI_SESSIONS.exists():
+        return []
+    address = portal_address(portal)
+    sessions = []
+    fallback = None
+    for session in sorted(ISCSI_SESSIONS.iterdir()):
+        if read_attr(session / "targetname") != target:
+            continue
+        sid = session.name[len("session"):]
+        addresses = set()
+        for conn in ISCSI_CONNECTIONS.glob(f"connection{sid}:*"):
+            addresses.add(read_attr(conn / "persistent_address") or read_attr(conn / "address"))
+        addresses.discard("")
+        if not addresses:
+            if fallback is None:
+                fallback = iscsiadm_session_portals()
+            addresses = {fallback.get(sid, "")}
+        if address in addresses:
+            sessions.append(session)
+    return sessions
+
+
+def session_block_device(session: Path, lun: int):
+    # sessionN/device/targetH:C:T/H:C:T:L/block/sdX
+    for block in (session / "device").glob(f"target*/*:*:*:{lun}/block/*"):
+        return block.name
+    return None
+
+
+def block_dev_numbers(name: str) -> str:
+    return read_attr(Path("/sys/class/block") / name / "dev")
+
+
+def block_dev_name(numbers: str) -> str:
+    try:
+        return Path("/sys/dev/block", numbers).resolve().name
+    except OSError:
+        return numbers
+
+
+def multipath_name(target: str, lun: int) -> str:
+    return "mpath_" + re.sub(r"[^A-Za-z0-9_.-]", "_", target) + f"_{lun}"
+
+
+def dm_exists(name: str) -> bool:
+    return subprocess.run(["dmsetup", "table", name], capture_output=True).returncode == 0
+
+
+def dm_status(name: str) -> List[str]:
+    try:
+        result = subprocess.run(["dmsetup", "status", name], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return result.stdout.split()
+
+
+def device_sectors(device: str) -> int:
+    name = Path(device).resolve().name
+    return int(read_attr(Path("/sys/class/block") / name / "size") or 0)
+
+
+def zero_superblock(device: str):
+    # Чистый заголовок метаданных — dm-cache/dm-writecache форматируют устройство заново
+    with open(device, "r+b") as dev:
+        dev.write(b"\0" * 4096)
+        dev.flush()
+        os.fsync(dev.fileno())
+
 
-    device_path = f"/dev/disk/by-path/ip-{portal}:3260-iscsi-{target}-lun-{lun or 0}"
+def attach_cache_backing(path: str, size_mb: int):
+    """Возвращает блочное устройство кэша; файл подключается через loop. Второе значение — создан ли файл."""
+    backing = Path(path)
+    if backing.is_block_device():
+        return str(backing), False
+    fresh = not backing.exists()
+    if fresh:
+        if not size_mb:
+            raise ValueError(f"Файл кэша {path} не существует и cache_size_mb не задан")
+        backing.parent.mkdir(parents=True, exist_ok=True)
+        with open(backing, "wb") as f:
+            f.truncate(size_mb * 1024 * 1024)
+    attached = subprocess.run(["losetup", "-j", str(backing)], capture_output=True, text=True)
+    if attached.returncode == 0 and attached.stdout.strip():
+        return attached.stdout.split(":", 1)[0], fresh
+    loop = subprocess.run(["losetup", "--find", "--show", str(backing)], capture_output=True, text=True, check=True)
+    return loop.stdout.strip(), fresh
 
-    # Ожидаем появления устройства
-    for _ in range(5):
-        if Path(device_path).exists():
-            break
+
+def setup_cache(name: str, origin: str, backing_path: str, mode: str, size_mb: int = None) -> str:
+    """Собирает dm-writecache или dm-cache поверх origin и возвращает путь к устройству."""
+    device = f"/dev/mapper/{name}"
+    if dm_exists(name):
+        return device
+    backing, fresh = attach_cache_backing(backing_path, size_mb)
+    marker = CACHE_STATE_DIR / f"{name}.init"
+    fresh = fresh or not marker.exists()
+    origin_size = device_sectors(origin)
+    if mode == "writecache":
+        if fresh:
+            zero_superblock(backing)
+        table = f"0 {origin_size} writecache s {origin} {backing} 4096 0"
+    else:
+        # Кэш-устройство делится dm-linear на метаданные и данные
+        cache_size = device_sectors(backing)
+        meta_size = max(8192, cache_size // 100)
+        meta, data = f"{name}_meta", f"{name}_data"
+        for part, table in (
+            (meta, f"0 {meta_size} linear {backing} 0"),
+            (data, f"0 {cache_size - meta_size} linear {backing} {meta_size}"),
+        ):
+            if not dm_exists(part):
+                subprocess.run(["dmsetup", "create", part, "--table", table], check=True, capture_output=True)
+        subprocess.run(["dmsetup", "mknodes", meta], check=True, capture_output=True)
+        if fresh:
+            zero_superblock(f"/dev/mapper/{meta}")
+        table = (
+            f"0 {origin_size} cache /dev/mapper/{meta} /dev/mapper/{data} {origin} "
+            f"{CACHE_BLOCK_SECTORS} 1 {mode} default 0"
+        )
+    subprocess.run(["dmsetup", "create", name, "--table", table], check=True, capture_output=True)
+    subprocess.run(["dmsetup", "mknodes", name], check=True, capture_output=True)
+    CACHE_STATE_DIR.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+    return device
+
+
+def cache_stats(name: str, mode: str) -> Dict[str, int]:
+    tokens = dm_status(name)
+    if len(tokens) < 4:
+        return {}
+    fields = tokens[3:]
+    try:
+        if mode == "writecache":
+            # <errors> <blocks> <free> <writeback> [<reads> <read hits> <writes> <write hits uncommitted> ...]
+            stats = {
+                "errors": int(fields[0]),
+                "blocks": int(fields[1]),
+                "free_blocks": int(fields[2]),
+                "writeback_blocks": int(fields[3]),
+            }
+            if len(fields) >= 9:
+                reads, read_hits, writes = int(fields[4]), int(fields[5]), int(fields[6])
+                write_hits = int(fields[7]) + int(fields[8])
+                stats.update(
+                    read_hits=read_hits,
+                    read_misses=reads - read_hits,
+                    write_hits=write_hits,
+                    write_misses=writes - write_hits,
+                )
+            return stats
+        # dm-cache: <md bs> <used>/<total md> <cache bs> <used>/<total cache> <read hits> <read misses>
+        # <write hits> <write misses> <demotions> <promotions> <dirty> ...
+        used, total = fields[3].split("/")
+        return {
+            "used_blocks": int(used),
+            "blocks": int(total),
+            "read_hits": int(fields[4]),
+            "read_misses": int(fields[5]),
+            "write_hits": int(fields[6]),
+            "write_misses": int(fields[7]),
+            "demotions": int(fields[8]),
+            "promotions": int(fields[9]),
+            "dirty": int(fields[10]),
+        }
+    except (ValueError, IndexError):
+        return {}
+
+
+def flush_cache(name: str, mode: str) -> bool:
+    """Сбрасывает грязные блоки на origin перед отключением кэша."""
+    if mode == "writecache":
+        # На suspend dm-writecache дописывает всё на origin и только потом возвращает управление
+        return run_cmd(["dmsetup", "message", name, "0", "flush_on_suspend"]) and run_cmd(["dmsetup", "suspend", name])
+    if mode == "writethrough":
+        return True
+    # dm-cache writeback: политика cleaner вычищает грязные блоки, ждём dirty == 0
+    table = subprocess.run(["dmsetup", "table", name], capture_output=True, text=True).stdout.split()
+    if len(table) < 8:
+        return False
+    cleaner = " ".join(table[:7] + ["1", "writeback", "cleaner", "0"])
+    if not (run_cmd(["dmsetup", "reload", name, "--table", cleaner]) and run_cmd(["dmsetup", "resume", name])):
+        return False
+    deadline = time.monotonic() + CACHE_FLUSH_TIMEOUT
+    while time.monotonic() < deadline:
+        if cache_stats(name, mode).get("dirty", 1) == 0:
+            return True
         time.sleep(1)
+    logging.error("Кэш %s не сбросился за %s с", name, CACHE_FLUSH_TIMEOUT)
+    return False
 
-    if not Path(device_path).exists():
-        logging.error("Устройство не появилось: %s", device_path)
-        return
 
-    # Монтируем
-    Path(mount_point).mkdir(parents=True, exist_ok=True)
-    # Проверим, уже смонтировано ли
-    already = subprocess.run(["findmnt", "-n", "-o", "TARGET", "--target", device_path], capture_output=True, text=True)
-    if already.returncode == 0 and mount_point in already.stdout:
-        logging.info("Уже смонтировано: %s -> %s", device_path, mount_point)
+def remove_cache(name: str, backing_path: str):
+    for part in (name, f"{name}_meta", f"{name}_data"):
+        if dm_exists(part):
+            run_cmd(["dmsetup", "remove", part])
+    backing = Path(backing_path)
+    if not backing.is_block_device():
+        attached = subprocess.run(["losetup", "-j", str(backing)], capture_output=True, text=True)
+        for line in attached.stdout.splitlines():
+            run_cmd(["losetup", "-d", line.split(":", 1)[0]])
+
+
+def multipath_table(devices: List[str], selector: str) -> str:
+    """Таблица dm-multipath: одна группа путей со всеми сессиями цели."""
+    size = read_attr(Path("/sys/class/block") / devices[0] / "size")
+    path_args = PATH_SELECTORS[selector]
+    paths = " ".join(f"{block_dev_numbers(dev)} {' '.join(path_args)}" for dev in devices)
+    return (
+        f"0 {size} multipath 1 queue_if_no_path 0 1 1 "
+        f"{selector} 0 {len(devices)} {len(path_args)} {paths}"
+    )
+
+
+def multipath_health(name: str) -> Dict[str, str]:
+    """Состояние путей dm-multipath по `dmsetup status`: устройство -> active/failed."""
+    try:
+        result = subprocess.run(["dmsetup", "status", name], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    tokens = result.stdout.split()
+    health = {}
+    for i, token in enumerate(tokens[:-1]):
+        if re.fullmatch(r"\d+:\d+", token) and tokens[i + 1] in ("A", "F"):
+            health[block_dev_name(token)] = "active" if tokens[i + 1] == "A" else "failed"
+    return health
+
+
+def read_mountinfo() -> Dict[str, Tuple[str, set]]:
+    """Точки монтирования -> (источник, опции) по /proc/self/mountinfo (без fork findmnt).
+
+    Опции — объединение опций точки (noatime, relatime) и суперблока (discard, commit=30).
+    """
+    mounts = {}
+    try:
+        lines = MOUNTINFO.read_text().splitlines()
+    except OSError:
+        return mounts
+    for line in lines:
+        fields = line.split(" - ", 1)
+        if len(fields) != 2:
+            continue
+        left = fields[0].split()
+        right = fields[1].split()
+        mount_point = left[4].replace("\\040", " ")
+        options = set(left[5].split(","))
+        if len(right) > 2:
+            options.update(right[2].split(","))
+        mounts[mount_point] = (right[1] if len(right) > 1 else "", options)
+    return mounts
+
+
+def mounted_targets() -> Dict[str, str]:
+    """Точки монтирования -> источник."""
+    return {mount_point: source for mount_point, (source, _) in read_mountinfo().items()}
+
+
+def remount_options(current: set, desired: List[str]) -> List[str]:
+    """
+    Опции remount, приводящие смонтированную ФС к профилю.
+
+    Опция, которую профиль больше не задаёт, сама при remount не снимается —
+    вместо неё передаётся обратная (noatime -> relatime, discard -> nodiscard,
+    commit=N -> commit=0, то есть значение по умолчанию).
+
+    Returns:
+        Список опций; пустой, если перемонтировать не нужно.
+    """
+    changes = [option for option in desired if option not in current]
+    desired_keys = {option.split("=", 1)[0] for option in desired}
+    for option in sorted(current):
+        key = option.split("=", 1)[0]
+        if key in desired_keys:
+            continue
+        inverse = MOUNT_OPTION_INVERSE.get(key)
+        if inverse is not None and inverse not in current and inverse not in changes:
+            changes.append(inverse)
+    return changes
+
+
+class UeventMonitor(threading.Thread):
+    """Читает uevent ядра из NETLINK_KOBJECT_UEVENT и раздаёт их подписчикам."""
+
+    def __init__(self):
+        super().__init__(name="uevent", daemon=True)
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.sock = None
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, 1))
+        except (OSError, AttributeError) as e:
+            logging.warning("Netlink uevent недоступен (%s), готовность устройств проверяется по таймеру", e)
+            self.sock = None
+
+    @property
+    def available(self) -> bool:
+        return self.sock is not None
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    @staticmethod
+    def parse(data: bytes) -> dict:
+        parts = data.split(b"\0")
+        props = {}
+        for part in parts[1:]:
+            key, sep, value = part.partition(b"=")
+            if sep:
+                props[key.decode(errors="replace")] = value.decode(errors="replace")
+        return props
+
+    def run(self):
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(65536)
+            except OSError as e:
+                logging.error("Ошибка чтения uevent: %s", e)
+                time.sleep(1)
+                continue
+            props = self.parse(data)
+            if props.get("SUBSYSTEM") != "block":
+                continue
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for callback in subscribers:
+                callback(props)
+
+
+class BlockStatSampler:
+    """Читает /sys/block/<dev>/stat через постоянно открытые дескрипторы и считает скорости."""
+
+    def __init__(self):
+        self.fds: Dict[str, int] = {}
+        self.last: Dict[str, tuple] = {}
+
+    def _read(self, name: str):
+        fd = self.fds.get(name)
+        if fd is None:
+            try:
+                fd = os.open(SYS_BLOCK / name / "stat", os.O_RDONLY)
+            except OSError:
+                return None
+            self.fds[name] = fd
+        try:
+            fields = os.pread(fd, 4096, 0).split()
+        except OSError:
+            # Устройство исчезло — дескриптор переоткроем, когда оно вернётся
+            self.forget(name)
+            return None
+        if len(fields) < 11:
+            return None
+        return [int(x) for x in fields[:11]]
+
+    def forget(self, name: str):
+        fd = self.fds.pop(name, None)
+        if fd is not None:
+            os.close(fd)
+        self.last.pop(name, None)
+
+    def retain(self, names: Set[str]):
+        for name in set(self.fds) - names:
+            self.forget(name)
+
+    def sample(self, name: str, now: float):
+        fields = self._read(name)
+        if fields is None:
+            return None
+        previous = self.last.get(name)
+        self.last[name] = (now, fields)
+        if previous is None or now <= previous[0]:
+            return None
+        elapsed = now - previous[0]
+        delta = [cur - old for cur, old in zip(fields, previous[1])]
+        if any(value < 0 for value in delta):
+            # Счётчики сброшены (устройство пересоздано под тем же именем): новый отсчёт
+            return None
+        # Поля stat: 0 read_ios, 2 read_sectors, 3 read_ticks, 4 write_ios, 6 write_sectors,
+        # 7 write_ticks, 9 io_ticks (мс)
+        read_ios, write_ios = delta[0], delta[4]
+        return {
+            "read_iops": read_ios / elapsed,
+            "write_iops": write_ios / elapsed,
+            "read_bps": delta[2] * SECTOR_SIZE / elapsed,
+            "write_bps": delta[6] * SECTOR_SIZE / elapsed,
+            "read_await_ms": delta[3] / read_ios if read_ios else 0.0,
+            "write_await_ms": delta[7] / write_ios if write_ios else 0.0,
+            "util": min(delta[9] / (elapsed * 10.0), 100.0),
+        }
+
+
+def exceeds_deadband(old: dict, new: dict, deadband: float) -> bool:
+    if set(old) != set(new):
+        return True
+    for key, value in new.items():
+        previous = old[key]
+        if abs(value - previous) > deadband * max(abs(previous), 1.0):
+            return True
+    return False
+
+
+@dataclass(frozen=True)
+class BlockProfile:
+    """Параметры монтирования, очереди блочного устройства и iSCSI-сессии для LUN."""
+    fs_type: str = None
+    noatime: bool = False
+    commit_interval: int = None
+    discard: str = None
+    read_ahead_kb: int = None
+    io_scheduler: str = None
+    nr_requests: int = None
+    queue_depth: int = None
+    max_recv_data_segment_length: int = None
+    first_burst_length: int = None
+    immediate_data: bool = None
+
+    def mount_options(self) -> List[str]:
+        options = []
+        if self.noatime:
+            options.append("noatime")
+        if self.commit_interval is not None and self.fs_type in (None, "ext3", "ext4"):
+            options.append(f"commit={self.commit_interval}")
+        if self.discard == "online":
+            options.append("discard")
+        elif self.discard == "off":
+            options.append("nodiscard")
+        return options
+
+    def session_params(self) -> Dict[str, str]:
+        # Имена параметров записи узла iscsiadm (node.*)
+        params = {}
+        if self.queue_depth is not None:
+            params["node.session.queue_depth"] = str(self.queue_depth)
+        if self.max_recv_data_segment_length is not None:
+            params["node.conn[0].iscsi.MaxRecvDataSegmentLength"] = str(self.max_recv_data_segment_length)
+        if self.first_burst_length is not None:
+            params["node.session.iscsi.FirstBurstLength"] = str(self.first_burst_length)
+        if self.immediate_data is not None:
+            params["node.session.iscsi.ImmediateData"] = "Yes" if self.immediate_data else "No"
+        return params
+
+
+def write_sysfs(path: Path, value: str) -> bool:
+    """Пишет значение в атрибут sysfs, только если оно отличается от текущего."""
+    current = read_attr(path)
+    # scheduler читается как "mq-deadline [none]" — активный в скобках
+    match = re.search(r"\[(\S+)\]", current)
+    if (match.group(1) if match else current) == value:
+        return True
+    try:
+        path.write_text(value)
+        return True
+    except OSError as e:
+        logging.error("Не удалось записать %s в %s: %s", value, path, e)
+        return False
+
+
+def apply_queue_profile(name: str, profile: BlockProfile, top: bool):
+    """Настраивает очередь блочного устройства; top — устройство, которое монтируется поверх путей."""
+    block = Path("/sys/class/block") / name
+    if profile.read_ahead_kb is not None:
+        write_sysfs(block / "queue" / "read_ahead_kb", str(profile.read_ahead_kb))
+    if top:
         return
+    # Планировщик и глубина очереди имеют смысл на путях (sdX), а не на dm поверх них
+    if profile.io_scheduler:
+        write_sysfs(block / "queue" / "scheduler", profile.io_scheduler)
+    if profile.nr_requests is not None:
+        write_sysfs(block / "queue" / "nr_requests", str(profile.nr_requests))
+    if profile.queue_depth is not None:
+        write_sysfs(block / "device" / "queue_depth", str(profile.queue_depth))
+
+
+@dataclass(frozen=True)
+class StorageSpec:
+    portals: tuple
+    sessions_per_portal: int
+    lun: int
+    mount_point: str
+    path_selector: str
+    profile: BlockProfile = BlockProfile()
+    cache_device: str = None
+    cache_mode: str = None
+    cache_size_mb: int = None
+
+    @property
+    def multipath(self) -> bool:
+        return len(self.portals) * self.sessions_per_portal > 1
+
+    @property
+    def cache_layout(self):
+        # Всё, от чего зависит таблица dm кэша; смена требует отключения старого кэша
+        return (self.cache_device, self.cache_mode, self.cache_size_mb, self.multipath)
+
+
+class TargetMachine:
+    """Конечный автомат одной цели: discover -> login -> device-ready -> mounted (-> degraded)."""
+
+    def __init__(self, target: str, spec: StorageSpec, uevents: UeventMonitor):
+        self.target = target
+        self.spec = spec
+        self.uevents = uevents
+        self.state = STATE_DISCOVER
+        self.sessions: Dict[str, List[Path]] = {}
+        self.paths: List[str] = []
+        self.device = None
+        self.running = False
+        self.degraded_at = 0.0
+        self.changed = threading.Condition()
+        # Предыдущий автомат с другим кэшем: его надо отключить до сборки нового
+        self.replaces = None
+        # run() и detach() не выполняются одновременно; stop() прерывает run() между шагами
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    @property
+    def mount_point(self) -> str:
+        return self.spec.mount_point
+
+    @property
+    def dm_name(self) -> str:
+        return multipath_name(self.target, self.spec.lun)
+
+    @property
+    def cache_name(self) -> str:
+        return "cache_" + self.dm_name[len("mpath_"):]
+
+    def on_uevent(self, props: dict):
+        if props.get("ACTION") in ("add", "change", "remove"):
+            with self.changed:
+                self.changed.notify_all()
+
+    def stop(self):
+        """Просит работающий автомат остановиться после текущего шага (цель удалена)."""
+        self.stopped.set()
+        with self.changed:
+            self.changed.notify_all()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logging.info("Storage %s: %s -> %s", self.target, self.state, state)
+            self.state = state
+            if state == STATE_DEGRADED:
+                self.degraded_at = time.monotonic()
+
+    def _node_known(self, portal: str) -> bool:
+        # Записи узла iscsiadm называются «адрес,порт,tpgt» — порт есть всегда
+        return any((ISCSI_NODES / self.target).glob(f"{portal_address(portal)},{portal_port(portal)},*"))
+
+    def _refresh_sessions(self):
+        self.sessions = {portal: find_sessions(self.target, portal) for portal in self.spec.portals}
+
+    def _apply_session_params(self, portal: str):
+        # Параметры записи узла действуют на следующие логины; queue_depth живых путей
+        # дополнительно меняется через sysfs в apply_queue_profile
+        for name, value in self.spec.profile.session_params().items():
+            run_cmd(["iscsiadm", "-m", "node", "-T", self.target, "-p", portal, "-o", "update", "-n", name, "-v", value])
+
+    def _discover(self):
+        self._refresh_sessions()
+        if all(len(s) >= self.spec.sessions_per_portal for s in self.sessions.values()):
+            logging.info("Storage %s: все сессии уже установлены, логин не нужен", self.target)
+            for portal in self.spec.portals:
+                self._apply_session_params(portal)
+            self._set_state(STATE_DEVICE_READY)
+            return
+        for portal, sessions in self.sessions.items():
+            if sessions or self._node_known(portal):
+                continue
+            run_cmd(["iscsiadm", "-m", "discovery", "-t", "sendtargets", "-p", portal])
+        self._set_state(STATE_LOGIN)
+
+    def _login(self):
+        for portal in self.spec.portals:
+            self._apply_session_params(portal)
+            if not self.sessions.get(portal):
+                run_cmd(["iscsiadm", "-m", "node", "-T", self.target, "-p", portal, "--login"])
+                self.sessions[portal] = find_sessions(self.target, portal)
+            sessions = self.sessions[portal]
+            # Дополнительные сессии к тому же порталу для агрегации пропускной способности
+            for _ in range(self.spec.sessions_per_portal - len(sessions)):
+                if not sessions:
+                    break
+                sid = sessions[0].name[len("session"):]
+                run_cmd(["iscsiadm", "-m", "session", "-r", sid, "--op", "new"])
+        self._refresh_sessions()
+        if not any(self.sessions.values()):
+            self._set_state(STATE_DEGRADED)
+            return
+        self._set_state(STATE_DEVICE_READY)
+
+    def _resolve_paths(self) -> List[str]:
+        self._refresh_sessions()
+        paths = []
+        for sessions in self.sessions.values():
+            for session in sessions:
+                name = session_block_device(session, self.spec.lun)
+                if name and (DEV_DIR / name).exists():
+                    paths.append(name)
+        return paths
+
+    def _wait_device(self):
+        # Без опроса в цикле: просыпаемся на uevent блочного устройства или по таймауту
+        expected = sum(len(s) for s in self.sessions.values())
+        deadline = time.monotonic() + DEVICE_TIMEOUT
+        step = DEVICE_TIMEOUT if self.uevents.available else 0.5
+        self.uevents.subscribe(self.on_uevent)
+        try:
+            with self.changed:
+                while True:
+                    self.paths = self._resolve_paths()
+                    if self.stopped.is_set() or (self.paths and len(self.paths) >= expected):
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.changed.wait(min(remaining, step))
+        finally:
+            self.uevents.unsubscribe(self.on_uevent)
+
+        if self.stopped.is_set():
+            return
+        if not self.paths:
+            logging.error("Storage %s: устройство LUN %s не появилось", self.target, self.spec.lun)
+            self._set_state(STATE_DEGRADED)
+            return
+        if len(self.paths) < expected:
+            logging.warning("Storage %s: готово %s из %s путей", self.target, len(self.paths), expected)
+
+        if self.spec.multipath:
+            self.device = self._assemble_multipath()
+        else:
+            self.device = f"/dev/{self.paths[0]}"
+        if self.device and self.spec.cache_device:
+            try:
+                self.device = setup_cache(
+                    self.cache_name, self.device, self.spec.cache_device, self.spec.cache_mode, self.spec.cache_size_mb
+                )
+                logging.info("Storage %s: локальный кэш %s (%s) на %s", self.target, self.cache_name,
+                             self.spec.cache_mode, self.spec.cache_device)
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                logging.error("Storage %s: не удалось собрать кэш: %s", self.target, e)
+                self.device = None
+        if not self.device:
+            self._set_state(STATE_DEGRADED)
+            return
+        for name in self.paths:
+            apply_queue_profile(name, self.spec.profile, top=False)
+        if self.spec.multipath or self.spec.cache_device:
+            apply_queue_profile(Path(self.device).resolve().name, self.spec.profile, top=True)
+        self._mount()
+        if self.state == STATE_MOUNTED and len(self.paths) < expected:
+            # Данные доступны, но без полной избыточности: повтор через RETRY_INTERVAL
+            # довходит в недостающие порталы и пересобирает таблицу multipath
+            logging.warning("Storage %s: смонтировано по %s из %s путей", self.target, len(self.paths), expected)
+            self._set_state(STATE_DEGRADED)
+
+    def _assemble_multipath(self):
+        name = self.dm_name
+        table = multipath_table(self.paths, self.spec.path_selector)
+        device = f"/dev/mapper/{name}"
+        current = subprocess.run(["dmsetup", "table", name], capture_output=True, text=True)
+        if current.returncode == 0:
+            if current.stdout.strip() == table:
+                return device
+            # Набор путей изменился — подменяем таблицу без размонтирования
+            ok = run_cmd(["dmsetup", "reload", name, "--table", table]) and run_cmd(["dmsetup", "resume", name])
+        else:
+            ok = run_cmd(["dmsetup", "create", name, "--table", table])
+        if not ok:
+            return None
+        # Без udev узел в /dev/mapper создаёт сам dmsetup
+        run_cmd(["dmsetup", "mknodes", name])
+        logging.info("Storage %s: dm-multipath %s (%s) из путей %s", self.target, name, self.spec.path_selector, self.paths)
+        return device
+
+    def _mount(self):
+        options = self.spec.profile.mount_options()
+        mounts = read_mountinfo()
+        if self.mount_point in mounts:
+            logging.info("Уже смонтировано: %s -> %s", self.device, self.mount_point)
+            # Профиль мог измениться: разница с текущими опциями применяется перемонтированием на месте
+            changes = remount_options(mounts[self.mount_point][1], options)
+            if changes:
+                run_cmd(["mount", "-o", ",".join(["remount"] + changes), self.mount_point])
+            self._set_state(STATE_MOUNTED)
+            return
+        Path(self.mount_point).mkdir(parents=True, exist_ok=True)
+        cmd = ["mount"]
+        if self.spec.profile.fs_type:
+            cmd += ["-t", self.spec.profile.fs_type]
+        if options:
+            cmd += ["-o", ",".join(options)]
+        if run_cmd(cmd + [self.device, self.mount_point]):
+            logging.info("Смонтировано: %s -> %s", self.device, self.mount_point)
+            self._set_state(STATE_MOUNTED)
+        else:
+            self._set_state(STATE_DEGRADED)
+
+    def detach(self, logout: bool) -> bool:
+        """
+        Отключает LUN в безопасном порядке: umount -> сброс кэша -> dm-устройства -> logout.
+
+        Ждёт завершения run(): иначе logout мог бы пройти посреди логина или монтирования.
+        """
+        with self.lock:
+            return self._detach(logout)
+
+    def _detach(self, logout: bool) -> bool:
+        if self.mount_point in mounted_targets():
+            if not run_cmd(["umount", self.mount_point]):
+                logging.error("Storage %s: %s занят, отключение отложено", self.target, self.mount_point)
+                return False
+        if self.spec.cache_device and dm_exists(self.cache_name):
+            if not flush_cache(self.cache_name, self.spec.cache_mode):
+                logging.error("Storage %s: кэш не сброшен, оставляем его подключённым", self.target)
+                return False
+            remove_cache(self.cache_name, self.spec.cache_device)
+            logging.info("Storage %s: кэш %s сброшен и отключён", self.target, self.cache_name)
+        self.device = None
+        if logout:
+            if self.spec.multipath and dm_exists(self.dm_name):
+                run_cmd(["dmsetup", "remove", self.dm_name])
+            for portal in self.spec.portals:
+                run_cmd(["iscsiadm", "-m", "node", "-T", self.target, "-p", portal, "--logout"])
+        return True
+
+    def run(self):
+        try:
+            with self.lock:
+                self._run()
+        finally:
+            self.running = False
+
+    def _run(self):
+        try:
+            previous, self.replaces = self.replaces, None
+            if previous is not None and not previous.detach(logout=False):
+                self._set_state(STATE_DEGRADED)
+                return
+            if self.state in (STATE_MOUNTED, STATE_DEGRADED):
+                self._set_state(STATE_DISCOVER)
+            while self.state not in (STATE_MOUNTED, STATE_DEGRADED):
+                if self.stopped.is_set():
+                    logging.info("Storage %s: автомат остановлен в состоянии %s", self.target, self.state)
+                    return
+                if self.state == STATE_DISCOVER:
+                    self._discover()
+                elif self.state == STATE_LOGIN:
+                    self._login()
+                elif self.state == STATE_DEVICE_READY:
+                    self._wait_device()
+        except Exception as e:
+            logging.error("Storage %s: ошибка автомата: %s", self.target, e)
+            self._set_state(STATE_DEGRADED)
+
+    def still_mounted(self) -> bool:
+        return bool(self.device) and Path(self.device).exists() and self.mount_point in mounted_targets()
+
+    def path_health(self) -> Dict[str, str]:
+        if self.spec.multipath:
+            health = multipath_health(self.dm_name)
+        else:
+            health = {}
+        for name in self.paths:
+            health.setdefault(name, "active" if Path("/sys/class/block", name).exists() else "failed")
+        return health
+
+
+class StorageManager:
+    def __init__(self, idl, debouncer: ChangeDebouncer = None):
+        self.idl = idl
+        # Счётчики проходов для AgentStats пишутся в транзакции publish()
+        self.debouncer = debouncer
+        self.uevents = UeventMonitor()
+        self.uevents.subscribe(self.on_uevent)
+        self.uevents.start()
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="iscsi")
+        self.machines: Dict[str, TargetMachine] = {}
+        self.desired: Dict[str, StorageSpec] = {}
+        self.lost = threading.Event()
+        self.sampler = BlockStatSampler()
+        self.stats_at = 0.0
+
+    def on_uevent(self, props: dict):
+        # Пропажа блочного устройства может означать обрыв сессии или пути
+        if props.get("ACTION") == "remove":
+            self.lost.set()
+
+    def _submit(self, machine: TargetMachine):
+        if machine.running:
+            return
+        machine.running = True
+        self.executor.submit(machine.run)
+
+    @staticmethod
+    def row_spec(row):
+        target = getattr(row, "target_iqn", None)
+        portals = list(getattr(row, "portals", None) or [])
+        portal_ip = optional_value(getattr(row, "portal_ip", None))
+        if portal_ip and portal_ip not in portals:
+            portals.insert(0, portal_ip)
+        if not target or not portals:
+            logging.error("Строка Storage не содержит target_iqn или порталов (portal_ip/portals)")
+            return None
+        selector = optional_value(getattr(row, "path_selector", None), DEFAULT_PATH_SELECTOR)
+        if selector not in PATH_SELECTORS:
+            logging.error("Storage %s: неизвестный path_selector %s", target, selector)
+            selector = DEFAULT_PATH_SELECTOR
+        profile = BlockProfile(
+            fs_type=optional_value(getattr(row, "fs_type", None)),
+            noatime=optional_value(getattr(row, "noatime", None), False),
+            commit_interval=optional_value(getattr(row, "commit_interval", None)),
+            discard=optional_value(getattr(row, "discard", None)),
+            read_ahead_kb=optional_value(getattr(row, "read_ahead_kb", None)),
+            io_scheduler=optional_value(getattr(row, "io_scheduler", None)),
+            nr_requests=optional_value(getattr(row, "nr_requests", None)),
+            queue_depth=optional_value(getattr(row, "queue_depth", None)),
+            max_recv_data_segment_length=optional_value(getattr(row, "max_recv_data_segment_length", None)),
+            first_burst_length=optional_value(getattr(row, "first_burst_length", None)),
+            immediate_data=optional_value(getattr(row, "immediate_data", None)),
+        )
+        cache_mode = optional_value(getattr(row, "cache_mode", None), "writethrough")
+        if cache_mode not in CACHE_MODES:
+            logging.error("Storage %s: неизвестный cache_mode %s", target, cache_mode)
+            cache_mode = "writethrough"
+        return StorageSpec(
+            portals=tuple(portals),
+            sessions_per_portal=max(optional_value(getattr(row, "sessions_per_portal", None), 1), 1),
+            lun=optional_value(getattr(row, "lun", None), 0),
+            mount_point=optional_value(getattr(row, "mount_point", None)) or f"/mnt/{target.replace(':', '_')}",
+            path_selector=selector,
+            profile=profile,
+            cache_device=optional_value(getattr(row, "cache_device", None)),
+            cache_mode=cache_mode,
+            cache_size_mb=optional_value(getattr(row, "cache_size_mb", None)),
+        )
+
+    def sync(self, table):
+        desired = {}
+        for row in table.rows.values():
+            spec = self.row_spec(row)
+            if spec is not None:
+                desired[row.target_iqn] = spec
+
+        for target in list(self.machines):
+            if target not in desired:
+                machine = self.machines.pop(target)
+                logging.info("Storage %s удалён из Sysdb, отключаем", target)
+                # detach() дождётся, пока автомат остановится после текущего шага
+                machine.stop()
+                self.executor.submit(machine.detach, True)
+        self.desired = desired
+        self.tick()
+
+    def tick(self):
+        lost = self.lost.is_set()
+        self.lost.clear()
+        now = time.monotonic()
+        for target, spec in self.desired.items():
+            machine = self.machines.get(target)
+            if machine is not None and (machine.spec == spec or machine.running):
+                # Автомат, работающий со старыми параметрами, заменим после его завершения
+                continue
+            previous = machine
+            machine = TargetMachine(target, spec, self.uevents)
+            if previous is not None and previous.spec.cache_device and previous.spec.cache_layout != spec.cache_layout:
+                machine.replaces = previous
+            self.machines[target] = machine
+            self._submit(machine)
+
+        for machine in self.machines.values():
+            if machine.running:
+                continue
+            if machine.state == STATE_DEGRADED and now - machine.degraded_at >= RETRY_INTERVAL:
+                self._submit(machine)
+            elif machine.state == STATE_MOUNTED and lost and not machine.still_mounted():
+                logging.warning("Storage %s: устройство пропало", machine.target)
+                machine._set_state(STATE_DEGRADED)
+                self._submit(machine)
+            elif machine.state == STATE_MOUNTED and lost and machine.spec.multipath:
+                # Путь мог вернуться новой сессией — перечитываем sysfs и пересобираем таблицу
+                self._submit(machine)
+        self.publish()
+
+    def collect_stats(self, machine: TargetMachine, now: float):
+        top = Path(machine.device).resolve().name
+        names = [top] + [p for p in machine.paths if p != top]
+        stats = {}
+        for name in names:
+            sample = self.sampler.sample(name, now)
+            if sample is None:
+                continue
+            # Метрики путей multipath — с префиксом имени устройства
+            prefix = "" if name == top else f"{name}/"
+            stats.update({prefix + key: round(value, 2) for key, value in sample.items()})
+        return names, stats
 
-    run_cmd(["mount", device_path, mount_point])
-    logging.info("Смонтировано: %s -> %s", device_path, mount_point)
+    def publish(self):
+        """Пишет состояние путей, I/O-телеметрию всех строк Storage и AgentStats одной транзакцией."""
+        if "Storage" not in self.idl.tables:
+            return
+        now = time.monotonic()
+        stats_due = now - self.stats_at >= STATS_INTERVAL
+        if stats_due:
+            self.stats_at = now
+        sampled = set()
+        txn = None
+        for target, machine in self.machines.items():
+            row = self.idl.lookup("Storage", "target_iqn", target)
+            if row is None or machine.running:
+                continue
+            updates = {}
+            health = machine.path_health()
+            if dict(getattr(row, "path_status", None) or {}) != health:
+                updates["path_status"] = health
+            # degraded с устройством — смонтировано не по всем путям, телеметрия нужна и тут
+            if stats_due and machine.state in (STATE_MOUNTED, STATE_DEGRADED) and machine.device:
+                names, stats = self.collect_stats(machine, now)
+                sampled.update(names)
+                current = dict(getattr(row, "io_stats", None) or {})
+                if stats and exceeds_deadband(current, stats, STATS_DEADBAND):
+                    updates["io_stats"] = stats
+                if machine.spec.cache_device:
+                    counters = cache_stats(machine.cache_name, machine.spec.cache_mode)
+                    if counters and dict(getattr(row, "cache_stats", None) or {}) != counters:
+                        updates["cache_stats"] = counters
+            if not updates:
+                continue
+            if txn is None:
+                txn = ovs.db.idl.Transaction(self.idl)
+            for column, value in updates.items():
+                setattr(row, column, value)
+        if stats_due:
+            self.sampler.retain(sampled)
+        if self.debouncer is not None:
+            txn = agent_stats_txn(self.idl, "storage_agent", self.debouncer, txn, now)
+        if txn is not None:
+            status = txn.commit_block()
+            logging.debug("Записано состояние Storage, статус транзакции: %s", status)
 
 
 def main():
@@ -72,24 +1086,32 @@ def main():
 
     helper = ovs.db.idl.SchemaHelper(location=SCHEMA)
     helper.register_all()
-    idl = ovs.db.idl.Idl(REMOTE, helper)
+    idl = SysdbIdl(REMOTE, helper, ignore_columns=STATUS_COLUMNS)
 
     poller = ovs.poller.Poller()
+    debouncer = ChangeDebouncer(("Storage",))
+    manager = StorageManager(idl, debouncer)
+    next_tick = 0.0
     logging.info("storage_agent запущен...")
 
     while True:
-        seqno = idl.change_seqno
         idl.run()
-        if idl.change_seqno != seqno:
+        debouncer.add(idl.take_changes())
+        synced = bool(debouncer.take_ready())
+        if synced:
             storage_table = idl.tables.get("Storage")
             if storage_table:
-                for row in storage_table.rows.values():
-                    ensure_session(row)
+                manager.sync(storage_table)
+        # IDL будит цикл и на чужие таблицы (Telemetry раз в секунду): периодическая
+        # работа — не чаще POLL_INTERVAL, если не было прохода согласования
+        now = time.monotonic()
+        if synced or now >= next_tick:
+            manager.tick()
+            next_tick = now + POLL_INTERVAL
 
         idl.wait(poller)
-        poller.timer_wait(POLL_INTERVAL * 1000)
+        poller.timer_wait(int(max(0.0, min(next_tick - now, debouncer.timeout())) * 1000))
         poller.block()
-        time.sleep(POLL_INTERVAL)
 
 
 if __name__ == "__main__":
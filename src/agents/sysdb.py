@@ -0,0 +1,233 @@
+"""Общие помощники агентов и CLI для работы с Sysdb (OVSDB).
+
+Модуль устанавливается в образ рядом с агентами (/usr/local/sbin/sysdb.py).
+"""
+import logging
+import os
+import time
+from typing import Dict, List
+
+import ovs.db.idl
+
+# Пачка изменений применяется, когда БД затихла на DEBOUNCE_QUIET секунд,
+# но не позже DEBOUNCE_MAX_DELAY от первого изменения пачки
+DEBOUNCE_QUIET = float(os.environ.get("SYSDB_DEBOUNCE_QUIET", "0.2"))
+DEBOUNCE_MAX_DELAY = float(os.environ.get("SYSDB_DEBOUNCE_MAX_DELAY", "2.0"))
+# AgentStats пишется не чаще раза в AGENT_STATS_INTERVAL секунд
+AGENT_STATS_INTERVAL = float(os.environ.get("SYSDB_AGENT_STATS_INTERVAL", "10"))
+
+
+def schema_indexes(tables) -> Dict[str, List[str]]:
+    """Одноколоночные индексы схемы: таблица -> список колонок."""
+    indexes = {}
+    for name, table in tables.items():
+        for index in getattr(table, "indexes", None) or []:
+            if len(index) == 1:
+                indexes.setdefault(name, []).append(index[0].name)
+    return indexes
+
+
+class SysdbIdl(ovs.db.idl.Idl):
+    """Idl с хеш-индексами по индексам схемы (name, target_iqn и т.п.).
+
+    Индексы обновляются инкрементально из уведомлений IDL, поэтому поиск строки
+    по ключу — O(1) вместо перебора tbl.rows.
+
+    Кроме того, IDL помнит содержимое строк и копит реально изменившиеся строки
+    (take_changes). change_seqno сдвигается и при переподключении: после
+    monitor_cond_since без пропущенных транзакций или после полного снимка
+    перезапущенного ovsdb-server. Сравнение с запомненным содержимым превращает такую
+    пересинхронизацию в «нет изменений», и агенты не переприменяют все строки.
+
+    ignore_columns (таблица -> колонки) — колонки, которые пишет сам агент
+    (состояние и телеметрия Storage): их изменение не считается изменением строки,
+    иначе каждая собственная запись агента запускала бы новый проход согласования.
+    """
+
+    def __init__(self, remote, schema_helper, ignore_columns: Dict[str, set] = None, **kwargs):
+        super().__init__(remote, schema_helper, **kwargs)
+        self.ignore_columns = {table: set(columns) for table, columns in (ignore_columns or {}).items()}
+        self.row_indexes: Dict[str, Dict[str, dict]] = {
+            table: {column: {} for column in columns}
+            for table, columns in schema_indexes(self.tables).items()
+        }
+        # uuid -> колонки строки (Datum не меняются на месте, хватает копии словаря)
+        self.row_data: Dict[str, dict] = {table: {} for table in self.tables}
+        self.changes: Dict[str, set] = {}
+
+    def notify(self, event, row, updates=None):
+        super().notify(event, row, updates)
+        self._track_change(event, row)
+        indexes = self.row_indexes.get(row._table.name)
+        if not indexes:
+            return
+        for column, index in indexes.items():
+            if event == ovs.db.idl.ROW_DELETE:
+                key = getattr(row, column, None)
+                if index.get(key) is row:
+                    del index[key]
+                continue
+            if event == ovs.db.idl.ROW_UPDATE and updates is not None and column in updates._data:
+                old_key = getattr(updates, column, None)
+                if index.get(old_key) is not None and index[old_key].uuid == row.uuid:
+                    del index[old_key]
+            index[getattr(row, column)] = row
+
+    def run(self):
+        seqno = self.change_seqno
+        pending = sum(len(rows) for rows in self.changes.values())
+        changed = super().run()
+        self._check_indexes()
+        self._check_rows()
+        if self.change_seqno != seqno and sum(len(rows) for rows in self.changes.values()) == pending:
+            logging.debug("Пересинхронизация с %s без изменений", self.session_name())
+        return changed
+
+    def take_changes(self) -> Dict[str, set]:
+        """Изменившиеся с прошлого вызова строки: таблица -> множество uuid."""
+        changes, self.changes = self.changes, {}
+        return changes
+
+    def _track_change(self, event, row):
+        table = row._table.name
+        known = self.row_data.setdefault(table, {})
+        if event == ovs.db.idl.ROW_DELETE:
+            if known.pop(row.uuid, None) is None:
+                return
+        else:
+            ignored = self.ignore_columns.get(table, ())
+            data = {column: value for column, value in row._data.items() if column not in ignored}
+            if known.get(row.uuid) == data:
+                return
+            known[row.uuid] = data
+        self.changes.setdefault(table, set()).add(row.uuid)
+
+    def _check_rows(self):
+        # Полный снимок приходит после очистки tbl.rows без уведомлений об удалении:
+        # строки, которых в новом снимке нет, остаются только в row_data
+        for table, known in self.row_data.items():
+            rows = self.tables[table].rows
+            if len(known) == len(rows):
+                continue
+            for uuid in [uuid for uuid in known if uuid not in rows]:
+                del known[uuid]
+                self.changes.setdefault(table, set()).add(uuid)
+
+    def _check_indexes(self):
+        # Полная перезагрузка реплики очищает tbl.rows без уведомлений об удалении —
+        # тогда размеры расходятся и индекс таблицы перестраивается целиком
+        for table, indexes in self.row_indexes.items():
+            rows = self.tables[table].rows
+            for column, index in indexes.items():
+                if len(index) != len(rows):
+                    index.clear()
+                    for row in rows.values():
+                        index[getattr(row, column)] = row
+
+    def lookup(self, table: str, column: str, value):
+        """Строка table с column == value или None."""
+        index = self.row_indexes.get(table, {}).get(column)
+        if index is None:
+            for row in self.tables[table].rows.values():
+                if getattr(row, column, None) == value:
+                    return row
+            return None
+        row = index.get(value)
+        if row is not None and self.tables[table].rows.get(row.uuid) is not row:
+            return None
+        return row
+
+
+class ChangeDebouncer:
+    """Склеивает изменения из take_changes() в один проход согласования.
+
+    apply или серия set дают много транзакций подряд; без склейки каждая запускает
+    полный проход агента. Изменения таблиц tables копятся, пока не наступит тишина
+    quiet секунд или не истечёт max_delay с первого изменения пачки.
+    """
+
+    def __init__(self, tables, quiet: float = DEBOUNCE_QUIET, max_delay: float = DEBOUNCE_MAX_DELAY):
+        self.tables = set(tables)
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.pending: Dict[str, set] = {}
+        self.first_at = 0.0
+        self.last_at = 0.0
+        self.batches = 0
+        # Счётчики для AgentStats
+        self.passes = 0
+        self.saved_passes = 0
+        self.rows = 0
+        self.published_at = float("-inf")
+
+    def add(self, changes: Dict[str, set], now: float = None):
+        changes = {table: uuids for table, uuids in changes.items() if table in self.tables}
+        if not changes:
+            return
+        now = time.monotonic() if now is None else now
+        if not self.pending:
+            self.first_at = now
+        self.last_at = now
+        self.batches += 1
+        for table, uuids in changes.items():
+            self.pending.setdefault(table, set()).update(uuids)
+
+    def timeout(self, now: float = None) -> float:
+        """Секунд до готовности пачки (inf, если ждать нечего)."""
+        if not self.pending:
+            return float("inf")
+        now = time.monotonic() if now is None else now
+        deadline = min(self.last_at + self.quiet, self.first_at + self.max_delay)
+        return max(0.0, deadline - now)
+
+    def take_ready(self, now: float = None) -> Dict[str, set]:
+        """Накопленные изменения, если пачка готова, иначе {}."""
+        if not self.pending or self.timeout(now) > 0:
+            return {}
+        changes, self.pending = self.pending, {}
+        self.passes += 1
+        self.saved_passes += self.batches - 1
+        self.rows += sum(len(uuids) for uuids in changes.values())
+        if self.batches > 1:
+            logging.debug("Склеено %d пачек изменений в один проход", self.batches)
+        self.batches = 0
+        return changes
+
+
+def agent_stats_txn(idl: SysdbIdl, agent: str, debouncer: ChangeDebouncer, txn=None, now: float = None):
+    """
+    Добавляет счётчики проходов агента в AgentStats (строка на агента) к транзакции txn.
+
+    Счётчики пишутся, только если изменились и с прошлой записи прошло
+    AGENT_STATS_INTERVAL: так статистика не удваивает число транзакций агента.
+
+    Returns:
+        txn (новая, если txn=None и есть что записать) или None, если писать нечего.
+    """
+    table = idl.tables.get("AgentStats")
+    if table is None:
+        return txn
+    now = time.monotonic() if now is None else now
+    if now - debouncer.published_at < AGENT_STATS_INTERVAL:
+        return txn
+    counters = (debouncer.passes, debouncer.saved_passes, debouncer.rows)
+    row = idl.lookup("AgentStats", "agent", agent)
+    if row is not None and (row.passes, row.saved_passes, row.rows) == counters:
+        return txn
+    if txn is None:
+        txn = ovs.db.idl.Transaction(idl)
+    if row is None:
+        row = txn.insert(table)
+        row.agent = agent
+    row.passes, row.saved_passes, row.rows = counters
+    debouncer.published_at = now
+    return txn
+
+
+def publish_agent_stats(idl: SysdbIdl, agent: str, debouncer: ChangeDebouncer):
+    """Пишет AgentStats отдельной транзакцией (агентам, у которых нет своей записи в БД)."""
+    txn = agent_stats_txn(idl, agent, debouncer)
+    if txn is None:
+        return
+    status = txn.commit_block()
+    logging.debug("Записана AgentStats %s, статус транзакции: %s", agent, status)
@@ -1,25 +1,140 @@
 #!/usr/bin/env python3
+import json
 import logging
 import os
 import signal
+import socket
 import subprocess
 import sys
-import time
 from pathlib import Path
+from typing import Dict, List, Set
 
 import ovs.db.idl
 import ovs.poller
 
+from sysdb import ChangeDebouncer, SysdbIdl, publish_agent_stats
+
 SCHEMA = "/etc/openvswitch/system.ovsschema"
 REMOTE = "unix:/var/run/openvswitch/db.sock"
 POLL_INTERVAL = 2.0
 QEMU_CMD = os.environ.get("QEMU_BIN", "qemu-system-aarch64")
 CGROUP_VM = Path("/sys/fs/cgroup/vm.slice/cgroup.procs")
+QMP_DIR = Path("/var/run/litainer/qmp")
+QMP_TIMEOUT = 2.0
+CPU_ONLINE = Path("/sys/devices/system/cpu/online")
+# Ядра под ovsdb-server, агентов и прерывания: vCPU на них не попадают
+HOUSEKEEPING_CPUS = os.environ.get("VM_HOUSEKEEPING_CPUS", "0")
+# pack — плотная упаковка по ядрам, spread — равномерное распределение
+PLACEMENT_POLICY = os.environ.get("VM_PLACEMENT_POLICY", "pack")
+# Сколько vCPU можно положить на одно ядро в режиме pack до перехода к переподписке
+VCPUS_PER_CORE = int(os.environ.get("VM_VCPUS_PER_CORE", "1"))
+
+
+def parse_cpu_list(text: str) -> Set[int]:
+    # Формат ядра: "0-3,5,7-8"
+    cpus = set()
+    for part in text.strip().split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def optional_value(value, default):
+    # Необязательные колонки (min 0, max 1) IDL отдаёт списком из 0 или 1 элемента
+    if isinstance(value, list):
+        return value[0] if value else default
+    return default if value is None else value
+
+
+def online_cpus() -> Set[int]:
+    try:
+        return parse_cpu_list(CPU_ONLINE.read_text())
+    except (OSError, ValueError):
+        return set(range(os.cpu_count() or 1))
+
+
+class QMPClient:
+    def __init__(self, path: Path, timeout: float = QMP_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+
+    def _recv(self, reader):
+        # Пропускаем асинхронные события, ждём ответ на команду
+        while True:
+            line = reader.readline()
+            if not line:
+                raise ConnectionError(f"QMP {self.path} закрыл соединение")
+            msg = json.loads(line)
+            if "return" in msg:
+                return msg["return"]
+            if "error" in msg:
+                raise RuntimeError(msg["error"].get("desc", str(msg["error"])))
+
+    def execute(self, *commands: str) -> list:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(str(self.path))
+            reader = sock.makefile("r")
+            greeting = json.loads(reader.readline() or "{}")
+            if "QMP" not in greeting:
+                raise ConnectionError(f"Неожиданное приветствие QMP: {greeting}")
+            results = []
+            for command in ("qmp_capabilities",) + commands:
+                sock.sendall(json.dumps({"execute": command}).encode() + b"\n")
+                results.append(self._recv(reader))
+            return results[1:]
+
+
+class CpuPlacer:
+    def __init__(self, host_cpus: Set[int], housekeeping: Set[int], policy: str = "pack",
+                 vcpus_per_core: int = 1):
+        if policy not in ("pack", "spread"):
+            raise ValueError(f"Неизвестная политика размещения: {policy}")
+        self.cpus = sorted(host_cpus - housekeeping) or sorted(host_cpus)
+        self.policy = policy
+        self.vcpus_per_core = max(vcpus_per_core, 1)
+
+    def _pick(self, load: Dict[int, int], own: Dict[int, int]) -> int:
+        if self.policy == "pack":
+            # first-fit по порядку ядер, пока есть ёмкость
+            for cpu in self.cpus:
+                if load[cpu] < self.vcpus_per_core:
+                    return cpu
+        # spread (и переподписка в pack): наименее загруженное ядро,
+        # при равенстве — где меньше vCPU этой же VM
+        return min(self.cpus, key=lambda c: (load[c], own.get(c, 0), c))
+
+    def plan(self, vcpus: Dict[str, int]) -> Dict[str, List[int]]:
+        """Возвращает для каждой VM список ядер по индексу vCPU."""
+        load = {cpu: 0 for cpu in self.cpus}
+        placement = {}
+        # Крупные VM размещаем первыми, порядок внутри — по имени для предсказуемости
+        for name in sorted(vcpus, key=lambda n: (-vcpus[n], n)):
+            own: Dict[int, int] = {}
+            cpus = []
+            for _ in range(max(vcpus[name], 1)):
+                cpu = self._pick(load, own)
+                load[cpu] += 1
+                own[cpu] = own.get(cpu, 0) + 1
+                cpus.append(cpu)
+            placement[name] = cpus
+        return placement
 
 
 class VMManager:
-    def __init__(self):
-        self.processes: dict[str, subprocess.Popen] = {}
+    def __init__(self, placer: CpuPlacer):
+        self.processes: Dict[str, subprocess.Popen] = {}
+        self.vcpus: Dict[str, int] = {}
+        self.placer = placer
+        self.placement: Dict[str, List[int]] = {}
+        # VM, чьи потоки ещё не закреплены (QMP не готов или план изменился)
+        self.pending_pin: Set[str] = set()
 
     def is_running(self, name: str) -> bool:
         proc = self.processes.get(name)
@@ -35,12 +150,15 @@ class VMManager:
             except subprocess.TimeoutExpired:
                 logging.warning("VM %s не завершилась, посылаем SIGKILL", name)
                 proc.kill()
-            self.processes.pop(name, None)
+        if self.processes.pop(name, None) is not None:
+            self.vcpus.pop(name, None)
+            self._qmp_path(name).unlink(missing_ok=True)
+            self.rebalance()
 
     def start_vm(self, row):
         name = row.name
-        cpu = getattr(row, "cpu", None) or 1
-        ram = getattr(row, "ram", None) or 512
+        cpu = optional_value(getattr(row, "cpu", None), 0) or 1
+        ram = optional_value(getattr(row, "ram", None), 0) or 512
         disk = getattr(row, "disk_path", None)
         passthrough = getattr(row, "pci_passthrough", [])
 
@@ -52,12 +170,18 @@ class VMManager:
             logging.info("VM %s уже запущена", name)
             return
 
+        QMP_DIR.mkdir(parents=True, exist_ok=True)
+        qmp_path = self._qmp_path(name)
+        qmp_path.unlink(missing_ok=True)
         args = [
             QEMU_CMD,
             "-name", name,
             "-m", str(ram),
             "-smp", str(cpu),
-            "-drive", f"file={disk},if=virtio,format=raw",
+            "-object", "iothread,id=io0",
+            "-drive", f"file={disk},if=none,id=disk0,format=raw",
+            "-device", "virtio-blk-pci,drive=disk0,iothread=io0",
+            "-qmp", f"unix:{qmp_path},server=on,wait=off",
             "-nographic",
             "-enable-kvm",
         ]
@@ -67,11 +191,78 @@ class VMManager:
         try:
             proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
             self.processes[name] = proc
+            self.vcpus[name] = int(cpu)
             logging.info("Запущена VM %s (pid %s)", name, proc.pid)
             self._assign_cgroup(proc.pid)
+            self.rebalance()
         except Exception as e:
             logging.error("Не удалось запустить VM %s: %s", name, e)
 
+    def _qmp_path(self, name: str) -> Path:
+        return QMP_DIR / f"{name}.qmp"
+
+    def rebalance(self):
+        plan = self.placer.plan(self.vcpus)
+        for name, cpus in plan.items():
+            if self.placement.get(name) != cpus:
+                self.pending_pin.add(name)
+                proc = self.processes.get(name)
+                if proc is not None:
+                    # Основной поток и все будущие потоки QEMU — только на ядрах VM,
+                    # чтобы до закрепления vCPU не занимать housekeeping-ядра
+                    try:
+                        os.sched_setaffinity(proc.pid, set(cpus))
+                    except OSError as e:
+                        logging.warning("Не удалось задать affinity VM %s: %s", name, e)
+        self.placement = plan
+        self.pending_pin &= set(plan)
+
+    def _pin_threads(self, name: str) -> bool:
+        cpus = self.placement.get(name)
+        if not cpus:
+            return True
+        try:
+            vcpu_info, iothreads = QMPClient(self._qmp_path(name)).execute(
+                "query-cpus-fast", "query-iothreads"
+            )
+        except (OSError, ValueError, RuntimeError) as e:
+            logging.debug("QMP VM %s пока недоступен: %s", name, e)
+            return False
+
+        for info in vcpu_info:
+            index = info.get("cpu-index", 0)
+            tid = info.get("thread-id")
+            if tid is None:
+                continue
+            cpu = cpus[index % len(cpus)]
+            try:
+                os.sched_setaffinity(tid, {cpu})
+            except OSError as e:
+                logging.warning("VM %s: не удалось закрепить vCPU %s (tid %s): %s", name, index, tid, e)
+                return False
+        for info in iothreads:
+            tid = info.get("thread-id")
+            if tid is None:
+                continue
+            try:
+                os.sched_setaffinity(tid, set(cpus))
+            except OSError as e:
+                logging.warning("VM %s: не удалось закрепить iothread %s: %s", name, info.get("id"), e)
+                return False
+        logging.info("VM %s: vCPU закреплены на ядрах %s", name, cpus)
+        return True
+
+    def poll(self):
+        # Учитываем VM, которые завершились сами: освобождаем их ядра
+        for name in list(self.processes):
+            proc = self.processes[name]
+            if proc.poll() is not None:
+                logging.warning("VM %s завершилась с кодом %s", name, proc.returncode)
+                self.stop_vm(name)
+        for name in list(self.pending_pin):
+            if name in self.processes and self._pin_threads(name):
+                self.pending_pin.discard(name)
+
     def _assign_cgroup(self, pid: int):
         if CGROUP_VM.exists():
             try:
@@ -105,24 +296,32 @@ def main():
 
     helper = ovs.db.idl.SchemaHelper(location=SCHEMA)
     helper.register_all()
-    idl = ovs.db.idl.Idl(REMOTE, helper)
+    idl = SysdbIdl(REMOTE, helper)
 
     poller = ovs.poller.Poller()
-    manager = VMManager()
+    placer = CpuPlacer(
+        online_cpus(),
+        parse_cpu_list(HOUSEKEEPING_CPUS),
+        PLACEMENT_POLICY,
+        VCPUS_PER_CORE,
+    )
+    manager = VMManager(placer)
+    debouncer = ChangeDebouncer(("VirtualMachine",))
     logging.info("vm_agent запущен...")
 
     while True:
-        seqno = idl.change_seqno
         idl.run()
-        if idl.change_seqno != seqno:
+        debouncer.add(idl.take_changes())
+        if debouncer.take_ready():
             vm_table = idl.tables.get("VirtualMachine")
             if vm_table:
                 manager.sync(vm_table)
+        publish_agent_stats(idl, "vm_agent", debouncer)
+        manager.poll()
 
         idl.wait(poller)
-        poller.timer_wait(POLL_INTERVAL * 1000)
+        poller.timer_wait(int(min(POLL_INTERVAL, debouncer.timeout()) * 1000))
         poller.block()
-        time.sleep(POLL_INTERVAL)
 
 
 if __name__ == "__main__":
@@ -16,8 +16,8 @@ except Exception:
 PROJECT_ROOT = Path(__file__).parent.parent
 SRC_PATH = PROJECT_ROOT / "src"
 IMG_PATH = PROJECT_ROOT / "raspi.img"
-KERNEL_IMAGE = PROJECT_ROOT / "temp" / "rpi_linux" / "arch/arm64/boot/Image"
-DTB_FILE = PROJECT_ROOT / "temp" / "rpi_linux" / "arch/arm64/boot/dts" / "broadcom" / "bcm2710-rpi-3-b-plus.dtb"
+KERNEL_IMAGE = PROJECT_ROOT / "temp" / "kernel" / "Image"
+DTB_FILE = PROJECT_ROOT / "temp" / "kernel" / "dts" / "broadcom" / "bcm2710-rpi-3-b-plus.dtb"
 
 REQUIRED_TOOLS = [
     ("brew", "Homebrew", "https://brew.sh/"),
@@ -2,24 +2,92 @@
 """
 Простой CLI для работы с OVSDB-схемой system.ovsschema.
 Пример: python3 cli.py set interface eth0 ip 10.0.0.2/24
+
+Модули ovs импортируются лениво, внутри команд: разбор аргументов и --help
+не платят за их загрузку.
 """
+from __future__ import annotations
+
 import argparse
+import io
+import json
+import os
 import sys
-from typing import Any, Dict
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from sysdb import SysdbIdl
 
-import ovs.db.idl
+# sysdb.py общий с агентами: src/agents в репозитории, /usr/local/sbin в образе
+for _lib_dir in (Path(__file__).resolve().parent / "agents", Path("/usr/local/sbin")):
+    if (_lib_dir / "sysdb.py").exists():
+        sys.path.insert(0, str(_lib_dir))
+        break
 
 SCHEMA = "src/schema/system.ovsschema"
 REMOTE = "unix:/var/run/openvswitch/db.sock"
+SYNC_TIMEOUT = 10.0
+OVSDB_PORT = 6640
+# Сколько узлов парка опрашивается одновременно
+FLEET_JOBS = 16
+# Сокет cli.py serve; переменная окружения включает тонкий клиент для всех команд
+SERVE_SOCKET = "/var/run/litainer/cli.sock"
+SESSION_SOCKET = os.environ.get("SYSDB_CLI_SOCKET")
+# Сколько serve ждёт клиента, который не досылает запрос или не забирает ответ
+SERVE_CLIENT_TIMEOUT = 5.0
+# Команды, которые никогда не пересылаются демону serve
+LOCAL_COMMANDS = ("serve", "shell", "watch")
+# Ключ строки для apply: по нему строки документа сопоставляются со строками БД
+TABLE_KEYS = {
+    "System": None,
+    "Interface": "name",
+    "VirtualMachine": "name",
+    "Storage": "target_iqn",
+}
+DELETE_MARKER = "_delete"
+# Ресурсы команды set -> таблица (ключевая колонка — в TABLE_KEYS)
+RESOURCES = {
+    "interface": "Interface",
+    "system": "System",
+    "vm": "VirtualMachine",
+    "storage": "Storage",
+}
 
 
-def get_idl(remote: str, schema_path: str) -> ovs.db.idl.Idl:
+def get_idl(
+    remote: str,
+    schema_path: str,
+    tables: Optional[List[str]] = None,
+    conditions: Optional[Dict[str, list]] = None,
+) -> SysdbIdl:
+    """Создаёт IDL, мониторящий только tables (все, если не заданы).
+
+    conditions — условия monitor_cond по таблицам, чтобы сервер прислал только
+    нужные строки, а не всю таблицу.
+    """
+    import ovs.db.idl
+    from sysdb import SysdbIdl
+
     helper = ovs.db.idl.SchemaHelper(location=schema_path)
-    helper.register_all()
-    return ovs.db.idl.Idl(remote, helper)
+    if tables is None:
+        helper.register_all()
+    else:
+        known = helper.schema_json.get("tables", {})
+        for table in tables:
+            if table not in known:
+                raise RuntimeError(f"Table {table} not found")
+            helper.register_table(table)
+    idl = SysdbIdl(remote, helper)
+    for table, cond in (conditions or {}).items():
+        idl.cond_change(table, cond)
+    return idl
 
 
 def commit(idl: ovs.db.idl.Idl):
+    import ovs.db.idl
+
     txn = ovs.db.idl.Transaction(idl)
     status = txn.commit_block()
     if status not in (
@@ -30,20 +98,51 @@ def commit(idl: ovs.db.idl.Idl):
         raise RuntimeError(f"Transaction failed: {status}")
 
 
-def upsert_row(idl: ovs.db.idl.Idl, table: str, match: Dict[str, Any], updates: Dict[str, Any]):
+def commit_txn(txn, timeout: float = SYNC_TIMEOUT):
+    """commit_block с ограничением по времени: зависший узел не держит fan-out."""
+    import ovs.db.idl
+    import ovs.poller
+
+    deadline = time.monotonic() + timeout
+    while True:
+        status = txn.commit()
+        if status != ovs.db.idl.Transaction.INCOMPLETE:
+            return status
+        if time.monotonic() >= deadline:
+            txn.abort()
+            raise TimeoutError(f"Transaction timed out after {timeout}s")
+        txn.idl.run()
+        poller = ovs.poller.Poller()
+        txn.idl.wait(poller)
+        txn.wait(poller)
+        poller.timer_wait(100)
+        poller.block()
+
+
+def find_row(idl: SysdbIdl, table: str, match: Dict[str, Any]):
+    if len(match) == 1:
+        # Поиск по индексу схемы (name, target_iqn) — O(1)
+        (column, value), = match.items()
+        return idl.lookup(table, column, value)
+    for r in idl.tables[table].rows.values():
+        if all(hasattr(r, k) and getattr(r, k) == v for k, v in match.items()):
+            return r
+    return None
+
+
+def upsert_row(
+    idl: SysdbIdl,
+    table: str,
+    match: Dict[str, Any],
+    updates: Dict[str, Any],
+    timeout: float = SYNC_TIMEOUT,
+):
+    import ovs.db.idl
+
     tbl = idl.tables.get(table)
     if not tbl:
         raise RuntimeError(f"Table {table} not found")
-    row = None
-    for r in tbl.rows.values():
-        ok = True
-        for k, v in match.items():
-            if not hasattr(r, k) or getattr(r, k) != v:
-                ok = False
-                break
-        if ok:
-            row = r
-            break
+    row = find_row(idl, table, match)
     txn = ovs.db.idl.Transaction(idl)
     if row is None:
         row = txn.insert(tbl)
@@ -51,7 +150,7 @@ def upsert_row(idl: ovs.db.idl.Idl, table: str, match: Dict[str, Any], updates:
             setattr(row, k, v)
     for k, v in updates.items():
         setattr(row, k, v)
-    status = txn.commit_block()
+    status = commit_txn(txn, timeout)
     if status not in (
         ovs.db.idl.Transaction.SUCCESS,
         ovs.db.idl.Transaction.UNCHANGED,
@@ -60,9 +159,11 @@ def upsert_row(idl: ovs.db.idl.Idl, table: str, match: Dict[str, Any], updates:
         raise RuntimeError(f"Transaction failed: {status}")
 
 
-def handle_set(args):
-    idl = get_idl(args.remote, args.schema)
-    idl.run()
+def handle_set(args, out=sys.stdout):
+    table = RESOURCES[args.resource]
+    key = TABLE_KEYS[table]
+    conditions = {table: [[key, "==", args.name]]} if key else None
+    idl, owned = command_idl(args, [table], conditions)
     if args.resource == "interface":
         updates: Dict[str, Any] = {}
         if args.key in ("ip", "state"):
@@ -71,60 +172,1014 @@ def handle_set(args):
             updates[args.key] = int(args.value)
         else:
             raise RuntimeError(f"Unknown interface field {args.key}")
-        upsert_row(idl, "Interface", {"name": args.name}, updates)
+        upsert_row(idl, "Interface", {"name": args.name}, updates, args.timeout)
     elif args.resource == "system":
         updates: Dict[str, Any] = {args.key: args.value}
-        upsert_row(idl, "System", {}, updates)
+        upsert_row(idl, "System", {}, updates, args.timeout)
     elif args.resource == "vm":
         updates: Dict[str, Any] = {}
         if args.key in ("cpu", "ram"):
             updates[args.key] = int(args.value)
         else:
             updates[args.key] = args.value
-        upsert_row(idl, "VirtualMachine", {"name": args.name}, updates)
+        upsert_row(idl, "VirtualMachine", {"name": args.name}, updates, args.timeout)
+    elif args.resource == "storage":
+        updates: Dict[str, Any] = {}
+        if args.key in (
+            "lun",
+            "sessions_per_portal",
+            "commit_interval",
+            "read_ahead_kb",
+            "nr_requests",
+            "queue_depth",
+            "max_recv_data_segment_length",
+            "first_burst_length",
+            "cache_size_mb",
+        ):
+            updates[args.key] = int(args.value)
+        elif args.key in ("noatime", "immediate_data"):
+            updates[args.key] = args.value.lower() in ("1", "true", "yes", "on")
+        elif args.key == "portals":
+            updates[args.key] = [p for p in args.value.split(",") if p]
+        elif args.key in (
+            "portal_ip",
+            "mount_point",
+            "path_selector",
+            "fs_type",
+            "discard",
+            "io_scheduler",
+            "cache_device",
+            "cache_mode",
+        ):
+            updates[args.key] = args.value
+        else:
+            raise RuntimeError(f"Unknown storage field {args.key}")
+        upsert_row(idl, "Storage", {"target_iqn": args.name}, updates, args.timeout)
     else:
         raise RuntimeError(f"Unknown resource {args.resource}")
-    print("OK")
+    if owned:
+        idl.close()
+    print("OK", file=out)
 
 
-def handle_show(args):
-    idl = get_idl(args.remote, args.schema)
-    idl.run()
-    tbl = idl.tables.get(args.table)
-    if not tbl:
+def sync_idl(idl: ovs.db.idl.Idl, timeout: float = SYNC_TIMEOUT):
+    """Крутит IDL, пока не придёт начальный снимок БД."""
+    import ovs.poller
+
+    deadline = time.monotonic() + timeout
+    while True:
+        idl.run()
+        if idl.has_ever_connected():
+            return
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"No initial sync from {idl.session_name()} within {timeout}s")
+        poller = ovs.poller.Poller()
+        idl.wait(poller)
+        poller.timer_wait(100)
+        poller.block()
+
+
+def command_idl(args, tables: Optional[List[str]], conditions: Optional[Dict[str, list]] = None):
+    """IDL для команды: (idl, owned).
+
+    В shell/serve args.idl — общая, уже синхронизированная реплика всех таблиц: команда
+    не платит за подключение и начальный снимок. Иначе открывается своё подключение,
+    которое команда закрывает сама (owned=True).
+    """
+    shared = getattr(args, "idl", None)
+    if shared is not None:
+        shared.run()
+        return shared, False
+    idl = get_idl(args.remote, args.schema, tables=tables, conditions=conditions)
+    sync_idl(idl, args.timeout)
+    return idl, True
+
+
+def load_document(path: str, text: Optional[str] = None) -> Dict[str, Any]:
+    if text is None:
+        text = sys.stdin.read() if path == "-" else open(path).read()
+    if path.endswith((".yaml", ".yml")) or not text.lstrip().startswith("{"):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("YAML input requires PyYAML (python3-yaml); use JSON instead")
+        doc = yaml.safe_load(text)
+    else:
+        doc = json.loads(text)
+    if not isinstance(doc, dict):
+        raise RuntimeError("Desired-state document must be a mapping of table names")
+    return doc
+
+
+def to_document_value(column, value):
+    """Приводит значение колонки IDL к виду документа: скаляр/None, список или словарь."""
+    if column.type.is_map():
+        return dict(value)
+    if column.type.is_optional():
+        return value[0] if value else None
+    if column.type.is_set():
+        return sorted(value)
+    return value
+
+
+def normalize_value(column, value):
+    if column.type.is_set() and not column.type.is_optional() and isinstance(value, (list, tuple, set)):
+        return sorted(value)
+    return value
+
+
+def empty_value(column):
+    if column.type.is_map():
+        return {}
+    if column.type.is_optional() or column.type.is_set():
+        return []
+    return None
+
+
+def check_value(table: str, name: str, column, value):
+    """
+    Проверяет значение документа по типу колонки так же, как это сделает IDL.
+
+    Row.__setattr__ молча отбрасывает неподходящее значение, и apply сообщил бы
+    об успехе без изменения; здесь ошибка поднимается до начала транзакции.
+    """
+    import ovs.db.data
+    import ovs.db.error
+
+    try:
+        ovs.db.data.Datum.from_python(column.type, value, lambda atom: atom)
+    except ovs.db.error.Error as exc:
+        raise RuntimeError(f"{table}.{name}: invalid value {json.dumps(value, default=str)}: {exc}")
+
+
+def desired_rows(tbl, table: str, spec: Any) -> Dict[Any, Dict[str, Any]]:
+    key = TABLE_KEYS[table]
+    entries = [spec] if key is None and isinstance(spec, dict) else spec
+    if not isinstance(entries, list):
+        raise RuntimeError(f"{table}: expected a list of rows")
+    rows = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise RuntimeError(f"{table}: row must be a mapping, got {entry!r}")
+        for column in entry:
+            if column != DELETE_MARKER and column not in tbl.columns:
+                raise RuntimeError(f"{table}: unknown column {column}")
+        if key is None:
+            rows[None] = entry
+            continue
+        if key not in entry:
+            raise RuntimeError(f"{table}: row without key column {key}: {entry!r}")
+        rows[entry[key]] = entry
+    return rows
+
+
+def compute_diff(idl: ovs.db.idl.Idl, doc: Dict[str, Any], prune: bool, replace: bool) -> List[Tuple]:
+    """Возвращает операции [(op, table, key, row, changes)], op = insert/update/delete."""
+    ops = []
+    for table, spec in doc.items():
+        if table not in TABLE_KEYS:
+            raise RuntimeError(f"Table {table} is not managed by apply")
+        tbl = idl.tables.get(table)
+        if not tbl:
+            raise RuntimeError(f"Table {table} not found")
+        key = TABLE_KEYS[table]
+        current = {}
+        for row in tbl.rows.values():
+            current[getattr(row, key) if key else None] = row
+
+        for row_key, entry in desired_rows(tbl, table, spec).items():
+            row = current.pop(row_key, None)
+            if entry.get(DELETE_MARKER):
+                if row is not None:
+                    ops.append(("delete", table, row_key, row, {}))
+                continue
+            changes = {}
+            for name, column in tbl.columns.items():
+                if name == key:
+                    continue
+                old = to_document_value(column, getattr(row, name)) if row is not None else None
+                if name in entry:
+                    new = normalize_value(column, entry[name])
+                elif replace and row is not None and empty_value(column) is not None:
+                    new = to_document_value(column, empty_value(column))
+                else:
+                    continue
+                if old != new:
+                    check_value(table, name, column, empty_value(column) if new is None else new)
+                    changes[name] = (old, new)
+            if row is None:
+                if key:
+                    check_value(table, key, tbl.columns[key], row_key)
+                ops.append(("insert", table, row_key, None, changes))
+            elif changes:
+                ops.append(("update", table, row_key, row, changes))
+
+        if prune and key is not None:
+            for row_key, row in current.items():
+                ops.append(("delete", table, row_key, row, {}))
+    return ops
+
+
+def format_diff(ops: List[Tuple]) -> List[str]:
+    lines = []
+    for op, table, key, _, changes in ops:
+        label = f"{table} {key}" if key is not None else table
+        if op == "delete":
+            lines.append(f"- {label}")
+        elif op == "insert":
+            fields = " ".join(f"{k}={json.dumps(new)}" for k, (_, new) in sorted(changes.items()))
+            lines.append(f"+ {label} {fields}".rstrip())
+        else:
+            for name, (old, new) in sorted(changes.items()):
+                lines.append(f"~ {label} {name}: {json.dumps(old)} -> {json.dumps(new)}")
+    return lines
+
+
+def apply_diff(idl: ovs.db.idl.Idl, ops: List[Tuple], timeout: float = SYNC_TIMEOUT):
+    """Применяет все операции одной транзакцией."""
+    import ovs.db.idl
+
+    txn = ovs.db.idl.Transaction(idl)
+    for op, table, key, row, changes in ops:
+        if op == "delete":
+            row.delete()
+            continue
+        tbl = idl.tables[table]
+        if op == "insert":
+            row = txn.insert(tbl)
+            if TABLE_KEYS[table]:
+                setattr(row, TABLE_KEYS[table], key)
+        for name, (_, new) in changes.items():
+            column = tbl.columns[name]
+            setattr(row, name, empty_value(column) if new is None else new)
+    status = commit_txn(txn, timeout)
+    if status not in (
+        ovs.db.idl.Transaction.SUCCESS,
+        ovs.db.idl.Transaction.UNCHANGED,
+    ):
+        raise RuntimeError(f"Transaction failed: {status} {txn.get_error() or ''}".rstrip())
+
+
+def handle_apply(args, out=sys.stdout):
+    # Документ читается один раз в main(): при fan-out stdin не перечитать
+    doc = args.document
+    idl, owned = command_idl(args, list(doc))
+    ops = compute_diff(idl, doc, prune=args.prune, replace=args.replace)
+    for line in format_diff(ops):
+        print(line, file=out)
+    if args.dry_run or not ops:
+        if owned:
+            idl.close()
+        print("No changes" if not ops else f"{len(ops)} change(s) (dry run)", file=out)
+        return
+    apply_diff(idl, ops, args.timeout)
+    if owned:
+        idl.close()
+    print(f"OK: {len(ops)} change(s) applied", file=out)
+
+
+def coerce_atom(column, text: str):
+    """Текст из командной строки -> значение типа ключа колонки."""
+    kind = column.type.key.type.to_string()
+    if kind == "integer":
+        return int(text)
+    if kind == "real":
+        return float(text)
+    if kind == "boolean":
+        return text.lower() in ("1", "true", "yes", "on")
+    return text
+
+
+def parse_predicate(tbl, text: str) -> Tuple[str, str, Any]:
+    for op in ("!=", "="):
+        name, sep, value = text.partition(op)
+        if sep:
+            break
+    else:
+        raise RuntimeError(f"Bad predicate {text!r}, expected col=value or col!=value")
+    name = name.strip()
+    if name not in tbl.columns:
+        raise RuntimeError(f"{tbl.name}: unknown column {name}")
+    return name, "==" if op == "=" else "!=", coerce_atom(tbl.columns[name], value.strip())
+
+
+def row_value(tbl, row, name: str):
+    if name == "_uuid":
+        return str(row.uuid)
+    value = to_document_value(tbl.columns[name], getattr(row, name))
+    if isinstance(value, list):
+        return [str(v) if not isinstance(v, (str, int, float, bool)) else v for v in value]
+    if isinstance(value, dict):
+        return {str(k): v for k, v in value.items()}
+    return value
+
+
+def matches(tbl, row, predicates) -> bool:
+    # Условия уже применены сервером через monitor_cond; локальная проверка нужна,
+    # если сервер не поддерживает условный мониторинг и прислал всю таблицу.
+    # Для множеств col=value — «содержит value», для map — «есть ключ value»
+    for name, op, value in predicates:
+        current = row_value(tbl, row, name)
+        equal = value in current if isinstance(current, (list, dict)) else current == value
+        if equal != (op == "=="):
+            return False
+    return True
+
+
+def monitor_conditions(tbl, predicates) -> list:
+    """
+    Условия monitor_cond с той же семантикой, что у matches.
+
+    Серверное == для множества — равенство всего множества, поэтому для колонок
+    с несколькими значениями отправляется includes/excludes. Ключи map так не
+    выразить: такие предикаты проверяются только локально.
+    """
+    conditions = []
+    for name, op, value in predicates:
+        column_type = tbl.columns[name].type
+        if column_type.is_map():
+            continue
+        if column_type.n_max > 1:
+            conditions.append([name, "includes" if op == "==" else "excludes", ["set", [value]]])
+        else:
+            conditions.append([name, op, value])
+    return conditions
+
+
+def format_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ",".join(str(v) for v in value)
+    if isinstance(value, dict):
+        return ",".join(f"{k}={v}" for k, v in sorted(value.items()))
+    return str(value)
+
+
+def show_columns(tbl, table: str, requested: Optional[str]) -> List[str]:
+    if requested:
+        columns = [c.strip() for c in requested.split(",") if c.strip()]
+        for name in columns:
+            if name != "_uuid" and name not in tbl.columns:
+                raise RuntimeError(f"{table}: unknown column {name}")
+        return columns
+    key = TABLE_KEYS.get(table)
+    rest = sorted(c for c in tbl.columns if c != key)
+    return ([key] if key else []) + rest
+
+
+def write_records(records, columns: List[str], fmt: str, out=sys.stdout):
+    """Печатает записи по мере форматирования, не собирая результат целиком."""
+    if fmt == "ndjson":
+        for record in records:
+            out.write(json.dumps({c: record.get(c) for c in columns}, default=str) + "\n")
+    elif fmt == "json":
+        out.write("[")
+        first = True
+        for record in records:
+            out.write(("\n  " if first else ",\n  ") + json.dumps({c: record.get(c) for c in columns}, default=str))
+            first = False
+        out.write("]\n" if first else "\n]\n")
+    else:
+        # Первый проход считает только ширины колонок, второй печатает строки
+        records = list(records)
+        widths = [len(c) for c in columns]
+        for record in records:
+            for i, c in enumerate(columns):
+                widths[i] = max(widths[i], len(format_cell(record.get(c))))
+        out.write("  ".join(c.ljust(w) for c, w in zip(columns, widths)).rstrip() + "\n")
+        for record in records:
+            cells = (format_cell(record.get(c)).ljust(w) for c, w in zip(columns, widths))
+            out.write("  ".join(cells).rstrip() + "\n")
+
+
+def sort_records(records, sort: str) -> list:
+    name = sort.lstrip("-")
+
+    def key(record):
+        value = record.get(name)
+        numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+        # Строки без значения идут после заполненных (при сортировке по возрастанию)
+        return (value is None, not numeric, value if numeric else 0, format_cell(value))
+
+    return sorted(records, key=key, reverse=sort.startswith("-"))
+
+
+def show_records(args):
+    """Колонки и записи show; без --sort записи отдаются генератором по мере чтения."""
+    shared = getattr(args, "idl", None)
+    idl = shared or get_idl(args.remote, args.schema, tables=[args.table])
+    if args.table not in idl.tables:
         raise RuntimeError(f"Table {args.table} not found")
-    for row in tbl.rows.values():
-        print(row)
+    tbl = idl.tables[args.table]
+    predicates = [parse_predicate(tbl, text) for text in args.where or []]
+    if shared is not None:
+        # Условия общей реплики не трогаем: фильтр только локальный
+        shared.run()
+    else:
+        conditions = monitor_conditions(tbl, predicates)
+        if conditions:
+            idl.cond_change(args.table, conditions)
+        sync_idl(idl, args.timeout)
+    columns = show_columns(tbl, args.table, args.columns)
+    fields = list(columns)
+    if args.sort:
+        sort_name = args.sort.lstrip("-")
+        if sort_name != "_uuid" and sort_name not in tbl.columns:
+            raise RuntimeError(f"{args.table}: unknown column {sort_name}")
+        if sort_name not in fields:
+            fields.append(sort_name)
+
+    def records():
+        try:
+            for row in tbl.rows.values():
+                if matches(tbl, row, predicates):
+                    yield {c: row_value(tbl, row, c) for c in fields}
+        finally:
+            if shared is None:
+                idl.close()
+
+    if args.sort:
+        return columns, sort_records(records(), args.sort)
+    return columns, records()
+
+
+def handle_show(args, out=sys.stdout):
+    columns, records = show_records(args)
+    write_records(records, columns, args.format, out)
+
+
+def watch_snapshot(tbl, columns: List[str], predicates) -> Dict[str, Dict[str, Any]]:
+    return {
+        str(row.uuid): {c: row_value(tbl, row, c) for c in columns}
+        for row in tbl.rows.values()
+        if matches(tbl, row, predicates)
+    }
+
+
+def watch_events(table: str, key: Optional[str], old: Dict[str, Dict], new: Dict[str, Dict]):
+    """События между двумя снимками: insert со всеми колонками, update только с
+    изменившимися (плюс ключ строки), delete с ключом строки."""
+    for uuid, values in new.items():
+        before = old.get(uuid)
+        if before is None:
+            yield {"event": "insert", "table": table, "_uuid": uuid, "row": values}
+            continue
+        changed = {c: v for c, v in values.items() if before.get(c) != v}
+        if changed:
+            if key and key in values:
+                changed.setdefault(key, values[key])
+            yield {"event": "update", "table": table, "_uuid": uuid, "row": changed}
+    for uuid, values in old.items():
+        if uuid not in new:
+            row = {key: values[key]} if key and key in values else {}
+            yield {"event": "delete", "table": table, "_uuid": uuid, "row": row}
+
+
+def handle_watch(args):
+    import ovs.poller
+
+    idl = get_idl(args.remote, args.schema, tables=[args.table])
+    tbl = idl.tables[args.table]
+    predicates = [parse_predicate(tbl, text) for text in args.where or []]
+    conditions = monitor_conditions(tbl, predicates)
+    if conditions:
+        idl.cond_change(args.table, conditions)
+    sync_idl(idl, args.timeout)
+    columns = show_columns(tbl, args.table, args.columns)
+    key = TABLE_KEYS.get(args.table)
+
+    # События считаются сравнением снимков, а не по каждому уведомлению IDL: изменения
+    # внутри интервала схлопываются (insert+delete пропадает, несколько update — один),
+    # а после переподключения (monitor_cond_since или полный снимок) печатается
+    # только реальная разница
+    snapshot = {} if not args.changes_only else watch_snapshot(tbl, columns, predicates)
+    seen_seqno = -1 if not args.changes_only else idl.change_seqno
+    next_flush = 0.0
+    while True:
+        idl.run()
+        now = time.monotonic()
+        if idl.change_seqno != seen_seqno and now >= next_flush:
+            seen_seqno = idl.change_seqno
+            current = watch_snapshot(tbl, columns, predicates)
+            stamp = round(time.time(), 3)
+            for event in watch_events(args.table, key, snapshot, current):
+                event["time"] = stamp
+                sys.stdout.write(json.dumps(event, default=str) + "\n")
+            sys.stdout.flush()
+            snapshot = current
+            next_flush = now + args.interval
+        poller = ovs.poller.Poller()
+        idl.wait(poller)
+        if idl.change_seqno != seen_seqno:
+            poller.timer_wait(max(0, int((next_flush - now) * 1000)))
+        poller.block()
+
+
+def normalize_remote(text: str) -> str:
+    """
+    Узел парка -> OVSDB remote: pi1 -> tcp:pi1:6640, fe80::1 -> tcp:[fe80::1]:6640.
+
+    Хвост :порт считается портом, только если адрес в скобках или двоеточие одно.
+    Список через запятую — кластер одного узла, нормализуется каждый элемент.
+    """
+    remotes = []
+    for part in (p.strip() for p in text.split(",")):
+        if part.split(":", 1)[0] in ("unix", "tcp", "ssl"):
+            remotes.append(part)
+        elif part.startswith("["):
+            remotes.append(f"tcp:{part}" if "]:" in part else f"tcp:{part}:{OVSDB_PORT}")
+        elif part.count(":") == 1:
+            remotes.append(f"tcp:{part}")
+        elif ":" in part:
+            remotes.append(f"tcp:[{part}]:{OVSDB_PORT}")
+        else:
+            remotes.append(f"tcp:{part}:{OVSDB_PORT}")
+    return ",".join(remotes)
+
+
+def fleet_remotes(args) -> List[str]:
+    """Узлы парка из --nodes и --remotes-file; пустой список — работа с одним --remote."""
+    remotes: List[str] = []
+    for value in args.nodes or []:
+        remotes.extend(r.strip() for r in value.split(",") if r.strip())
+    if args.remotes_file:
+        with open(args.remotes_file) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    remotes.append(line)
+    return list(dict.fromkeys(remotes))
+
+
+def forward_socket(args, nodes: List[str]) -> Optional[str]:
+    """
+    Сокет serve, которому пересылается команда, или None — выполнить её здесь.
+
+    Демон работает со своим remote: команда с явным --remote или с парком узлов
+    (--nodes, --remotes-file) молча ушла бы на его единственный узел, поэтому
+    такие команды выполняются напрямую.
+    """
+    if not args.socket or args.cmd in LOCAL_COMMANDS:
+        return None
+    if args.remote is not None or nodes:
+        return None
+    return args.socket
+
+
+def run_node(args, node: str) -> Dict[str, Any]:
+    """Выполняет команду на одном узле, собирая вывод в буфер."""
+    node_args = argparse.Namespace(**{**vars(args), "remote": normalize_remote(node)})
+    out = io.StringIO()
+    result: Dict[str, Any] = {"node": node, "status": "ok", "error": "", "records": None}
+    start = time.monotonic()
+    try:
+        if args.cmd == "show" and args.merge:
+            columns, records = show_records(node_args)
+            result["records"] = (columns, list(records))
+        else:
+            args.func(node_args, out)
+    except TimeoutError as exc:
+        result.update(status="timeout", error=str(exc))
+    except Exception as exc:
+        result.update(status="error", error=str(exc))
+    result["seconds"] = time.monotonic() - start
+    result["output"] = out.getvalue()
+    return result
+
+
+def write_fleet_summary(results: List[Dict[str, Any]], out):
+    width = max(len("NODE"), *(len(r["node"]) for r in results))
+    out.write(f"{'NODE'.ljust(width)}  STATUS   TIME     RESULT\n")
+    for r in results:
+        lines = r["output"].strip().splitlines()
+        message = r["error"] or (lines[-1] if lines else "")
+        if not message and r["records"] is not None:
+            message = f"{len(r['records'][1])} row(s)"
+        out.write(f"{r['node'].ljust(width)}  {r['status'].ljust(7)}  {r['seconds']:6.2f}s  {message}\n")
+
+
+def handle_fleet(args, nodes: List[str]) -> int:
+    """Команда на всех узлах параллельно (не больше --jobs сразу): общее время —
+    время самого медленного узла, каждый узел ограничен своим --timeout."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    results: Dict[str, Dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(args.jobs, len(nodes)))) as pool:
+        futures = [pool.submit(run_node, args, node) for node in nodes]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result["node"]] = result
+            if result["output"]:
+                sys.stdout.write(f"== {result['node']} ==\n{result['output']}")
+                sys.stdout.flush()
+
+    ordered = [results[node] for node in nodes]
+    if args.cmd == "show" and args.merge:
+        columns: List[str] = []
+        merged = []
+        for r in ordered:
+            if r["records"] is None:
+                continue
+            node_columns, records = r["records"]
+            columns = columns or node_columns
+            merged.extend({"node": r["node"], **record} for record in records)
+        if args.sort:
+            merged = sort_records(merged, args.sort)
+        write_records(merged, ["node"] + columns, args.format)
+    # У show stdout занят данными, сводка уходит в stderr
+    write_fleet_summary(ordered, sys.stderr if args.cmd == "show" else sys.stdout)
+    return 0 if all(r["status"] == "ok" for r in ordered) else 1
+
+
+def run_session_command(idl, remote: str, argv: List[str], cwd: Optional[str] = None, stdin: Optional[str] = None):
+    """Выполняет одну команду CLI на общей реплике shell/serve. Возвращает (код, вывод)."""
+    from contextlib import redirect_stderr, redirect_stdout
+
+    out = io.StringIO()
+    try:
+        # argparse печатает --help и ошибки разбора сам и завершает процесс
+        with redirect_stdout(out), redirect_stderr(out):
+            args = build_parser().parse_args(argv)
+    except SystemExit as exc:
+        return (exc.code if isinstance(exc.code, int) else 1), out.getvalue()
+    try:
+        if args.cmd in LOCAL_COMMANDS:
+            raise RuntimeError(f"{args.cmd} is not available inside a session")
+        if args.remote is not None or args.nodes or args.remotes_file:
+            raise RuntimeError("--remote, --nodes and --remotes-file are not available inside a session")
+        args.remote = remote
+        args.idl = idl
+        if args.cmd == "apply":
+            path = args.file if args.file == "-" or cwd is None else os.path.join(cwd, args.file)
+            if path == "-" and stdin is None:
+                raise RuntimeError("apply -f - needs the document on stdin")
+            args.document = load_document(path, stdin if path == "-" else None)
+        args.func(args, out)
+    except Exception as exc:
+        out.write(f"ERROR: {exc}\n")
+        return 1, out.getvalue()
+    return 0, out.getvalue()
+
+
+def open_session(args):
+    """Реплика всех таблиц для shell/serve, синхронизированная один раз на старте."""
+    idl = get_idl(args.remote, args.schema)
+    sync_idl(idl, args.timeout)
+    return idl
+
+
+def run_shell_line(idl, remote: str, line: bytes) -> Optional[str]:
+    """Выполняет строку shell: вывод команды или None для exit/quit.
+
+    Строку, которую не разобрать (незакрытая кавычка, не UTF-8), REPL сообщает
+    как ошибку и продолжает работу: общая реплика не теряется.
+    """
+    import shlex
+
+    try:
+        argv = shlex.split(line.decode())
+    except (ValueError, UnicodeDecodeError) as exc:
+        return f"ERROR: {exc}\n"
+    if argv and argv[0] in ("exit", "quit"):
+        return None
+    if not argv:
+        return ""
+    return run_session_command(idl, remote, argv, cwd=os.getcwd())[1]
+
+
+def handle_shell(args, out=sys.stdout):
+    """REPL поверх одной реплики: между командами IDL продолжает получать обновления."""
+    import select
+
+    import ovs.poller
+
+    idl = open_session(args)
+    fd = sys.stdin.fileno()
+    interactive = sys.stdin.isatty()
+    prompt = "sysdb> " if interactive else ""
+    buffer = b""
+    out.write(prompt)
+    out.flush()
+    while True:
+        idl.run()
+        if select.select([fd], [], [], 0)[0]:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                text = run_shell_line(idl, args.remote, line)
+                if text is None:
+                    idl.close()
+                    return
+                out.write(text)
+                out.write(prompt)
+                out.flush()
+            continue
+        poller = ovs.poller.Poller()
+        idl.wait(poller)
+        poller.fd_wait(fd, ovs.poller.POLLIN)
+        poller.block()
+    if interactive:
+        out.write("\n")
+    idl.close()
+
+
+class SessionServer:
+    """
+    Сокет serve: запрос — строка JSON {"argv": [...], "cwd": ..., "stdin": ...},
+    ответ — {"status": ..., "output": ...}.
+
+    Чтение и запись неблокирующие, у каждого клиента свои буферы: медленный клиент
+    не задерживает остальных и обновления реплики. Клиент, который client_timeout
+    секунд не досылает запрос или не забирает ответ, отключается.
+    """
+
+    def __init__(self, idl, remote: str, path: str, client_timeout: float = SERVE_CLIENT_TIMEOUT):
+        import socket
+
+        self.idl = idl
+        self.remote = remote
+        self.path = path
+        self.client_timeout = client_timeout
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+        # сокет -> {"input": принятое, "output": неотправленный ответ (None, пока читается запрос), "deadline": ...}
+        self.clients: Dict[Any, Dict[str, Any]] = {}
+
+    def step(self, timeout_ms: Optional[int] = None):
+        """Одна итерация: реплика, новые клиенты, чтение запросов, запись ответов."""
+        import select
+
+        import ovs.poller
+
+        self.idl.run()
+        readers = [sock for sock, client in self.clients.items() if client["output"] is None]
+        writers = [sock for sock, client in self.clients.items() if client["output"] is not None]
+        readable, writable, _ = select.select([self.listener, *readers], writers, [], 0)
+        for sock in readable:
+            if sock is self.listener:
+                self._accept()
+            else:
+                self._read(sock)
+        for sock in writable:
+            if sock in self.clients:
+                self._write(sock)
+        now = time.monotonic()
+        for sock, client in list(self.clients.items()):
+            if now >= client["deadline"]:
+                self._drop(sock)
+        if readable or writable:
+            return
+        poller = ovs.poller.Poller()
+        self.idl.wait(poller)
+        poller.fd_wait(self.listener.fileno(), ovs.poller.POLLIN)
+        for sock, client in self.clients.items():
+            poller.fd_wait(sock.fileno(), ovs.poller.POLLIN if client["output"] is None else ovs.poller.POLLOUT)
+        if self.clients:
+            deadline = min(client["deadline"] for client in self.clients.values())
+            poller.timer_wait(max(0, int((deadline - now) * 1000)))
+        if timeout_ms is not None:
+            poller.timer_wait(timeout_ms)
+        poller.block()
+
+    def close(self):
+        for sock in list(self.clients):
+            self._drop(sock)
+        self.listener.close()
+        os.unlink(self.path)
+
+    def _accept(self):
+        try:
+            conn, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.clients[conn] = {"input": b"", "output": None, "deadline": time.monotonic() + self.client_timeout}
+
+    def _read(self, sock):
+        client = self.clients[sock]
+        try:
+            data = sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._drop(sock)
+            return
+        client["input"] += data
+        client["deadline"] = time.monotonic() + self.client_timeout
+        if data and b"\n" not in client["input"]:
+            return
+        if not client["input"]:
+            self._drop(sock)
+            return
+        request_line = client["input"].split(b"\n", 1)[0]
+        try:
+            request = json.loads(request_line)
+            status, text = run_session_command(
+                self.idl, self.remote, request["argv"], request.get("cwd"), request.get("stdin")
+            )
+        except (ValueError, KeyError, TypeError) as exc:
+            status, text = 1, f"ERROR: bad request: {exc}\n"
+        client["output"] = json.dumps({"status": status, "output": text}).encode() + b"\n"
+        self._write(sock)
+
+    def _write(self, sock):
+        client = self.clients[sock]
+        try:
+            sent = sock.send(client["output"])
+        except BlockingIOError:
+            return
+        except OSError:
+            self._drop(sock)
+            return
+        client["output"] = client["output"][sent:]
+        client["deadline"] = time.monotonic() + self.client_timeout
+        if not client["output"]:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        self.clients.pop(sock, None)
+        sock.close()
+
+
+def handle_serve(args, out=sys.stdout):
+    """Держит реплику и принимает команды на unix-сокете (см. SessionServer)."""
+    path = args.socket or SERVE_SOCKET
+    idl = open_session(args)
+    server = SessionServer(idl, args.remote, path)
+    print(f"Serving {args.remote} on {path}", file=out)
+    out.flush()
+    try:
+        while True:
+            server.step()
+    finally:
+        server.close()
+        idl.close()
+
+
+def forward_command(path: str, argv: List[str], stdin: Optional[str], out=sys.stdout) -> int:
+    """Тонкий клиент: отправляет команду демону serve и печатает его ответ."""
+    import socket
+
+    request = {"argv": argv, "cwd": os.getcwd(), "stdin": stdin}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    response = json.loads(b"".join(chunks))
+    out.write(response["output"])
+    return response["status"]
 
 
 def build_parser():
     parser = argparse.ArgumentParser(description="OVSDB CLI wrapper")
-    parser.add_argument("--remote", default=REMOTE, help="OVSDB remote (default unix socket)")
+    parser.add_argument(
+        "--remote",
+        help=f"OVSDB remote (default {REMOTE}); a comma-separated list is one clustered database",
+    )
+    parser.add_argument(
+        "--nodes",
+        action="append",
+        help="Fleet mode: hosts or remotes to run the command on; repeat or comma-separate",
+    )
+    parser.add_argument(
+        "--socket",
+        default=SESSION_SOCKET,
+        help="Send the command to a running 'serve' on this unix socket (env SYSDB_CLI_SOCKET); "
+        "ignored by watch and shell and with --remote, --nodes or --remotes-file; "
+        f"for serve, the socket to listen on (default {SERVE_SOCKET})",
+    )
+    parser.add_argument(
+        "--remotes-file",
+        help="Fleet mode: file with one node per line (# comments); a line may list a cluster's remotes",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=FLEET_JOBS,
+        help="Nodes contacted concurrently in fleet mode (default %(default)s)",
+    )
     parser.add_argument("--schema", default=SCHEMA, help="Path to ovsschema")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=SYNC_TIMEOUT,
+        help="Per-node seconds to wait for the initial sync and for a commit (default %(default)s)",
+    )
     sub = parser.add_subparsers(dest="cmd", required=True)
 
     setp = sub.add_parser("set", help="Set values")
-    setp.add_argument("resource", choices=["interface", "system", "vm"])
+    setp.add_argument("resource", choices=["interface", "system", "vm", "storage"])
     setp.add_argument("name", help="Resource name (ignored for system)")
     setp.add_argument("key", help="Field name")
     setp.add_argument("value", help="Field value")
     setp.set_defaults(func=handle_set)
 
+    applyp = sub.add_parser("apply", help="Apply a desired-state document in one transaction")
+    applyp.add_argument("-f", "--file", required=True, help="JSON/YAML document or '-' for stdin")
+    applyp.add_argument("--dry-run", action="store_true", help="Print the diff without committing")
+    applyp.add_argument("--prune", action="store_true", help="Delete rows of listed tables absent from the document")
+    applyp.add_argument(
+        "--replace",
+        action="store_true",
+        help="Reset columns missing from a document row instead of leaving them unchanged",
+    )
+    applyp.set_defaults(func=handle_apply)
+
     showp = sub.add_parser("show", help="Show table rows")
     showp.add_argument("table", help="Table name")
+    showp.add_argument("-c", "--columns", help="Comma-separated columns to print (_uuid allowed)")
+    showp.add_argument(
+        "-w",
+        "--where",
+        action="append",
+        help="Filter col=value or col!=value, pushed to the server as a monitor condition; repeatable",
+    )
+    showp.add_argument("-s", "--sort", help="Sort by column, prefix with '-' for descending order")
+    showp.add_argument(
+        "-o",
+        "--format",
+        choices=["table", "json", "ndjson"],
+        default="table",
+        help="Output format (default %(default)s)",
+    )
+    showp.add_argument("--merge", action="store_true", help="Fleet mode: one result with a node column")
     showp.set_defaults(func=handle_show)
+
+    watchp = sub.add_parser("watch", help="Stream row changes of a table as NDJSON")
+    watchp.add_argument("table", help="Table name")
+    watchp.add_argument("-c", "--columns", help="Comma-separated columns to watch (_uuid allowed)")
+    watchp.add_argument(
+        "-w",
+        "--where",
+        action="append",
+        help="Filter col=value or col!=value, pushed to the server as a monitor condition; repeatable",
+    )
+    watchp.add_argument(
+        "-i",
+        "--interval",
+        type=float,
+        default=0.0,
+        help="Emit at most once per interval seconds, coalescing changes in between (default %(default)s)",
+    )
+    watchp.add_argument(
+        "--changes-only",
+        action="store_true",
+        help="Do not emit the current rows as inserts on start",
+    )
+    watchp.set_defaults(func=handle_watch)
+
+    shellp = sub.add_parser("shell", help="Interactive shell over one synced connection")
+    shellp.set_defaults(func=handle_shell)
+
+    servep = sub.add_parser("serve", help="Keep one synced connection and accept commands on a unix socket")
+    servep.set_defaults(func=handle_serve)
     return parser
 
 
 def main():
     parser = build_parser()
     args = parser.parse_args()
+    nodes = fleet_remotes(args)
+    socket_path = forward_socket(args, nodes)
+    if socket_path:
+        stdin = sys.stdin.read() if args.cmd == "apply" and args.file == "-" else None
+        sys.exit(forward_command(socket_path, sys.argv[1:], stdin))
+    if args.remote is None:
+        args.remote = REMOTE
+    if args.cmd == "apply":
+        args.document = load_document(args.file)
+    if nodes:
+        if args.cmd in LOCAL_COMMANDS:
+            raise RuntimeError(f"{args.cmd} works with a single remote")
+        sys.exit(handle_fleet(args, nodes))
+    args.remote = normalize_remote(args.remote)
     args.func(args)
 
 
 if __name__ == "__main__":
     try:
         main()
+    except KeyboardInterrupt:
+        sys.exit(130)
+    except BrokenPipeError:
+        # watch | head: читатель закрыл канал
+        sys.exit(0)
     except Exception as exc:
         print(f"ERROR: {exc}", file=sys.stderr)
         sys.exit(1)
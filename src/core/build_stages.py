@@ -0,0 +1,325 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, TextIO, Tuple
+
+from core.interfaces import LoggerPort
+
+MANIFEST_VERSION = 1
+# Сколько этапов выполняется одновременно
+STAGE_WORKERS = 4
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+HASH_CHUNK = 1 << 20
+# Каталоги rootfs, в которые при сборке монтируются псевдо-ФС
+SNAPSHOT_SKIP = {"proc", "sys"}
+
+
+_current = threading.local()
+
+
+def stage_output() -> Optional[TextIO]:
+    """
+    Лог текущего этапа для вывода дочерних процессов (stdout=stage_output()).
+
+    Returns:
+        Открытый файл лога или None вне этапа (вывод идёт в консоль).
+    """
+    return getattr(_current, "log", None)
+
+
+class _StageLogHandler(logging.Handler):
+    """Дублирует записи logging в лог этапа, из потока которого они пришли."""
+
+    def emit(self, record: logging.LogRecord):
+        log = stage_output()
+        if log is None:
+            return
+        try:
+            log.write(self.format(record) + "\n")
+            log.flush()
+        except (OSError, ValueError):
+            pass
+
+
+def hash_inputs(items: Iterable) -> str:
+    """
+    sha256 входов этапа: файлы — по содержимому, каталоги — по именам и содержимому
+    всех файлов, остальное — по JSON-представлению.
+    """
+    digest = hashlib.sha256()
+    for item in items:
+        if isinstance(item, Path):
+            digest.update(f"path:{item}\0".encode())
+            if item.is_dir():
+                for root, dirs, files in os.walk(item):
+                    dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+                    for name in sorted(files):
+                        path = Path(root) / name
+                        digest.update(f"{path.relative_to(item)}\0".encode())
+                        _hash_file(path, digest)
+            elif item.exists():
+                _hash_file(item, digest)
+            else:
+                digest.update(b"missing\0")
+        else:
+            digest.update(json.dumps(item, sort_keys=True, default=str).encode() + b"\0")
+    return digest.hexdigest()
+
+
+def _hash_file(path: Path, digest):
+    if path.is_symlink():
+        digest.update(f"link:{os.readlink(path)}\0".encode())
+        return
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+
+
+def snapshot(rootfs_path: Path) -> Dict[str, Tuple[int, int, int]]:
+    """Путь в rootfs -> (тип, размер, mtime_ns) для всех файлов, ссылок и каталогов."""
+    result: Dict[str, Tuple[int, int, int]] = {}
+    if not rootfs_path.exists():
+        return result
+    for root, dirs, files in os.walk(rootfs_path):
+        rel_root = os.path.relpath(root, rootfs_path)
+        if rel_root == ".":
+            dirs[:] = [d for d in dirs if d not in SNAPSHOT_SKIP]
+        for name in dirs + files:
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            st = os.lstat(os.path.join(root, name))
+            result[rel] = (st.st_mode >> 12, st.st_size, st.st_mtime_ns)
+    return result
+
+
+@dataclass
+class Stage:
+    """
+    Этап сборки: функция и этапы, которые должны завершиться до неё.
+
+    Этап с inputs пишет в rootfs и кэшируется по манифесту; этап без inputs
+    (исходники и сборка ядра, загрузка пакетов) выполняется всегда и сам решает,
+    есть ли у него работа.
+    """
+    name: str
+    run: Callable[[], None]
+    inputs: Optional[Callable[[], Sequence]] = None
+    after: Tuple[str, ...] = ()
+    outputs: List[str] = field(default_factory=list)
+    status: str = "pending"
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+class StageRunner:
+    """
+    Сборка как граф этапов: независимые этапы идут параллельно (STAGE_WORKERS).
+
+    Этапы rootfs выполняются по одному: их результаты определяются по снимкам
+    rootfs до и после этапа. Для каждого такого этапа в манифесте хранится хеш
+    входов и список путей rootfs, которые он создал или изменил. Этап
+    пропускается, если хеш совпал, его результаты на месте и ни один этап rootfs
+    из after не пересобирался. Перед повторным запуском удаляются только его
+    прежние результаты.
+
+    Вывод каждого этапа (logging и дочерние процессы через stage_output())
+    пишется в log_dir/<этап>.log; в конце печатается критический путь.
+    """
+
+    def __init__(
+        self,
+        rootfs_path: Path,
+        manifest_path: Path,
+        logger: LoggerPort,
+        log_dir: Optional[Path] = None,
+        workers: int = STAGE_WORKERS,
+    ):
+        self.rootfs_path = Path(rootfs_path)
+        self.manifest_path = Path(manifest_path)
+        self.logger = logger
+        self.log_dir = Path(log_dir) if log_dir else None
+        self.workers = workers
+        self.stages: Dict[str, Stage] = {}
+        self._rootfs_lock = threading.Lock()
+        self._recorded: Dict[str, dict] = {}
+        self._start = 0.0
+
+    def add(
+        self,
+        name: str,
+        run: Callable[[], None],
+        inputs: Optional[Callable[[], Sequence]] = None,
+        after: Sequence[str] = (),
+    ):
+        unknown = [dep for dep in after if dep not in self.stages]
+        if unknown:
+            raise ValueError(f"Этап {name} зависит от неизвестных этапов: {', '.join(unknown)}")
+        self.stages[name] = Stage(name, run, inputs, tuple(after))
+
+    def load_manifest(self) -> Dict[str, dict]:
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}
+        return manifest.get("stages", {})
+
+    def save_manifest(self):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"version": MANIFEST_VERSION, "stages": self._recorded}, indent=2, sort_keys=True))
+        os.replace(tmp, self.manifest_path)
+
+    def _outputs_present(self, outputs: List[str]) -> bool:
+        return all(os.path.lexists(self.rootfs_path / rel) for rel in outputs)
+
+    def stale_reason(self, stage: Stage) -> Optional[str]:
+        """Почему этап rootfs нужно пересобрать; None — результаты актуальны."""
+        entry = self._recorded.get(stage.name)
+        if entry is None:
+            return "нет в манифесте"
+        if entry.get("hash") != hash_inputs(stage.inputs()):
+            return "изменились входы"
+        if not self._outputs_present(entry.get("outputs", [])):
+            return "результаты удалены"
+        rebuilt = [dep for dep in stage.after if self.stages[dep].inputs and self.stages[dep].status == "done"]
+        if rebuilt:
+            return "пересобран " + ", ".join(rebuilt)
+        return None
+
+    def remove_outputs(self, name: str) -> List[str]:
+        """
+        Удаляет прежние результаты этапа, кроме путей, которые записали и другие этапы.
+
+        Returns:
+            Оставленные пути: они по-прежнему числятся за этапом.
+        """
+        outputs = self._recorded.get(name, {}).get("outputs", [])
+        kept: Set[str] = set()
+        for other, entry in self._recorded.items():
+            if other != name:
+                kept.update(entry.get("outputs", []))
+        # Сначала файлы, затем каталоги от самых глубоких
+        for rel in sorted((p for p in outputs if p not in kept), key=lambda p: p.count("/"), reverse=True):
+            path = self.rootfs_path / rel
+            try:
+                if path.is_dir() and not path.is_symlink():
+                    path.rmdir()
+                else:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Непустой каталог: в нём остались результаты других этапов
+                pass
+        return [p for p in outputs if p in kept]
+
+    def _run_rootfs_stage(self, stage: Stage):
+        with self._rootfs_lock:
+            reason = self.stale_reason(stage)
+            if reason is None:
+                stage.status = "skipped"
+                self.logger.info(f"Этап {stage.name}: без изменений, пропущен")
+                return
+            self.logger.info(f"Этап {stage.name}: пересборка ({reason})")
+            previous = self.remove_outputs(stage.name)
+            # Прерванная сборка не должна оставить в манифесте старую запись этапа
+            self._recorded.pop(stage.name, None)
+            self.save_manifest()
+            before = snapshot(self.rootfs_path)
+            stage.run()
+            after = snapshot(self.rootfs_path)
+            changed = {rel for rel, sig in after.items() if before.get(rel) != sig}
+            kept = {rel for rel in previous if os.path.lexists(self.rootfs_path / rel)}
+            stage.outputs = sorted(changed | kept)
+            # Входы пересчитываются после этапа: он сам мог их обновить (packages.lock.json)
+            self._recorded[stage.name] = {"hash": hash_inputs(stage.inputs()), "outputs": stage.outputs}
+            self.save_manifest()
+            stage.status = "done"
+
+    def _execute(self, stage: Stage):
+        _current.log = None
+        if self.log_dir is not None:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            _current.log = open(self.log_dir / f"{stage.name}.log", "w")
+        stage.started = time.monotonic() - self._start
+        try:
+            if stage.inputs is None:
+                stage.run()
+                stage.status = "done"
+            else:
+                self._run_rootfs_stage(stage)
+        except BaseException:
+            stage.status = "failed"
+            raise
+        finally:
+            stage.finished = time.monotonic() - self._start
+            if _current.log is not None:
+                _current.log.close()
+                _current.log = None
+        if stage.status == "done":
+            self.logger.info(f"Этап {stage.name}: {stage.duration:.1f} с")
+
+    def run(self, force: bool = False):
+        """
+        Выполняет граф: этап стартует, как только завершились все этапы из after.
+
+        Raises:
+            Первую ошибку этапа; новые этапы после неё не запускаются.
+        """
+        self._recorded = {} if force else self.load_manifest()
+        self._start = time.monotonic()
+        handler = _StageLogHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logging.getLogger().addHandler(handler)
+        error: Optional[BaseException] = None
+        running: Dict[Future, Stage] = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="stage") as pool:
+                while True:
+                    if error is None:
+                        for stage in self.stages.values():
+                            ready = all(self.stages[dep].status in ("done", "skipped") for dep in stage.after)
+                            if stage.status == "pending" and ready:
+                                stage.status = "running"
+                                running[pool.submit(self._execute, stage)] = stage
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage = running.pop(future)
+                        if future.exception() is not None and error is None:
+                            error = future.exception()
+                            self.logger.error(f"Этап {stage.name} завершился ошибкой: {error}")
+        finally:
+            logging.getLogger().removeHandler(handler)
+        if error is not None:
+            raise error
+        self.logger.info(self.critical_path_report())
+
+    def critical_path(self) -> List[Stage]:
+        """Цепочка этапов, определившая время сборки: от последнего завершившегося назад по after."""
+        done = [s for s in self.stages.values() if s.status in ("done", "skipped")]
+        if not done:
+            return []
+        path = [max(done, key=lambda s: s.finished)]
+        while path[-1].after:
+            path.append(max((self.stages[dep] for dep in path[-1].after), key=lambda s: s.finished))
+        return path[::-1]
+
+    def critical_path_report(self) -> str:
+        path = self.critical_path()
+        total = max((s.finished for s in self.stages.values()), default=0.0)
+        busy = sum(s.duration for s in self.stages.values())
+        chain = " -> ".join(f"{s.name} {s.duration:.1f} с" for s in path)
+        return f"Критический путь: {chain}; сборка {total:.1f} с, суммарно по этапам {busy:.1f} с"
@@ -2,17 +2,31 @@ import os
 import platform
 import stat
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Set
+from core.copy_plan import CopyPlan, copy_file, is_up_to_date
+from core.elf_deps import ElfResolver
 from core.interfaces import FileSystemPort, LoggerPort, NetworkConfiguratorPort
-import shutil
 import subprocess
 
 class ContainerSetup:
 
-    def __init__(self, fs: FileSystemPort, logger: LoggerPort, network_configurator: NetworkConfiguratorPort):
+    def __init__(
+        self,
+        fs: FileSystemPort,
+        logger: LoggerPort,
+        network_configurator: NetworkConfiguratorPort,
+        sysroot: Path = Path("/"),
+        target_arch: Optional[str] = None,
+    ):
         self.fs = fs
         self.logger = logger
         self.network_configurator = network_configurator
+        # Откуда берутся бинарники и библиотеки: "/" или корень целевой системы при кросс-сборке
+        self.sysroot = Path(sysroot)
+        self.target_arch = target_arch
+        self.elf = ElfResolver(self.sysroot)
+        self.copy_plan = CopyPlan(self.sysroot)
+        self._reported_missing: Dict[str, Set[str]] = {}
 
     def setup_directories(self, rootfs_path: Path):
         directories = [
@@ -35,59 +49,31 @@ class ContainerSetup:
             rel_path = dest
         else:
             try:
-                rel_path = source.relative_to("/")
+                rel_path = source.relative_to(self.sysroot)
             except ValueError:
                 rel_path = source
 
         destination = rootfs_path / rel_path
         destination.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(source, destination)
+        if is_up_to_date(source, destination):
+            return
+        copy_file(source, destination)
         self.logger.info(f"Скопирован файл: {source} -> {destination}")
 
-    def _ldd_dependencies(self, path: Path) -> set[Path]:
-        """Возвращает список зависимостей, найденных через ldd."""
-        deps = set()
-        try:
-            result = subprocess.run(["ldd", str(path)], capture_output=True, text=True, check=True)
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"ldd вернул ошибку для {path}: {e}")
-            return deps
-
-        for line in result.stdout.splitlines():
-            line = line.strip()
-            # Форматы строк ldd: "libc.so.6 => /lib/... (0x..)" или "/lib/... (0x..)"
-            if "=>" in line:
-                candidate = line.split("=>", 1)[1].strip().split()[0]
-            else:
-                candidate = line.split()[0] if line.startswith("/") else None
-
-            if candidate:
-                candidate_path = Path(candidate)
-                if candidate_path.exists():
-                    deps.add(candidate_path)
-                else:
-                    self.logger.error(f"Зависимость {candidate} не найдена для {path}")
+    def _execute_copy_plan(self, rootfs_path: Path):
+        """Копирует накопленный план одним параллельным проходом и печатает итог."""
+        stats = self.copy_plan.execute(rootfs_path, self.logger)
+        self.logger.info(f"Копирование в rootfs: {stats.summary()}")
+
+    def _collect_recursive_dependencies(self, initial: Path) -> Set[Path]:
+        """Ищет зависимости бинарника и их зависимости рекурсивно (ElfResolver, без ldd)."""
+        deps = self.elf.dependencies(initial)
+        for target, names in self.elf.missing.items():
+            for name in sorted(names - self._reported_missing.get(target, set())):
+                self.logger.error(f"Зависимость {name} не найдена для {target}")
+            self._reported_missing.setdefault(target, set()).update(names)
         return deps
 
-    def _collect_recursive_dependencies(self, initial: Path) -> set[Path]:
-        """Ищет зависимости бинарника и их зависимости рекурсивно через ldd."""
-        to_process = [initial]
-        seen = set()
-        all_deps = set()
-
-        while to_process:
-            current = to_process.pop()
-            if current in seen:
-                continue
-            seen.add(current)
-            deps = self._ldd_dependencies(current)
-            for dep in deps:
-                if dep not in seen:
-                    to_process.append(dep)
-                all_deps.add(dep)
-
-        return all_deps
-
     def write_base_configs(self, rootfs_path: Path, hostname: str = "litainer"):
         """Создаёт базовые системные конфиги в rootfs."""
         fstab = """proc /proc proc defaults 0 0
@@ -129,7 +115,7 @@ tmpfs /tmp tmpfs defaults 0 0
         """
         Возвращает пути системных библиотек на основе архитектуры.
         """
-        arch = platform.machine()
+        arch = self.target_arch or platform.machine()
         if arch == "x86_64":
             return [
                 Path("/lib/x86_64-linux-gnu/libc.so.6"),
@@ -151,37 +137,41 @@ tmpfs /tmp tmpfs defaults 0 0
         else:
             raise ValueError(f"Неизвестная архитектура: {arch}")
 
+    def _system_library(self, path: Path) -> Path:
+        """Путь библиотеки в sysroot как есть: ссылки по нему переносит CopyPlan."""
+        return self.sysroot / str(path).lstrip("/")
+
     def copy_system_libraries(self, rootfs_path: Path):
-        libraries = self.get_library_paths()
+        libraries = [self._system_library(lib) for lib in self.get_library_paths()]
         for lib in libraries:
-            if not lib.exists():
+            if not self.elf.exists(lib):
                 self.logger.error(f"Библиотека не найдена: {lib}")
                 continue
-            self._copy_to_rootfs(lib, rootfs_path)
+            self.copy_plan.add(lib)
             deps = self._collect_recursive_dependencies(lib)
             for dep in deps:
-                if dep.exists():
-                    self._copy_to_rootfs(dep, rootfs_path)
+                if self.elf.exists(dep):
+                    self.copy_plan.add(dep)
                 else:
                     self.logger.error(f"Зависимость {dep} не найдена для {lib}")
+        self._execute_copy_plan(rootfs_path)
 
-    def copy_binaries_and_dependencies(self, rootfs_path: Path, binaries: list[str]):
+    def copy_binaries_and_dependencies(self, rootfs_path: Path, binaries: List[str]):
         for binary in binaries:
             # Найти путь к бинарнику
-            result = subprocess.run(["which", binary], capture_output=True, text=True)
-            binary_path = result.stdout.strip()
-            if not binary_path or not Path(binary_path).exists():
+            binary_path = self.elf.find_binary(binary)
+            if binary_path is None:
                 self.logger.error(f"Бинарник {binary} не найден!")
                 continue
             # Копировать бинарник
-            binary_path = Path(binary_path)
-            self._copy_to_rootfs(binary_path, rootfs_path)
+            self.copy_plan.add(binary_path)
             deps = self._collect_recursive_dependencies(binary_path)
             for dep in deps:
-                if dep.exists():
-                    self._copy_to_rootfs(dep, rootfs_path)
+                if self.elf.exists(dep):
+                    self.copy_plan.add(dep)
                 else:
                     self.logger.error(f"Зависимость {dep} не найдена!")
+        self._execute_copy_plan(rootfs_path)
 
     def install_ovsdb_assets(
         self,
@@ -192,8 +182,9 @@ tmpfs /tmp tmpfs defaults 0 0
         vm_agent: Optional[Path] = None,
         stat_agent: Optional[Path] = None,
         cli_tool: Optional[Path] = None,
+        agent_libs: Optional[List[Path]] = None,
     ):
-        """Копирует схему OVSDB и агентов, создаёт init-скрипт для запуска."""
+        """Копирует схему OVSDB, агентов и их общие модули, создаёт init-скрипт для запуска."""
         if not schema_src.exists():
             self.logger.error(f"Файл схемы не найден: {schema_src}")
             return
@@ -219,6 +210,13 @@ tmpfs /tmp tmpfs defaults 0 0
             self._copy_to_rootfs(path, rootfs_path, Path("usr/local/sbin") / path.name)
             target.chmod(0o755)
 
+        # Общие модули (sysdb.py) — рядом с агентами, чтобы импортироваться без sys.path
+        for lib in agent_libs or []:
+            if lib.exists():
+                self._copy_to_rootfs(lib, rootfs_path, Path("usr/local/sbin") / lib.name)
+            else:
+                self.logger.error(f"Модуль агентов не найден: {lib}")
+
         if cli_tool and cli_tool.exists():
             self._copy_to_rootfs(cli_tool, rootfs_path, Path("usr/local/bin/cli.py"))
             (rootfs_path / "usr/local/bin/cli.py").chmod(0o755)
@@ -252,6 +250,8 @@ mkdir -p "$OVS_RUNDIR" "$OVS_DBDIR" "$OVS_LOGDIR"
 
 if [ ! -f "$DB" ]; then
     ovsdb-tool create "$DB" "$SCHEMA"
+elif ovsdb-tool needs-conversion "$DB" "$SCHEMA" | grep -q yes; then
+    ovsdb-tool convert "$DB" "$SCHEMA"
 fi
 
 ovsdb-server \
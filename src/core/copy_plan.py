@@ -0,0 +1,240 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+from core.elf_deps import sysroot_path
+
+# Сколько файлов копируется одновременно
+COPY_WORKERS = min(8, os.cpu_count() or 1)
+# ioctl FICLONE: reflink всего файла (btrfs, xfs, overlayfs поверх них)
+FICLONE = 0x40049409
+COPY_CHUNK = 1 << 30
+HASH_CHUNK = 1 << 20
+MAX_SYMLINKS = 40
+
+
+@dataclass
+class CopyStats:
+    """Итог выполнения плана копирования."""
+    files: int = 0
+    links: int = 0
+    reflinked: int = 0
+    unchanged: int = 0
+    duplicates: int = 0
+    bytes_copied: int = 0
+    bytes_reflinked: int = 0
+    bytes_unchanged: int = 0
+    bytes_duplicate: int = 0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_reflinked + self.bytes_unchanged + self.bytes_duplicate
+
+    def summary(self) -> str:
+        mib = 1 << 20
+        return (
+            f"скопировано {self.files} файлов ({self.bytes_copied / mib:.1f} МБ), "
+            f"reflink {self.reflinked} ({self.bytes_reflinked / mib:.1f} МБ), "
+            f"без изменений {self.unchanged} ({self.bytes_unchanged / mib:.1f} МБ), "
+            f"повторов в плане {self.duplicates} ({self.bytes_duplicate / mib:.1f} МБ), "
+            f"ссылок {self.links}; сэкономлено {self.bytes_saved / mib:.1f} МБ"
+        )
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_up_to_date(source: Path, destination: Path) -> bool:
+    """
+    Совпадает ли destination с source: размер и mtime, а при другом mtime — sha256.
+
+    Returns:
+        True, если копировать не нужно.
+    """
+    try:
+        dst = os.lstat(destination)
+    except FileNotFoundError:
+        return False
+    if not os.path.isfile(destination) or os.path.islink(destination):
+        return False
+    src = os.stat(source)
+    if src.st_size != dst.st_size:
+        return False
+    if src.st_mtime_ns == dst.st_mtime_ns:
+        return True
+    if _file_hash(source) != _file_hash(destination):
+        return False
+    shutil.copystat(source, destination)
+    return True
+
+
+def copy_file(source: Path, destination: Path) -> bool:
+    """
+    Копирует файл с правами и временами: FICLONE, затем copy_file_range, затем обычное чтение.
+
+    Файл пишется во временный рядом и атомарно подменяет destination.
+
+    Returns:
+        True, если данные разделены через reflink, а не скопированы.
+    """
+    tmp = destination.with_name(f".{destination.name}.{threading.get_ident()}.tmp")
+    reflinked = False
+    with open(source, "rb") as src, open(tmp, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            reflinked = True
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EPERM):
+                raise
+            _copy_range(src, dst)
+    shutil.copystat(source, tmp)
+    os.replace(tmp, destination)
+    return reflinked
+
+
+def _copy_range(src, dst):
+    """Копирование внутри ядра; без copy_file_range — через буфер."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK):
+                pass
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+    shutil.copyfileobj(src, dst, HASH_CHUNK)
+
+
+class CopyPlan:
+    """
+    План наполнения rootfs: сначала собирается полный набор файлов, затем одно
+    параллельное копирование.
+
+    Каждый путь назначения копируется один раз, сколько бы бинарников от него ни
+    зависело; цепочки symlink (libfoo.so.1 -> libfoo.so.1.2.3) переносятся как
+    ссылки, а не как отдельные копии файла.
+    """
+
+    def __init__(self, sysroot: Path = Path("/")):
+        self.sysroot = Path(sysroot)
+        self.files: Dict[Path, Path] = {}
+        self.links: Dict[Path, str] = {}
+        # Уже выполненные пути: повторные execute() их не копируют
+        self.done: Set[Path] = set()
+        self.duplicates = 0
+        self.bytes_duplicate = 0
+
+    def _relative(self, source: Path) -> Path:
+        try:
+            return source.relative_to(self.sysroot)
+        except ValueError:
+            return Path(str(source).lstrip("/"))
+
+    def add(self, source: Path, dest: Optional[Path] = None):
+        """
+        Добавляет файл в план.
+
+        Ссылки в пути читаются внутри sysroot (sysroot_path): абсолютная ссылка
+        /lib64/ld-linux-x86-64.so.2 -> /lib/... ведёт в sysroot, а не на хост.
+
+        Args:
+            source: Путь на хосте (внутри sysroot).
+            dest: Путь в rootfs; по умолчанию совпадает с путём в sysroot.
+        """
+        source = Path(source)
+        if dest is not None:
+            self._add_file(Path(dest), source)
+            return
+        rel = self._relative(source)
+        for _ in range(MAX_SYMLINKS):
+            host = sysroot_path(self.sysroot, "/" + str(rel), follow=False)
+            if not host.is_symlink():
+                break
+            if self._planned(rel, host):
+                return
+            link = os.readlink(host)
+            self.links[rel] = link
+            target = link if link.startswith("/") else os.path.join("/", str(rel.parent), link)
+            rel = Path(os.path.normpath(target).lstrip("/"))
+        self._add_file(rel, sysroot_path(self.sysroot, "/" + str(rel)))
+
+    def _planned(self, rel: Path, source: Path) -> bool:
+        """Уже ли rel в плане; повтор учитывается в статистике."""
+        if rel not in self.files and rel not in self.links and rel not in self.done:
+            return False
+        self.duplicates += 1
+        if not source.is_symlink():
+            self.bytes_duplicate += os.stat(source).st_size
+        return True
+
+    def _add_file(self, rel: Path, source: Path):
+        if not self._planned(rel, source):
+            self.files[rel] = source
+
+    def execute(self, rootfs_path: Path, logger=None, workers: int = COPY_WORKERS) -> CopyStats:
+        """
+        Выполняет план: файлы параллельно, затем ссылки.
+
+        Returns:
+            CopyStats с байтами скопированными и сэкономленными.
+        """
+        stats = CopyStats(duplicates=self.duplicates, bytes_duplicate=self.bytes_duplicate)
+        lock = threading.Lock()
+        for rel in list(self.files) + list(self.links):
+            (rootfs_path / rel).parent.mkdir(parents=True, exist_ok=True)
+
+        def copy_one(rel: Path, source: Path):
+            destination = rootfs_path / rel
+            size = os.stat(source).st_size
+            if is_up_to_date(source, destination):
+                with lock:
+                    stats.unchanged += 1
+                    stats.bytes_unchanged += size
+                return
+            if os.path.islink(destination):
+                os.unlink(destination)
+            reflinked = copy_file(source, destination)
+            with lock:
+                if reflinked:
+                    stats.reflinked += 1
+                    stats.bytes_reflinked += size
+                else:
+                    stats.files += 1
+                    stats.bytes_copied += size
+            if logger is not None:
+                logger.info(f"Скопирован файл: {source} -> {destination}")
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(copy_one, rel, source) for rel, source in self.files.items()]
+            for future in futures:
+                future.result()
+
+        for rel, link in self.links.items():
+            destination = rootfs_path / rel
+            if os.path.islink(destination) and os.readlink(destination) == link:
+                continue
+            if os.path.lexists(destination):
+                os.unlink(destination)
+            os.symlink(link, destination)
+            stats.links += 1
+        self.done.update(self.files)
+        self.done.update(self.links)
+        self.files.clear()
+        self.links.clear()
+        self.duplicates = self.bytes_duplicate = 0
+        return stats
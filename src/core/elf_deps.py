@@ -0,0 +1,302 @@
+import glob
+import os
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+ELF_MAGIC = b"\x7fELF"
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+# e_machine -> каталог multiarch
+MULTIARCH = {
+    3: "i386-linux-gnu",
+    40: "arm-linux-gnueabihf",
+    62: "x86_64-linux-gnu",
+    183: "aarch64-linux-gnu",
+}
+DEFAULT_LIB_DIRS = ["/lib", "/usr/lib", "/lib64", "/usr/lib64"]
+MAX_SYMLINKS = 40
+
+
+@dataclass(frozen=True)
+class ElfInfo:
+    """Сведения динамической компоновки одного ELF-файла."""
+    machine: int
+    elf_class: int
+    interp: Optional[str]
+    needed: Tuple[str, ...]
+    rpath: Tuple[str, ...]
+    runpath: Tuple[str, ...]
+
+
+def read_elf(path: Path) -> Optional[ElfInfo]:
+    """
+    Читает PT_INTERP и DT_NEEDED/RPATH/RUNPATH без запуска ldd.
+
+    Читаются только заголовки, сегмент DYNAMIC и нужные строки, поэтому годится
+    для ELF любой архитектуры (aarch64 на x86_64-хосте).
+
+    Returns:
+        ElfInfo или None, если файл не ELF.
+    """
+    with open(path, "rb") as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            return None
+        elf_class = ident[4]
+        endian = "<" if ident[5] == 1 else ">"
+        # e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize, e_phnum
+        if elf_class == 2:
+            header = struct.unpack_from(endian + "HHIQQQIHHH", f.read(48))
+            phdr_format, dyn_format = endian + "IIQQQQQQ", endian + "qQ"
+        else:
+            header = struct.unpack_from(endian + "HHIIIIIHHH", f.read(36))
+            phdr_format, dyn_format = endian + "IIIIIIII", endian + "iI"
+        machine, phoff, phentsize, phnum = header[1], header[4], header[8], header[9]
+
+        f.seek(phoff)
+        table = f.read(phentsize * phnum)
+        loads = []
+        dynamic = None
+        interp = None
+        for i in range(phnum):
+            fields = struct.unpack_from(phdr_format, table, i * phentsize)
+            if elf_class == 2:
+                p_type, _, offset, vaddr, _, filesz = fields[:6]
+            else:
+                p_type, offset, vaddr, _, filesz = fields[:5]
+            if p_type == PT_LOAD:
+                loads.append((vaddr, offset, filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (offset, filesz)
+            elif p_type == PT_INTERP:
+                f.seek(offset)
+                interp = f.read(filesz).split(b"\0", 1)[0].decode()
+
+        if dynamic is None:
+            return ElfInfo(machine, elf_class, interp, (), (), ())
+        f.seek(dynamic[0])
+        raw = f.read(dynamic[1])
+        entries = []
+        strtab = None
+        for tag, value in struct.iter_unpack(dyn_format, raw[: len(raw) - len(raw) % struct.calcsize(dyn_format)]):
+            if tag == DT_NULL:
+                break
+            if tag == DT_STRTAB:
+                strtab = value
+            elif tag in (DT_NEEDED, DT_RPATH, DT_RUNPATH):
+                entries.append((tag, value))
+        if strtab is None:
+            return ElfInfo(machine, elf_class, interp, (), (), ())
+        # DT_STRTAB — виртуальный адрес, переводим в смещение в файле
+        for vaddr, offset, filesz in loads:
+            if vaddr <= strtab < vaddr + filesz:
+                strtab_offset = strtab - vaddr + offset
+                break
+        else:
+            return ElfInfo(machine, elf_class, interp, (), (), ())
+
+        def string(index: int) -> str:
+            f.seek(strtab_offset + index)
+            chunk = b""
+            while b"\0" not in chunk:
+                block = f.read(256)
+                if not block:
+                    break
+                chunk += block
+            return chunk.split(b"\0", 1)[0].decode()
+
+        needed, rpath, runpath = [], [], []
+        for tag, value in entries:
+            text = string(value)
+            if tag == DT_NEEDED:
+                needed.append(text)
+            elif tag == DT_RPATH:
+                rpath.extend(p for p in text.split(":") if p)
+            else:
+                runpath.extend(p for p in text.split(":") if p)
+    return ElfInfo(machine, elf_class, interp, tuple(needed), tuple(rpath), tuple(runpath))
+
+
+def sysroot_path(sysroot: Path, target: str, follow: bool = True) -> Path:
+    """
+    Путь target целевой системы -> путь на хосте внутри sysroot.
+
+    Ссылки разрешаются покомпонентно, абсолютные — от sysroot, поэтому
+    /lib -> /usr/lib или /lib64/ld-linux.so -> /lib/... не уводят на хост.
+
+    Args:
+        follow: Разрешать ли ссылку в последнем компоненте.
+    """
+    sysroot = Path(sysroot)
+    if sysroot == Path("/"):
+        return Path(target)
+    parts = [p for p in target.split("/") if p]
+    resolved = "/"
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == ".":
+            continue
+        if part == "..":
+            resolved = os.path.dirname(resolved)
+            continue
+        candidate = os.path.join(resolved, part)
+        host = sysroot / candidate.lstrip("/")
+        if (parts or follow) and links < MAX_SYMLINKS and host.is_symlink():
+            links += 1
+            link = os.readlink(host)
+            if link.startswith("/"):
+                resolved = "/"
+            parts = [p for p in link.split("/") if p] + parts
+            continue
+        resolved = candidate
+    return sysroot / resolved.lstrip("/")
+
+
+class ElfResolver:
+    """
+    Разрешает зависимости ELF относительно sysroot по правилам ld.so:
+    RPATH (если нет RUNPATH), RUNPATH, ld.so.conf, стандартные каталоги.
+
+    Результаты кэшируются на всю сборку: каждый файл читается один раз, а
+    замыкание зависимостей библиотеки считается один раз для всех бинарников.
+    """
+
+    def __init__(self, sysroot: Path = Path("/")):
+        self.sysroot = Path(sysroot)
+        self._info: Dict[str, Optional[ElfInfo]] = {}
+        self._direct: Dict[str, List[str]] = {}
+        self._closure: Dict[str, Set[str]] = {}
+        self._ld_conf_dirs: Optional[List[str]] = None
+        self.missing: Dict[str, Set[str]] = {}
+
+    def host_path(self, target: str) -> Path:
+        """Путь внутри целевой системы -> путь на хосте; абсолютные ссылки остаются в sysroot."""
+        return sysroot_path(self.sysroot, target)
+
+    def exists(self, host: Path) -> bool:
+        """Есть ли файл host (внутри sysroot) с учётом ссылок целевой системы."""
+        return self.host_path(self.target_path(host)).exists()
+
+    def target_path(self, host: Path) -> str:
+        return "/" + str(Path(host).relative_to(self.sysroot)).lstrip("/") if self.sysroot != Path("/") else str(host)
+
+    def info(self, target: str) -> Optional[ElfInfo]:
+        if target not in self._info:
+            try:
+                self._info[target] = read_elf(self.host_path(target))
+            except (OSError, struct.error, UnicodeDecodeError):
+                self._info[target] = None
+        return self._info[target]
+
+    def ld_conf_dirs(self) -> List[str]:
+        """Каталоги из /etc/ld.so.conf (с include) целевой системы."""
+        if self._ld_conf_dirs is None:
+            dirs: List[str] = []
+            self._read_ld_conf("/etc/ld.so.conf", dirs, set())
+            self._ld_conf_dirs = dirs
+        return self._ld_conf_dirs
+
+    def _read_ld_conf(self, target: str, dirs: List[str], seen: Set[str]):
+        if target in seen:
+            return
+        seen.add(target)
+        try:
+            lines = self.host_path(target).read_text().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith("include "):
+                pattern = line.split(None, 1)[1]
+                if not pattern.startswith("/"):
+                    pattern = os.path.join(os.path.dirname(target), pattern)
+                for match in sorted(glob.glob(str(self.sysroot / pattern.lstrip("/")))):
+                    self._read_ld_conf(self.target_path(Path(match)), dirs, seen)
+            elif line not in dirs:
+                dirs.append(line)
+
+    def search_dirs(self, target: str, info: ElfInfo) -> List[str]:
+        origin = os.path.dirname(target)
+        own = list(info.runpath) if info.runpath else list(info.rpath)
+        own = [d.replace("$ORIGIN", origin).replace("${ORIGIN}", origin) for d in own]
+        multiarch = MULTIARCH.get(info.machine)
+        defaults = [f"/lib/{multiarch}", f"/usr/lib/{multiarch}"] if multiarch else []
+        return own + self.ld_conf_dirs() + defaults + DEFAULT_LIB_DIRS
+
+    def find_library(self, name: str, target: str, info: ElfInfo) -> Optional[str]:
+        """Путь библиотеки name для объекта target той же архитектуры и разрядности."""
+        if "/" in name:
+            return name
+        for directory in self.search_dirs(target, info):
+            candidate = os.path.join(directory, name)
+            if not self.host_path(candidate).exists():
+                continue
+            found = self.info(candidate)
+            if found is not None and found.machine == info.machine and found.elf_class == info.elf_class:
+                return candidate
+        return None
+
+    def direct_dependencies(self, target: str) -> List[str]:
+        if target not in self._direct:
+            info = self.info(target)
+            deps: List[str] = []
+            if info is not None:
+                if info.interp:
+                    deps.append(info.interp)
+                for name in info.needed:
+                    found = self.find_library(name, target, info)
+                    if found is None:
+                        self.missing.setdefault(target, set()).add(name)
+                    else:
+                        deps.append(found)
+            self._direct[target] = deps
+        return self._direct[target]
+
+    def dependencies(self, host: Path) -> Set[Path]:
+        """
+        Все зависимости файла (рекурсивно), как пути на хосте.
+
+        Пути остаются такими, как их записали PT_INTERP и каталоги поиска
+        (/lib64/ld-linux-x86-64.so.2, soname-ссылки): ссылки по ним переносит
+        CopyPlan. Проверять их наличие нужно через exists().
+
+        Args:
+            host: Путь к ELF-файлу на хосте (внутри sysroot).
+        """
+        root = self.target_path(host)
+        if root not in self._closure:
+            closure: Set[str] = set()
+            stack = [root]
+            while stack:
+                current = stack.pop()
+                for dep in self.direct_dependencies(current):
+                    if dep in closure:
+                        continue
+                    closure.add(dep)
+                    if dep in self._closure:
+                        closure.update(self._closure[dep])
+                    else:
+                        stack.append(dep)
+            self._closure[root] = closure
+        return {self.sysroot / dep.lstrip("/") for dep in self._closure[root]}
+
+    def find_binary(self, name: str, path: Tuple[str, ...] = (
+        "/usr/local/sbin", "/usr/local/bin", "/usr/sbin", "/usr/bin", "/sbin", "/bin",
+    )) -> Optional[Path]:
+        """Аналог which внутри sysroot."""
+        for directory in path:
+            host = self.host_path(os.path.join(directory, name))
+            if host.is_file() and os.access(host, os.X_OK):
+                return self.sysroot / directory.lstrip("/") / name
+        return None
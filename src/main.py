@@ -1,3 +1,6 @@
+import os
+import platform
+from core.build_stages import StageRunner
 from core.container_setup import ContainerSetup
 from adapters.file_adapter import FileAdapter
 from adapters.logging_adapter import LoggingAdapter
@@ -6,6 +9,7 @@ from adapters.package_installer import PackageInstaller, install_dependencies
 from adapters.linux_kernel import LinuxKernel
 from make_image import create_img
 from pathlib import Path
+from typing import List
 
 
 # Определение абсолютных путей
@@ -14,79 +18,201 @@ PROJECT_ROOT = SCRIPT_DIR.parent
 TEMP_PATH = PROJECT_ROOT / "temp"
 ROOTFS_PATH = PROJECT_ROOT / "container"
 RPI_MODEL = "bcm2711_defconfig"
+# DTB, которые собираются и ставятся: платы семейства RPI_MODEL и Pi 3B+ для QEMU (raspi3b)
+KERNEL_DTBS = ["broadcom/bcm2711-rpi-*", "broadcom/bcm2710-rpi-3-b-plus"]
+# Оверлеи из config.txt
+KERNEL_OVERLAYS: List[str] = []
+# Профиль ядра (фрагменты src/kernel/fragments): hypervisor, storage или full
+KERNEL_PROFILE = os.environ.get("KERNEL_PROFILE", "full")
+# Вывод lsmod с эталонной загрузки: если задан, неиспользуемые модули отключаются
+KERNEL_MODULE_MANIFEST = os.environ.get("KERNEL_MODULE_MANIFEST")
 SCHEMA_PATH = SCRIPT_DIR / "schema" / "system.ovsschema"
 NET_AGENT_PATH = SCRIPT_DIR / "agents" / "net_agent.py"
 STORAGE_AGENT_PATH = SCRIPT_DIR / "agents" / "storage_agent.py"
 VM_AGENT_PATH = SCRIPT_DIR / "agents" / "vm_agent.py"
 STAT_AGENT_PATH = SCRIPT_DIR / "agents" / "stat_agent.py"
+SYSDB_LIB_PATH = SCRIPT_DIR / "agents" / "sysdb.py"
 CLI_PATH = SCRIPT_DIR / "cli.py"
+# Пути пакетов, которые не нужны в rootfs
+PACKAGE_EXCLUDE = ["usr/share/doc/*", "usr/share/man/*", "usr/share/info/*"]
+PACKAGE_ARCH = "arm64"
+# Архитектура Debian -> platform.machine() целевой системы
+DEBIAN_MACHINES = {"arm64": "aarch64", "amd64": "x86_64"}
+TARGET_MACHINE = DEBIAN_MACHINES.get(PACKAGE_ARCH, PACKAGE_ARCH)
+# Откуда берутся BINARIES и системные библиотеки: корень хоста, если архитектуры
+# совпадают, иначе sysroot целевой системы (по умолчанию — сам rootfs с пакетами)
+TARGET_SYSROOT = Path(os.environ.get(
+    "TARGET_SYSROOT",
+    "/" if platform.machine() == TARGET_MACHINE else str(ROOTFS_PATH),
+))
+PACKAGES_LOCK = PROJECT_ROOT / "packages.lock.json"
+# Зависимости для maintainer-скриптов: в rootfs они не запускаются
+PACKAGE_SKIP = ["debconf", "dpkg", "init-system-helpers", "perl-base"]
+HOSTNAME = "litainer"
+# Пакеты для установки в rootfs
+PACKAGES = [
+    "bash",
+    "coreutils",
+    "curl",
+    "vim",
+    "iproute2",
+    "openvswitch-common",
+    "openvswitch-switch",
+    "python3-ovs",
+    # YAML-документы cli.py apply
+    "python3-yaml",
+    "qemu-system-aarch64",
+    "iscsitarget",
+    "dmsetup",
+    "socat",
+]
+# Бинарники хоста, которые копируются в rootfs вместе с зависимостями
+BINARIES = [
+    "bash",
+    "coreutils",
+    "curl",
+    "vim",
+    "ip",
+    "ldd",
+    "ovsdb-server",
+    "ovs-vsctl",
+    "ovs-vswitchd",
+    "python3",
+]
+# Манифест инкрементальной сборки rootfs: хеши входов и результаты этапов
+BUILD_MANIFEST = TEMP_PATH / "rootfs.manifest.json"
+# Код, от которого зависит копирование файлов хоста в rootfs
+COPY_SOURCES = [SCRIPT_DIR / "core" / name for name in ("container_setup.py", "copy_plan.py", "elf_deps.py")]
+# Логи этапов сборки: temp/logs/<этап>.log
+BUILD_LOGS = TEMP_PATH / "logs"
+# BUILD_CLEAN=1 — собрать rootfs с нуля
+BUILD_CLEAN = os.environ.get("BUILD_CLEAN", "") not in ("", "0")
 
 if __name__ == "__main__":
     # Инициализация адаптеров
     file_adapter = FileAdapter(ROOTFS_PATH)
     logging_adapter = LoggingAdapter()
     network_adapter = NetworkAdapter()
-    linux_kernel = LinuxKernel(TEMP_PATH, RPI_MODEL, ROOTFS_PATH)
-    package_installer = PackageInstaller(TEMP_PATH, ROOTFS_PATH)
+    linux_kernel = LinuxKernel(
+        TEMP_PATH,
+        RPI_MODEL,
+        ROOTFS_PATH,
+        dtbs=KERNEL_DTBS,
+        overlays=KERNEL_OVERLAYS,
+        profile=KERNEL_PROFILE,
+        module_manifest=KERNEL_MODULE_MANIFEST,
+    )
+    package_installer = PackageInstaller(
+        TEMP_PATH,
+        ROOTFS_PATH,
+        exclude=PACKAGE_EXCLUDE,
+        arch=PACKAGE_ARCH,
+        lock_path=PACKAGES_LOCK,
+        skip_packages=PACKAGE_SKIP,
+    )
 
-    file_adapter.clear_container()
+    if BUILD_CLEAN or not BUILD_MANIFEST.exists():
+        file_adapter.clear_container()
+        BUILD_MANIFEST.unlink(missing_ok=True)
     ROOTFS_PATH.mkdir(parents=True, exist_ok=True)
     print('_______________')
     # Инициализация контейнера
-    setup = ContainerSetup(file_adapter, logging_adapter, network_adapter)
-    linux_kernel.download_kernel()
-    linux_kernel.unpack_kernel()
-    install_dependencies()
-    linux_kernel.configure_kernel()
-    linux_kernel.compile_kernel()
-    # Настройка контейнера
-    setup.setup_directories(ROOTFS_PATH)
-    setup.write_base_configs(ROOTFS_PATH, hostname="litainer")
-    try:
-        setup.copy_system_libraries(ROOTFS_PATH)
-    except ValueError as e:
-        logging_adapter.error(str(e))
-    setup.setup_network(ROOTFS_PATH)
-    setup.create_dev_nodes(ROOTFS_PATH)
-    linux_kernel.install_kernel()
+    setup = ContainerSetup(
+        file_adapter, logging_adapter, network_adapter,
+        sysroot=TARGET_SYSROOT, target_arch=TARGET_MACHINE,
+    )
 
-    # Список пакетов для установки
-    packages = [
-        "bash",
-        "coreutils",
-        "curl",
-        "vim",
-        "iproute2",
-        "openvswitch-common",
-        "openvswitch-switch",
-        "python3-ovs",
-        "qemu-system-aarch64",
-        "iscsitarget",
-        "socat",
-    ]
-    package_installer.install_base_packages(packages)
-    binaries = [
-        "bash",
-        "coreutils",
-        "curl",
-        "vim",
-        "ip",
-        "ldd",
-        "ovsdb-server",
-        "ovs-vsctl",
-        "ovs-vswitchd",
-        "python3",
-    ]
-    setup.copy_binaries_and_dependencies(ROOTFS_PATH, binaries)
-    setup.install_ovsdb_assets(
-        ROOTFS_PATH,
-        SCHEMA_PATH,
-        NET_AGENT_PATH,
-        storage_agent=STORAGE_AGENT_PATH,
-        vm_agent=VM_AGENT_PATH,
-        stat_agent=STAT_AGENT_PATH,
-        cli_tool=CLI_PATH,
+    def download_kernel():
+        linux_kernel.download_kernel()
+        linux_kernel.unpack_kernel()
+
+    def setup_base():
+        setup.setup_directories(ROOTFS_PATH)
+        setup.write_base_configs(ROOTFS_PATH, hostname=HOSTNAME)
+        setup.setup_network(ROOTFS_PATH)
+        setup.create_dev_nodes(ROOTFS_PATH)
+
+    def copy_system_libraries():
+        try:
+            setup.copy_system_libraries(ROOTFS_PATH)
+        except ValueError as e:
+            logging_adapter.error(str(e))
+
+    def install_ovsdb_assets():
+        setup.install_ovsdb_assets(
+            ROOTFS_PATH,
+            SCHEMA_PATH,
+            NET_AGENT_PATH,
+            storage_agent=STORAGE_AGENT_PATH,
+            vm_agent=VM_AGENT_PATH,
+            stat_agent=STAT_AGENT_PATH,
+            cli_tool=CLI_PATH,
+            agent_libs=[SYSDB_LIB_PATH],
+        )
+
+    def host_files(paths):
+        """Файлы хоста и все их зависимости — входы этапов копирования."""
+        files = set()
+        for path in paths:
+            if path is not None and setup.elf.exists(path):
+                files.add(path)
+                for dep in setup.elf.dependencies(path):
+                    # И путь как есть (ссылка), и файл, на который он указывает в sysroot
+                    files.add(dep)
+                    files.add(setup.elf.host_path(setup.elf.target_path(dep)))
+        return sorted(files)
+
+    def system_library_inputs():
+        try:
+            libraries = [setup._system_library(lib) for lib in setup.get_library_paths()]
+        except ValueError:
+            libraries = []
+        return COPY_SOURCES + host_files(libraries)
+
+    # Граф сборки: независимые этапы идут параллельно (пакеты и rootfs — пока
+    # собирается ядро); этапы rootfs пропускаются, если их входы не изменились
+    stages = StageRunner(ROOTFS_PATH, BUILD_MANIFEST, logging_adapter, log_dir=BUILD_LOGS)
+    stages.add("kernel_download", download_kernel)
+    stages.add("build_deps", install_dependencies)
+    stages.add("kernel_configure", linux_kernel.configure_kernel, after=["kernel_download", "build_deps"])
+    stages.add("kernel_compile", linux_kernel.compile_kernel, after=["kernel_configure"])
+    # apt-get download ждёт установки зависимостей сборки, чтобы не делить с ней блокировки apt
+    stages.add("packages_fetch", lambda: package_installer.fetch_packages(PACKAGES), after=["build_deps"])
+    stages.add(
+        "base",
+        setup_base,
+        lambda: [HOSTNAME, SCRIPT_DIR / "core" / "container_setup.py", SCRIPT_DIR / "adapters" / "network_adapter.py"],
+    )
+    stages.add(
+        "kernel_modules",
+        linux_kernel.install_kernel,
+        lambda: [linux_kernel.cache_key, SCRIPT_DIR / "adapters" / "linux_kernel.py"],
+        after=["kernel_compile", "base"],
+    )
+    stages.add(
+        "packages",
+        lambda: package_installer.install_base_packages(PACKAGES),
+        lambda: [
+            PACKAGES, PACKAGE_EXCLUDE, PACKAGE_ARCH, PACKAGE_SKIP, PACKAGES_LOCK,
+            SCRIPT_DIR / "adapters" / "package_installer.py", SCRIPT_DIR / "adapters" / "apt_index.py",
+        ],
+        after=["packages_fetch", "base"],
+    )
+    # При кросс-сборке sysroot по умолчанию — rootfs, и библиотеки появляются в нём с пакетами
+    stages.add("system_libs", copy_system_libraries, system_library_inputs, after=["base", "packages"])
+    stages.add(
+        "binaries",
+        lambda: setup.copy_binaries_and_dependencies(ROOTFS_PATH, BINARIES),
+        lambda: [BINARIES] + COPY_SOURCES + host_files(setup.elf.find_binary(b) for b in BINARIES),
+        after=["packages", "system_libs"],
+    )
+    stages.add(
+        "ovsdb_assets",
+        install_ovsdb_assets,
+        lambda: [SCHEMA_PATH, SCRIPT_DIR / "agents", CLI_PATH, SCRIPT_DIR / "core" / "container_setup.py"],
+        after=["base"],
     )
+    stages.run()
     try:
         create_img()
     except Exception as e:
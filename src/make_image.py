@@ -15,8 +15,8 @@ BOOT_MNT = TEMP_PATH / "mnt_boot"
 ROOTFS_MNT = TEMP_PATH / "mnt_rootfs"
 
 # Пути к файлам ядра и конфигам (замените на свои при необходимости)
-KERNEL_IMAGE = TEMP_PATH / "rpi_linux" / "arch/arm64/boot/Image"
-DTB_DIR = TEMP_PATH / "rpi_linux" / "arch/arm64/boot/dts"
+KERNEL_IMAGE = TEMP_PATH / "kernel" / "Image"
+DTB_DIR = TEMP_PATH / "kernel" / "dts"
 CONFIG_TXT = TEMP_PATH / "config.txt"
 CMDLINE_TXT = TEMP_PATH / "cmdline.txt"
 
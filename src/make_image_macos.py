@@ -13,8 +13,8 @@ CONTAINER_PATH = PROJECT_ROOT / "container"
 TEMP_PATH = PROJECT_ROOT / "temp"
 IMG_PATH = PROJECT_ROOT / IMG_NAME
 
-KERNEL_IMAGE = TEMP_PATH / "rpi_linux" / "arch/arm64/boot/Image"
-DTB_DIR = TEMP_PATH / "rpi_linux" / "arch/arm64/boot/dts"
+KERNEL_IMAGE = TEMP_PATH / "kernel" / "Image"
+DTB_DIR = TEMP_PATH / "kernel" / "dts"
 CONFIG_TXT = TEMP_PATH / "config.txt"
 CMDLINE_TXT = TEMP_PATH / "cmdline.txt"
 
@@ -0,0 +1,274 @@
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+# Небольшой индекс Packages: версии с эпохой и ~, альтернативы, виртуальные пакеты
+PACKAGES_INDEX = """\
+Package: app
+Version: 2.0-1
+Architecture: arm64
+Pre-Depends: libc6
+Depends: libfoo (>= 1.2) | libfoo-compat, libbar (>= 5) | libbar-compat, mail-transport-agent, dpkg
+SHA256: a1
+Size: 10
+Description: приложение
+ многострочное описание пропускается
+
+Package: libc6
+Version: 2.36-9
+Architecture: arm64
+SHA256: c6
+Size: 10
+
+Package: libfoo
+Version: 1.1-1
+Architecture: arm64
+Depends: libc6
+SHA256: f1
+Size: 10
+
+Package: libfoo
+Version: 1.3~rc1-1
+Architecture: arm64
+Depends: libc6
+SHA256: f3
+Size: 10
+
+Package: libfoo
+Version: 1.3-1
+Architecture: amd64
+SHA256: fx
+Size: 10
+
+Package: libbar
+Version: 4.0-1
+Architecture: arm64
+SHA256: b4
+Size: 10
+
+Package: libbar-compat
+Version: 1.0-1
+Architecture: all
+SHA256: bc
+Size: 10
+
+Package: postfix
+Version: 3.7.6-0+deb12u2
+Architecture: arm64
+Provides: mail-transport-agent
+Depends: libc6
+SHA256: pf
+Size: 10
+
+Package: exim4
+Version: 4.96-15
+Architecture: arm64
+Provides: mail-transport-agent
+SHA256: ex
+Size: 10
+
+Package: dpkg
+Version: 1.21.22
+Architecture: arm64
+SHA256: dp
+Size: 10
+
+Package: cycle-a
+Version: 1
+Architecture: arm64
+Depends: cycle-b
+SHA256: ca
+Size: 10
+
+Package: cycle-b
+Version: 1
+Architecture: arm64
+Depends: cycle-a
+SHA256: cb
+Size: 10
+
+Package: no-sha
+Version: 1
+Architecture: arm64
+"""
+
+
+def check_compare_versions():
+    from adapters.apt_index import compare_versions, version_satisfies
+
+    # (a, b, знак a - b) — значения dpkg --compare-versions
+    cases = [
+        ("1.0", "1.0", 0),
+        ("1.0", "1.0-0", 0),
+        ("1.0-1", "1.0-2", -1),
+        ("1.0-10", "1.0-9", 1),
+        ("1:0.1", "9.9", 1),
+        ("0:1.0", "1.0", 0),
+        ("2:1.0", "1:9.0", 1),
+        ("1.0~rc1", "1.0", -1),
+        ("1.0~rc1", "1.0~rc2", -1),
+        ("1.0~~", "1.0~", -1),
+        ("1.0~", "1.0", -1),
+        ("1.0", "1.0a", -1),
+        ("1.0a", "1.0+", -1),
+        ("1.0.1", "1.0a", 1),
+        ("1.002", "1.2", 0),
+        ("1.10", "1.9", 1),
+        ("2.36-9", "2.36-9+deb12u1", -1),
+        ("1.2-3-4", "1.2-3-5", -1),
+        ("3.7.6-0+deb12u2", "3.7.6-0+deb12u10", -1),
+    ]
+    for a, b, expected in cases:
+        sign = (compare_versions(a, b) > 0) - (compare_versions(a, b) < 0)
+        reverse = (compare_versions(b, a) > 0) - (compare_versions(b, a) < 0)
+        if sign != expected or reverse != -expected:
+            print(f"[apt-version] {a} vs {b}: {sign}, ожидалось {expected}")
+            return False
+    relations = [
+        ("1.2", ">=", "1.2", True),
+        ("1.2~1", ">=", "1.2", False),
+        ("1.2", ">>", "1.2", False),
+        ("1.3", ">>", "1.2", True),
+        ("1.2", "<<", "1.2", False),
+        ("1.2", "=", "1.2-0", True),
+        # Устаревшие < и > означают <= и >=
+        ("1.2", "<", "1.2", True),
+        ("1.2", ">", "1.2", True),
+        ("1.0", None, None, True),
+    ]
+    for version, op, wanted, expected in relations:
+        if version_satisfies(version, op, wanted) != expected:
+            print(f"[apt-version] {version} {op} {wanted}: ожидалось {expected}")
+            return False
+    print("[apt-version] OK — сравнение версий совпадает с dpkg (эпоха, ~, ревизия).")
+    return True
+
+
+def make_index(tmp: Path):
+    import logging
+
+    from adapters.apt_index import AptIndex
+
+    logging.disable(logging.WARNING)
+    (tmp / "deb.example.org_debian_dists_bookworm_main_binary-arm64_Packages").write_text(PACKAGES_INDEX)
+    (tmp / "deb.example.org_debian_dists_bookworm_main_binary-arm64_Packages.lz4").write_text("")
+    try:
+        return AptIndex("arm64", tmp)
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def check_index_files():
+    import gzip
+    import logging
+
+    from adapters.apt_index import index_files
+
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        prefix = "deb.debian.org_debian_dists_bookworm"
+        for name in ("main_binary-arm64_Packages", "contrib_binary-arm64_Packages.lz4", "main_binary-amd64_Packages"):
+            (tmp / f"{prefix}_{name}").write_text("")
+        with gzip.open(tmp / f"{prefix}-updates_main_binary-arm64_Packages.gz", "wt") as f:
+            f.write("")
+        found = [path.name for path in index_files("arm64", tmp)]
+    logging.disable(logging.NOTSET)
+    expected = [f"{prefix}-updates_main_binary-arm64_Packages.gz", f"{prefix}_main_binary-arm64_Packages"]
+    if found != expected:
+        print(f"[apt-index] индексы {found}, ожидались {expected}")
+        return False
+    print("[apt-index] OK — несжатые и gz/xz индексы с точками в имени хоста находятся, lz4 пропускается.")
+    return True
+
+
+def check_resolve():
+    with tempfile.TemporaryDirectory() as tmp:
+        index = make_index(Path(tmp))
+        if "no-sha" in index.packages or [p.version for p in index.packages["libfoo"]] != ["1.3~rc1-1", "1.1-1"]:
+            print(f"[apt-resolve] версии libfoo: {index.packages.get('libfoo')}")
+            return False
+        order = index.resolve(["app"], skip=["dpkg"])
+    names = [p.name for p in order]
+    # libfoo 1.3~rc1 удовлетворяет >= 1.2, libbar 4.0 — нет, и берётся альтернатива;
+    # виртуальный mail-transport-agent — первым поставщиком из индекса
+    expected = ["libc6", "libfoo", "libbar-compat", "postfix", "app"]
+    if names != expected:
+        print(f"[apt-resolve] порядок {names}, ожидался {expected}")
+        return False
+    if order[1].version != "1.3~rc1-1" or order[2].arch != "all":
+        print(f"[apt-resolve] выбраны {order[1]} и {order[2]}")
+        return False
+    print("[apt-resolve] OK — альтернативы, виртуальные пакеты и skip разрешаются, зависимости раньше зависящих.")
+    return True
+
+
+def check_pick_cases():
+    with tempfile.TemporaryDirectory() as tmp:
+        index = make_index(Path(tmp))
+        # Виртуальный пакет уже выполнен выбранным поставщиком: второй не тянется
+        order = [p.name for p in index.resolve(["exim4", "app"], skip=["dpkg"])]
+        if "postfix" in order or order[0] != "exim4":
+            print(f"[apt-pick] уже выбранный поставщик не учтён: {order}")
+            return False
+        # Запрошенное виртуальное имя и цикл зависимостей
+        virtual = [p.name for p in index.resolve(["mail-transport-agent"])]
+        cycle = [p.name for p in index.resolve(["cycle-a"])]
+        if virtual != ["libc6", "postfix"] or sorted(cycle) != ["cycle-a", "cycle-b"]:
+            print(f"[apt-pick] виртуальное имя {virtual}, цикл {cycle}")
+            return False
+        try:
+            index.resolve(["missing"])
+            print("[apt-pick] неизвестный пакет разрешён")
+            return False
+        except LookupError:
+            pass
+    print("[apt-pick] OK — уже выбранные поставщики, виртуальные имена и циклы обрабатываются.")
+    return True
+
+
+def check_corrupted_cache():
+    import logging
+
+    from adapters.apt_index import DebPackage
+    from adapters.package_installer import PackageInstaller, file_sha256
+
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        installer = PackageInstaller(str(tmp / "temp"), str(tmp / "rootfs"), arch="arm64")
+        good = tmp / "good.deb"
+        good.write_bytes(b"deb contents")
+        package = DebPackage("pkg", "1.0", "arm64", "", file_sha256(good), good.stat().st_size)
+        cached = installer._cached_deb(package)
+        cached.write_bytes(b"deb contents")
+        if not installer._is_cached(package):
+            print("[apt-cache] целый .deb из кэша не принят")
+            return False
+        # Тот же размер, другое содержимое
+        cached.write_bytes(b"deb_contents")
+        downloaded = []
+        installer.resolve = lambda packages: [package]
+        installer._download_packages = lambda packages: downloaded.extend(packages)
+        installer.fetch_packages(["pkg"])
+    logging.disable(logging.NOTSET)
+    if downloaded != [package] or cached.exists():
+        print(f"[apt-cache] повреждённый .deb того же размера не перезагружен: {downloaded}")
+        return False
+    print("[apt-cache] OK — .deb из кэша сверяется по sha256, повреждённый загружается заново.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_compare_versions, check_index_files, check_resolve, check_pick_cases, check_corrupted_cache):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
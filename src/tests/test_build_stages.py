@@ -0,0 +1,127 @@
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+
+class ListLogger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message: str):
+        self.messages.append(message)
+
+    def error(self, message: str):
+        self.messages.append(message)
+
+
+def check_only_changed_stage_rebuilds():
+    from core.build_stages import StageRunner
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rootfs = Path(tmp) / "rootfs"
+        agent = Path(tmp) / "net_agent.py"
+        agent.write_text("v1\n")
+        runs = []
+
+        def base():
+            runs.append("base")
+            (rootfs / "etc").mkdir(parents=True, exist_ok=True)
+            (rootfs / "etc/hostname").write_text("litainer\n")
+
+        def packages():
+            runs.append("packages")
+            (rootfs / "usr/bin").mkdir(parents=True, exist_ok=True)
+            (rootfs / "usr/bin/bash").write_text("bash\n")
+
+        def assets():
+            runs.append("assets")
+            (rootfs / "usr/local/sbin").mkdir(parents=True, exist_ok=True)
+            (rootfs / "usr/local/sbin/net_agent.py").write_text(agent.read_text())
+
+        def build():
+            runner = StageRunner(rootfs, Path(tmp) / "manifest.json", ListLogger())
+            runner.add("base", base, lambda: ["litainer"])
+            runner.add("packages", packages, lambda: [["bash"]], after=["base"])
+            runner.add("assets", assets, lambda: [agent], after=["base"])
+            runner.run()
+
+        build()
+        build()
+        if sorted(runs) != ["assets", "base", "packages"] or runs[0] != "base":
+            print(f"[build-stages] повторная сборка без изменений выполнила этапы: {runs}")
+            return False
+
+        runs.clear()
+        agent.write_text("v2\n")
+        build()
+        if runs != ["assets"] or (rootfs / "usr/local/sbin/net_agent.py").read_text() != "v2\n":
+            print(f"[build-stages] после правки агента выполнены этапы {runs}")
+            return False
+        if not (rootfs / "usr/bin/bash").exists():
+            print("[build-stages] удалены результаты актуального этапа")
+            return False
+
+        runs.clear()
+        (rootfs / "usr/bin/bash").unlink()
+        build()
+        if runs != ["packages"]:
+            print(f"[build-stages] удалённый результат не вызвал пересборку этапа: {runs}")
+            return False
+    print("[build-stages] OK — пересобираются только этапы с изменившимися входами.")
+    return True
+
+
+def check_parallel_and_critical_path():
+    import threading
+    import time
+
+    from core.build_stages import StageRunner, stage_output
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rootfs = Path(tmp) / "rootfs"
+        both_running = threading.Barrier(2, timeout=5)
+
+        def kernel_compile():
+            # Ядро собирается одновременно с rootfs
+            both_running.wait()
+            time.sleep(0.2)
+            stage_output().write("make output\n")
+
+        def base():
+            both_running.wait()
+            rootfs.mkdir(parents=True, exist_ok=True)
+            (rootfs / "etc").mkdir(exist_ok=True)
+
+        runner = StageRunner(rootfs, Path(tmp) / "manifest.json", ListLogger(), log_dir=Path(tmp) / "logs")
+        runner.add("kernel_compile", kernel_compile)
+        runner.add("base", base, lambda: ["litainer"])
+        runner.add("kernel_modules", lambda: (rootfs / "lib").mkdir(), lambda: ["modules"], after=["kernel_compile", "base"])
+        try:
+            runner.run()
+        except threading.BrokenBarrierError:
+            print("[build-stages] независимые этапы не выполнялись параллельно")
+            return False
+        path = [stage.name for stage in runner.critical_path()]
+        if path != ["kernel_compile", "kernel_modules"]:
+            print(f"[build-stages] неверный критический путь: {path}")
+            return False
+        if (Path(tmp) / "logs/kernel_compile.log").read_text() != "make output\n":
+            print("[build-stages] вывод этапа не попал в его лог")
+            return False
+    print("[build-stages] OK — независимые этапы параллельны, критический путь найден.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_only_changed_stage_rebuilds, check_parallel_and_critical_path):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
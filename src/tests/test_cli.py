@@ -0,0 +1,285 @@
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+SCHEMA_PATH = PROJECT_ROOT / "src" / "schema" / "system.ovsschema"
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+
+def check_normalize_remote():
+    from cli import normalize_remote
+
+    cases = {
+        "pi1": "tcp:pi1:6640",
+        "pi1:7000": "tcp:pi1:7000",
+        "10.0.0.5": "tcp:10.0.0.5:6640",
+        "fe80::1": "tcp:[fe80::1]:6640",
+        "[fe80::1]": "tcp:[fe80::1]:6640",
+        "[fe80::1]:7000": "tcp:[fe80::1]:7000",
+        "unix:/var/run/openvswitch/db.sock": "unix:/var/run/openvswitch/db.sock",
+        "tcp:10.0.0.1:6641,tcp:10.0.0.2:6641": "tcp:10.0.0.1:6641,tcp:10.0.0.2:6641",
+        "db1,db2": "tcp:db1:6640,tcp:db2:6640",
+    }
+    for text, expected in cases.items():
+        if normalize_remote(text) != expected:
+            print(f"[cli-remote] {text} -> {normalize_remote(text)}, ожидалось {expected}")
+            return False
+    print("[cli-remote] OK — узлы, порты и IPv6 нормализуются в OVSDB remote.")
+    return True
+
+
+def check_cluster_remote_not_fanned_out():
+    from cli import build_parser, fleet_remotes
+
+    parser = build_parser()
+    args = parser.parse_args(["--remote", "tcp:a:6641,tcp:b:6641", "show", "System"])
+    if fleet_remotes(args) or args.remote != "tcp:a:6641,tcp:b:6641":
+        print(f"[cli-remote] кластер в --remote разбит на узлы: {fleet_remotes(args)}")
+        return False
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+        f.write("# парк\npi3\ntcp:c:6641,tcp:d:6641\n")
+        f.flush()
+        args = parser.parse_args(["--nodes", "pi1,pi2", "--nodes", "pi1", "--remotes-file", f.name, "show", "System"])
+        nodes = fleet_remotes(args)
+    if nodes != ["pi1", "pi2", "pi3", "tcp:c:6641,tcp:d:6641"]:
+        print(f"[cli-remote] узлы парка: {nodes}")
+        return False
+    print("[cli-remote] OK — --remote остаётся кластером, парк задаётся --nodes и --remotes-file.")
+    return True
+
+
+def check_fleet_not_forwarded():
+    from cli import build_parser, fleet_remotes, forward_socket, run_session_command
+
+    parser = build_parser()
+    sock = "/tmp/cli.sock"
+    cases = [
+        (["--socket", sock, "set", "vm", "vm1", "state", "run"], sock),
+        (["--socket", sock, "--nodes", "pi1,pi2", "set", "vm", "vm1", "state", "run"], None),
+        (["--socket", sock, "--remote", "tcp:db:6640", "show", "System"], None),
+        (["--socket", sock, "shell"], None),
+    ]
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+        f.write("pi1\n")
+        f.flush()
+        cases.append((["--socket", sock, "--remotes-file", f.name, "apply", "-f", "node.json"], None))
+        for argv, expected in cases:
+            args = parser.parse_args(argv)
+            if forward_socket(args, fleet_remotes(args)) != expected:
+                print(f"[cli-socket] {' '.join(argv)}: пересылка {forward_socket(args, fleet_remotes(args))}")
+                return False
+    # Внутри сессии узлы задать нельзя: команда ушла бы на узел демона
+    status, text = run_session_command(None, "unix:/db.sock", ["--nodes", "pi1", "set", "vm", "vm1", "state", "run"])
+    if status == 0 or "ERROR" not in text:
+        print(f"[cli-socket] сессия приняла --nodes: {status} {text!r}")
+        return False
+    print("[cli-socket] OK — команды парка и с явным --remote не пересылаются демону serve.")
+    return True
+
+
+class FakeRow:
+    def __init__(self, **data):
+        self.uuid = "u1"
+        for column, value in data.items():
+            setattr(self, column, value)
+
+
+def check_set_column_pushdown():
+    import ovs.db.idl
+
+    from cli import matches, monitor_conditions, parse_predicate
+
+    helper = ovs.db.idl.SchemaHelper(location=str(SCHEMA_PATH))
+    helper.register_all()
+    # Соединение не нужно: проверяются только условия и локальный фильтр
+    tbl = ovs.db.idl.Idl("unix:/nonexistent.sock", helper).tables["Storage"]
+    predicates = [
+        parse_predicate(tbl, text)
+        for text in ("portals=10.0.0.1", "portals!=10.0.0.9", "target_iqn=iqn.a", "io_stats=read_iops")
+    ]
+    conditions = monitor_conditions(tbl, predicates)
+    expected = [
+        ["portals", "includes", ["set", ["10.0.0.1"]]],
+        ["portals", "excludes", ["set", ["10.0.0.9"]]],
+        ["target_iqn", "==", "iqn.a"],
+    ]
+    if conditions != expected:
+        print(f"[cli-where] условия для сервера {conditions}, ожидались {expected}")
+        return False
+    # Строка с двумя порталами: сервер с includes её пришлёт, локальный фильтр — пропустит
+    row = FakeRow(portals=["10.0.0.1", "10.0.0.2"], target_iqn="iqn.a", io_stats={"read_iops": 1.0})
+    other = FakeRow(portals=["10.0.0.2", "10.0.0.9"], target_iqn="iqn.a", io_stats={"read_iops": 1.0})
+    if not matches(tbl, row, predicates) or matches(tbl, other, predicates):
+        print("[cli-where] локальный фильтр по множеству расходится с includes/excludes")
+        return False
+    print("[cli-where] OK — для множеств на сервер уходят includes/excludes, map фильтруется локально.")
+    return True
+
+
+def check_watch_events():
+    import ovs.db.idl
+
+    from cli import parse_predicate, watch_events, watch_snapshot
+
+    helper = ovs.db.idl.SchemaHelper(location=str(SCHEMA_PATH))
+    helper.register_all()
+    tbl = ovs.db.idl.Idl("unix:/nonexistent.sock", helper).tables["VirtualMachine"]
+
+    def vm(uuid, name, state, cpu):
+        row = FakeRow(name=name, state=[state], cpu=[cpu])
+        row.uuid = uuid
+        return row
+
+    columns = ["name", "state", "cpu"]
+    predicates = [parse_predicate(tbl, "state!=stop")]
+    before = [vm("u1", "vm1", "run", 2), vm("u2", "vm2", "run", 1), vm("u3", "vm3", "stop", 1), vm("u4", "vm4", "run", 4)]
+    # vm1: сменилось число vCPU; vm2 остановлена (ушла из фильтра); vm3 запущена (вошла);
+    # vm4 удалена; vm5 создана остановленной — под фильтр не попадает
+    after = [vm("u1", "vm1", "run", 4), vm("u2", "vm2", "stop", 1), vm("u3", "vm3", "run", 1), vm("u5", "vm5", "stop", 1)]
+    tbl.rows = {row.uuid: row for row in before}
+    old = watch_snapshot(tbl, columns, predicates)
+    tbl.rows = {row.uuid: row for row in after}
+    new = watch_snapshot(tbl, columns, predicates)
+    events = sorted(
+        ((e["event"], e["_uuid"], e["row"]) for e in watch_events("VirtualMachine", "name", old, new)),
+        key=lambda event: event[1],
+    )
+    expected = [
+        ("update", "u1", {"cpu": 4, "name": "vm1"}),
+        ("delete", "u2", {"name": "vm2"}),
+        ("insert", "u3", {"name": "vm3", "state": "run", "cpu": 1}),
+        ("delete", "u4", {"name": "vm4"}),
+    ]
+    if events != expected:
+        print(f"[cli-watch] события {events}, ожидались {expected}")
+        return False
+    # Снимок без изменений — без событий; старт без --changes-only — все строки как insert
+    if list(watch_events("VirtualMachine", "name", new, new)):
+        print("[cli-watch] одинаковые снимки дали события")
+        return False
+    initial = [e["event"] for e in watch_events("VirtualMachine", "name", {}, new)]
+    if initial != ["insert", "insert"]:
+        print(f"[cli-watch] начальный снимок: {initial}")
+        return False
+    print("[cli-watch] OK — insert/update/delete по разнице снимков с учётом --where.")
+    return True
+
+
+def apply_idl():
+    """IDL без подключения со строками Interface, поданными как ответ monitor."""
+    import uuid
+
+    from cli import get_idl
+
+    idl = get_idl("unix:/nonexistent.sock", str(SCHEMA_PATH))
+    rows = {
+        str(uuid.uuid4()): {"new": {"name": "eth0", "vlan": 100, "mtu": 1500}},
+        str(uuid.uuid4()): {"new": {"name": "eth1", "state": "up"}},
+    }
+    idl._Idl__parse_update({"Interface": rows}, "update")
+    return idl
+
+
+def ovs_success():
+    import ovs.db.idl
+
+    return ovs.db.idl.Transaction.SUCCESS
+
+
+def check_apply_diff():
+    import cli
+
+    idl = apply_idl()
+    doc = {"Interface": [{"name": "eth0", "vlan": 200}, {"name": "eth2", "mtu": 9000}]}
+    cases = [
+        ({}, [("update", "eth0", {"vlan": (100, 200)}), ("insert", "eth2", {"mtu": (None, 9000)})]),
+        (
+            {"replace": True},
+            [("update", "eth0", {"vlan": (100, 200), "mtu": (1500, None)}), ("insert", "eth2", {"mtu": (None, 9000)})],
+        ),
+        (
+            {"prune": True},
+            [("update", "eth0", {"vlan": (100, 200)}), ("insert", "eth2", {"mtu": (None, 9000)}), ("delete", "eth1", {})],
+        ),
+    ]
+    for flags, expected in cases:
+        options = {"prune": False, "replace": False, **flags}
+        ops = [(op, key, changes) for op, _, key, _, changes in cli.compute_diff(idl, doc, **options)]
+        if ops != expected:
+            print(f"[cli-apply] {flags or 'без флагов'}: {ops}, ожидалось {expected}")
+            return False
+    ops = cli.compute_diff(idl, {"Interface": [{"name": "eth1", "_delete": True}]}, prune=False, replace=False)
+    if [(op, key) for op, _, key, _, _ in ops] != [("delete", "eth1")]:
+        print(f"[cli-apply] _delete: {ops}")
+        return False
+
+    # Вся разница уходит одной транзакцией; commit подменён, записи проверяются в ней
+    ops = cli.compute_diff(idl, doc, prune=True, replace=True)
+    current = {row.name: row.uuid for row in idl.tables["Interface"].rows.values()}
+    committed = []
+    saved = cli.commit_txn
+    cli.commit_txn = lambda txn, timeout: committed.append(txn) or ovs_success()
+    try:
+        cli.apply_diff(idl, ops)
+    finally:
+        cli.commit_txn = saved
+    txn_rows = committed[0]._txn_rows if committed else {}
+    # У удаляемой строки _changes = None: колонки через неё уже не читаются
+    deleted = {uuid for uuid, row in txn_rows.items() if row._changes is None}
+    rows = {row.name: row for row in txn_rows.values() if row._changes is not None}
+    if len(committed) != 1 or deleted != {current["eth1"]} or set(rows) != {"eth0", "eth2"}:
+        print(f"[cli-apply] в транзакции строки {sorted(rows)}, удаляются {deleted}")
+        return False
+    eth0, eth2 = rows["eth0"], rows["eth2"]
+    if (eth0.vlan, eth0.mtu, eth2.mtu) != ([200], [], [9000]):
+        print(f"[cli-apply] записано eth0 vlan={eth0.vlan} mtu={eth0.mtu}, eth2 mtu={eth2.mtu}")
+        return False
+    idl.close()
+    print("[cli-apply] OK — diff учитывает --replace, --prune и _delete, apply пишет его одной транзакцией.")
+    return True
+
+
+def check_apply_invalid_value():
+    from cli import compute_diff
+
+    idl = apply_idl()
+    bad_docs = [
+        ({"Interface": [{"name": "eth0", "vlan": "abc"}]}, "Interface.vlan"),
+        ({"Interface": [{"name": "eth0", "mtu": [1500, 9000]}]}, "Interface.mtu"),
+        ({"Interface": [{"name": 5, "state": "up"}]}, "Interface.name"),
+        ({"VirtualMachine": [{"name": "vm1", "pci_passthrough": [1]}]}, "VirtualMachine.pci_passthrough"),
+    ]
+    for doc, where in bad_docs:
+        try:
+            compute_diff(idl, doc, prune=False, replace=False)
+        except RuntimeError as exc:
+            if where not in str(exc):
+                print(f"[cli-apply] ошибка без колонки {where}: {exc}")
+                return False
+            continue
+        print(f"[cli-apply] значение {doc} принято")
+        return False
+    idl.close()
+    print("[cli-apply] OK — значение не того типа отклоняется до транзакции с таблицей и колонкой.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (
+        check_normalize_remote,
+        check_cluster_remote_not_fanned_out,
+        check_fleet_not_forwarded,
+        check_set_column_pushdown,
+        check_watch_events,
+        check_apply_diff,
+        check_apply_invalid_value,
+    ):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import io
+import json
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+SCHEMA_PATH = PROJECT_ROOT / "src" / "schema" / "system.ovsschema"
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+import cli  # noqa: E402
+
+# ovsdb-server не нужен: реплика без подключения пуста, команды show читают пустые таблицы
+REMOTE = "unix:/nonexistent/db.sock"
+
+
+def session_idl():
+    return cli.get_idl(REMOTE, str(SCHEMA_PATH))
+
+
+def check_session_commands():
+    idl = session_idl()
+    try:
+        status, text = cli.run_session_command(idl, REMOTE, ["show", "Interface", "-o", "json"])
+        if status != 0 or text != "[]\n":
+            print(f"[cli-session] show в сессии: {status} {text!r}")
+            return False
+        for argv in (["watch", "Interface"], ["--remote", "tcp:db:6640", "show", "System"], ["show", "NoSuchTable"]):
+            status, text = cli.run_session_command(idl, REMOTE, argv)
+            if status == 0 or not text.startswith("ERROR:"):
+                print(f"[cli-session] {' '.join(argv)}: {status} {text!r}, ожидалась ошибка")
+                return False
+        # Ошибка argparse не завершает процесс сессии
+        status, _ = cli.run_session_command(idl, REMOTE, ["set", "vm"])
+        if status == 0:
+            print("[cli-session] неполная команда выполнена")
+            return False
+    finally:
+        idl.close()
+    print("[cli-session] OK — команды сессии выполняются на общей реплике, ошибки возвращаются текстом.")
+    return True
+
+
+def check_shell_bad_lines():
+    idl = session_idl()
+    try:
+        for line in (b'show "Interface', b"show \xff\xfe"):
+            text = cli.run_shell_line(idl, REMOTE, line)
+            if text is None or not text.startswith("ERROR:"):
+                print(f"[cli-shell] строка {line!r}: {text!r}, ожидалась ошибка")
+                return False
+        if cli.run_shell_line(idl, REMOTE, b"show Interface -o ndjson") != "":
+            print("[cli-shell] после ошибочной строки REPL не выполняет команды")
+            return False
+        if cli.run_shell_line(idl, REMOTE, b"  ") != "" or cli.run_shell_line(idl, REMOTE, b"quit") is not None:
+            print("[cli-shell] пустая строка или quit обработаны неверно")
+            return False
+    finally:
+        idl.close()
+    print("[cli-shell] OK — незакрытая кавычка и не UTF-8 дают ERROR, REPL продолжает работу.")
+    return True
+
+
+def serve_until(server, done, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not done() and time.monotonic() < deadline:
+        server.step(timeout_ms=50)
+    return done()
+
+
+def forward_in_thread(path, argv):
+    result = {}
+
+    def run():
+        out = io.StringIO()
+        result["status"] = cli.forward_command(path, argv, None, out)
+        result["output"] = out.getvalue()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def check_serve_round_trip():
+    idl = session_idl()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "cli.sock")
+        server = cli.SessionServer(idl, REMOTE, path, client_timeout=1.0)
+        try:
+            # Клиент подключился и молчит: остальные обслуживаются без ожидания
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stalled.connect(path)
+            stalled.sendall(b'{"argv": ["show"')
+            thread, result = forward_in_thread(path, ["show", "Interface", "-o", "json"])
+            start = time.monotonic()
+            if not serve_until(server, lambda: not thread.is_alive()):
+                print("[cli-serve] ответ не получен: сервер ждёт молчащего клиента")
+                return False
+            if time.monotonic() - start > 0.8 or result != {"status": 0, "output": "[]\n"}:
+                print(f"[cli-serve] ответ {result} за {time.monotonic() - start:.2f} с")
+                return False
+            # Некорректный запрос — ответ с ошибкой, а не падение сервера
+            bad = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            bad.connect(path)
+            bad.sendall(b"not json\n")
+            serve_until(server, lambda: select.select([bad], [], [], 0)[0])
+            bad.settimeout(1)
+            response = json.loads(bad.recv(65536))
+            bad.close()
+            if response["status"] != 1 or "bad request" not in response["output"]:
+                print(f"[cli-serve] некорректный запрос: {response}")
+                return False
+            if not serve_until(server, lambda: not server.clients, timeout=3.0):
+                print("[cli-serve] молчащий клиент не отключён по таймауту")
+                return False
+            stalled.settimeout(1)
+            if stalled.recv(1) != b"":
+                print("[cli-serve] молчащему клиенту отправлены данные")
+                return False
+            stalled.close()
+        finally:
+            server.close()
+            idl.close()
+    print("[cli-serve] OK — forward_command получает ответ, молчащий клиент не блокирует сервер и отключается.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_session_commands, check_shell_bad_lines, check_serve_round_trip):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+CLI_PATH = PROJECT_ROOT / "src" / "cli.py"
+SCHEMA_PATH = PROJECT_ROOT / "src" / "schema" / "system.ovsschema"
+DB_SOCK = Path("/var/run/openvswitch/db.sock")
+RUNS = 10
+# Бюджеты времени старта (медиана, мс)
+HELP_BUDGET_MS = 150
+SHOW_BUDGET_MS = 400
+
+
+def median_ms(cmd):
+    samples = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        samples.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError(f"{cmd} вернул {result.returncode}: {result.stderr.strip()}")
+    return statistics.median(samples)
+
+
+def check_lazy_imports():
+    code = (
+        "import sys; sys.argv = ['cli.py', '--help']; "
+        f"sys.path.insert(0, {str(CLI_PATH.parent)!r}); import cli; cli.build_parser(); "
+        "print(','.join(m for m in sys.modules if m.startswith(('ovs', 'yaml'))))"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=30)
+    loaded = result.stdout.strip()
+    if result.returncode != 0 or loaded:
+        print(f"[cli-imports] при разборе аргументов загружены тяжёлые модули: {loaded or result.stderr.strip()}")
+        return False
+    print("[cli-imports] OK — ovs/yaml не импортируются до выполнения команды.")
+    return True
+
+
+def check_help_budget():
+    elapsed = median_ms([sys.executable, str(CLI_PATH), "--help"])
+    if elapsed > HELP_BUDGET_MS:
+        print(f"[cli-help] медиана {elapsed:.0f} мс > бюджета {HELP_BUDGET_MS} мс")
+        return False
+    print(f"[cli-help] OK — медиана {elapsed:.0f} мс (бюджет {HELP_BUDGET_MS} мс)")
+    return True
+
+
+def check_show_budget():
+    if not DB_SOCK.exists():
+        print(f"[cli-show] пропущено: нет {DB_SOCK}")
+        return True
+    cmd = [sys.executable, str(CLI_PATH), "--schema", str(SCHEMA_PATH), "show", "System"]
+    elapsed = median_ms(cmd)
+    if elapsed > SHOW_BUDGET_MS:
+        print(f"[cli-show] медиана {elapsed:.0f} мс > бюджета {SHOW_BUDGET_MS} мс")
+        return False
+    print(f"[cli-show] OK — медиана {elapsed:.0f} мс (бюджет {SHOW_BUDGET_MS} мс)")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_lazy_imports, check_help_budget, check_show_budget):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+
+def check_symlinks_and_dedup():
+    from core.copy_plan import CopyPlan
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sysroot = Path(tmp) / "sysroot"
+        rootfs = Path(tmp) / "rootfs"
+        libdir = sysroot / "lib"
+        libdir.mkdir(parents=True)
+        (libdir / "libfoo.so.1.2.3").write_bytes(b"x" * 4096)
+        os.symlink("libfoo.so.1.2.3", libdir / "libfoo.so.1")
+        os.symlink("libfoo.so.1", libdir / "libfoo.so")
+
+        plan = CopyPlan(sysroot)
+        # Три бинарника зависят от одной библиотеки
+        for _ in range(3):
+            plan.add(libdir / "libfoo.so")
+        stats = plan.execute(rootfs)
+        if not (rootfs / "lib/libfoo.so").is_symlink() or os.readlink(rootfs / "lib/libfoo.so.1") != "libfoo.so.1.2.3":
+            print("[copy-plan] цепочка symlink не сохранена")
+            return False
+        if (stats.files + stats.reflinked, stats.links, stats.duplicates) != (1, 2, 2):
+            print(f"[copy-plan] неожиданный итог: {stats}")
+            return False
+
+        plan.add(libdir / "libfoo.so.1.2.3", Path("opt/libfoo.so"))
+        plan.execute(rootfs)
+        # Повторная сборка в тот же rootfs: всё совпадает по размеру и mtime
+        again = CopyPlan(sysroot)
+        again.add(libdir / "libfoo.so")
+        again.add(libdir / "libfoo.so.1.2.3", Path("opt/libfoo.so"))
+        stats = again.execute(rootfs)
+        if (stats.files, stats.reflinked, stats.unchanged, stats.links) != (0, 0, 2, 0):
+            print(f"[copy-plan] повторное копирование не пропущено: {stats}")
+            return False
+    print("[copy-plan] OK — ссылки сохранены, повторы и неизменённые файлы не копируются.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_symlinks_and_dedup,):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
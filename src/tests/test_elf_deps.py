@@ -0,0 +1,139 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Set
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+BINARIES = ["bash", "ls", "curl", "ip", "python3"]
+# Бюджет на разрешение зависимостей всех BINARIES без ldd (мс)
+RESOLVE_BUDGET_MS = 500
+
+
+def ldd_names(path: Path) -> Set[str]:
+    result = subprocess.run(["ldd", str(path)], capture_output=True, text=True)
+    names = set()
+    for line in result.stdout.splitlines():
+        line = line.strip()
+        if "=>" in line:
+            candidate = line.split("=>", 1)[1].strip().split()[0]
+        else:
+            candidate = line.split()[0] if line.startswith("/") else None
+        if candidate and candidate.startswith("/"):
+            names.add(Path(candidate).name)
+    return names
+
+
+def check_matches_ldd():
+    from core.elf_deps import ElfResolver
+
+    resolver = ElfResolver()
+    ok = True
+    start = time.perf_counter()
+    resolved = {}
+    for binary in BINARIES:
+        path = resolver.find_binary(binary)
+        if path is not None:
+            resolved[path] = {dep.name for dep in resolver.dependencies(path)}
+    elapsed = (time.perf_counter() - start) * 1000
+    for path, names in resolved.items():
+        expected = ldd_names(path)
+        if names != expected:
+            print(f"[elf-deps] {path}: ElfResolver {sorted(names ^ expected)} расходится с ldd")
+            ok = False
+    if elapsed > RESOLVE_BUDGET_MS:
+        print(f"[elf-deps] разрешение заняло {elapsed:.0f} мс > бюджета {RESOLVE_BUDGET_MS} мс")
+        ok = False
+    if ok:
+        print(f"[elf-deps] OK — {len(resolved)} бинарников совпадают с ldd, {elapsed:.0f} мс")
+    return ok
+
+
+def mirror_into_sysroot(sysroot: Path, target: str):
+    """Переносит путь хоста в sysroot со всей цепочкой ссылок."""
+    from core.elf_deps import sysroot_path
+
+    for _ in range(40):
+        dest = sysroot_path(sysroot, target, follow=False)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if not os.path.islink(target):
+            shutil.copy2(target, dest)
+            return
+        link = os.readlink(target)
+        if not os.path.lexists(dest):
+            os.symlink(link, dest)
+        target = link if link.startswith("/") else os.path.normpath(os.path.join(os.path.dirname(target), link))
+
+
+def check_sysroot_symlinks():
+    from core.copy_plan import CopyPlan
+    from core.elf_deps import ElfResolver
+
+    binary = ElfResolver().find_binary("ls")
+    if binary is None:
+        print("[elf-deps] ls не найден, проверка sysroot пропущена")
+        return True
+    host_deps = sorted(str(dep) for dep in ElfResolver().dependencies(binary))
+    with tempfile.TemporaryDirectory() as tmp:
+        sysroot, rootfs = Path(tmp) / "sysroot", Path(tmp) / "rootfs"
+        # Абсолютные ссылки каталогов, как в merged-usr: на хосте они вели бы в /usr/lib хоста
+        (sysroot / "usr/lib").mkdir(parents=True)
+        (sysroot / "usr/lib64").mkdir()
+        (sysroot / "lib").symlink_to("/usr/lib")
+        (sysroot / "lib64").symlink_to("/usr/lib64")
+        for target in [str(binary)] + host_deps:
+            mirror_into_sysroot(sysroot, target)
+
+        resolver = ElfResolver(sysroot)
+        sysroot_binary = sysroot / str(binary).lstrip("/")
+        deps = resolver.dependencies(sysroot_binary)
+        expected = {sysroot / dep.lstrip("/") for dep in host_deps}
+        if deps != expected:
+            print(f"[elf-deps] в sysroot зависимости {sorted(map(str, deps ^ expected))} расходятся с хостом")
+            return False
+
+        plan = CopyPlan(sysroot)
+        plan.add(sysroot_binary)
+        for dep in deps:
+            plan.add(dep)
+        plan.execute(rootfs)
+        links = 0
+        for dep in host_deps:
+            copied = rootfs / dep.lstrip("/")
+            if os.path.islink(dep):
+                links += 1
+                if not copied.is_symlink() or os.readlink(copied) != os.readlink(dep):
+                    print(f"[elf-deps] ссылка {dep} не перенесена в rootfs как ссылка")
+                    return False
+            elif not copied.is_file() or copied.is_symlink():
+                print(f"[elf-deps] файл {dep} не скопирован в rootfs")
+                return False
+        # Все ссылки rootfs должны вести на скопированные файлы rootfs, а не хоста
+        for root, _, files in os.walk(rootfs):
+            for name in files:
+                path = Path(root) / name
+                if path.is_symlink():
+                    link = os.readlink(path)
+                    resolved = rootfs / link.lstrip("/") if link.startswith("/") else path.parent / link
+                    if not os.path.lexists(resolved):
+                        print(f"[elf-deps] {path} -> {link}: цель не скопирована")
+                        return False
+    print(f"[elf-deps] OK — sysroot с абсолютными ссылками: {len(deps)} зависимостей, {links} ссылок перенесено.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_matches_ldd, check_sysroot_symlinks):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+
+def git(repo: Path, *args: str):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=repo, check=True, capture_output=True,
+    )
+
+
+def check_cache_key():
+    from adapters.linux_kernel import LinuxKernel
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kernel = LinuxKernel(tmp, "bcm2711_defconfig", Path(tmp) / "rootfs")
+        repo = kernel.rpi_repo_path
+        repo.mkdir()
+        (repo / "Makefile").write_text("all:\n")
+        git(repo, "init", "-q")
+        git(repo, "add", "Makefile")
+        git(repo, "commit", "-q", "-m", "init")
+        kernel.build_path.mkdir()
+
+        kernel.config_path.write_text("# Automatically generated\nCONFIG_KVM=y\n# CONFIG_DEBUG_INFO is not set\n")
+        base = kernel.build_key()
+        # Порядок строк и комментарии на ключ не влияют
+        kernel.config_path.write_text("# CONFIG_DEBUG_INFO is not set\n\n# другая шапка\nCONFIG_KVM=y\n")
+        if kernel.build_key() != base:
+            print("[kernel-cache] ключ зависит от комментариев или порядка .config")
+            return False
+        kernel.config_path.write_text("CONFIG_KVM=y\nCONFIG_DEBUG_INFO=y\n")
+        if kernel.build_key() == base:
+            print("[kernel-cache] ключ не изменился при смене опции")
+            return False
+        kernel.config_path.write_text("CONFIG_KVM=y\n# CONFIG_DEBUG_INFO is not set\n")
+        (repo / "Makefile").write_text("all:\n\ttrue\n")
+        if kernel.build_key() == base:
+            print("[kernel-cache] ключ не учитывает локальные правки исходников")
+            return False
+        git(repo, "commit", "-q", "-am", "change")
+        committed = kernel.build_key()
+        if committed == base or kernel.source_revision().count("+"):
+            print("[kernel-cache] ключ не учитывает новый коммит")
+            return False
+    print("[kernel-cache] OK — ключ кэша зависит от коммита и значимых опций .config.")
+    return True
+
+
+def check_dtb_targets():
+    from adapters.linux_kernel import LinuxKernel
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kernel = LinuxKernel(tmp, "bcm2711_defconfig", Path(tmp) / "rootfs", overlays=["disable-bt"])
+        dts = kernel.rpi_repo_path / "arch/arm64/boot/dts/broadcom"
+        dts.mkdir(parents=True)
+        for name in ("bcm2711-rpi-4-b", "bcm2711-rpi-cm4", "bcm2712-rpi-5-b", "bcm2710-rpi-3-b-plus"):
+            (dts / f"{name}.dts").write_text("/dts-v1/;\n")
+        targets = kernel.build_targets()
+        expected = [
+            "Image", "modules",
+            "broadcom/bcm2711-rpi-4-b.dtb", "broadcom/bcm2711-rpi-cm4.dtb",
+            "overlays/disable-bt.dtbo",
+        ]
+        if targets != expected:
+            print(f"[kernel-cache] цели сборки {targets}, ожидались {expected}")
+            return False
+    print("[kernel-cache] OK — собираются только Image, модули и DTB семейства платы.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_cache_key, check_dtb_targets):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
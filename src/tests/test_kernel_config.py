@@ -0,0 +1,101 @@
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+# Дерево ядра для проверки фрагментов настоящим Kconfig (по умолчанию — исходники сборки)
+KERNEL_SRC = Path(os.environ.get("KERNEL_SRC", PROJECT_ROOT / "temp" / "rpi_linux"))
+RPI_MODEL = "bcm2711_defconfig"
+
+
+def check_profiles_merge():
+    from adapters.kernel_config import PROFILES, merge_fragments, profile_fragments
+
+    for profile in PROFILES:
+        try:
+            options = merge_fragments(profile_fragments(profile))
+        except ValueError as e:
+            print(f"[kernel-config] профиль {profile}: {e}")
+            return False
+        if options.get("CONFIG_CGROUPS") != "y":
+            print(f"[kernel-config] профиль {profile} без базового фрагмента")
+            return False
+    print(f"[kernel-config] OK — профили {', '.join(PROFILES)} собираются без конфликтов.")
+    return True
+
+
+def check_conflict_and_check():
+    from adapters.kernel_config import (
+        ConfigConflictError,
+        apply_options,
+        check_options,
+        merge_fragments,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        (tmp / "a.config").write_text("# fragment: a\n# version: 2\nCONFIG_KVM=y\nCONFIG_DEBUG_INFO=y\n")
+        (tmp / "b.config").write_text("# fragment: b\n# version: 1\nCONFIG_KVM=y\n# CONFIG_DEBUG_INFO is not set\n")
+        try:
+            merge_fragments([tmp / "a.config", tmp / "b.config"])
+            print("[kernel-config] конфликт CONFIG_DEBUG_INFO не обнаружен")
+            return False
+        except ConfigConflictError as e:
+            if "a v2 = y, b v1 = n" not in str(e):
+                print(f"[kernel-config] неинформативный конфликт: {e}")
+                return False
+
+        config = tmp / ".config"
+        config.write_text("CONFIG_KVM=m\nCONFIG_DEBUG_INFO=y\nCONFIG_FOO=y\n")
+        options = {"CONFIG_KVM": "y", "CONFIG_DEBUG_INFO": "n", "CONFIG_MISSING": "y"}
+        apply_options(config, options)
+        text = config.read_text()
+        if "CONFIG_KVM=m" in text or "# CONFIG_DEBUG_INFO is not set" not in text or "CONFIG_FOO=y" not in text:
+            print(f"[kernel-config] опции применены неверно:\n{text}")
+            return False
+        # olddefconfig выбросил бы опцию с невыполненными зависимостями
+        config.write_text(text.replace("CONFIG_MISSING=y\n", ""))
+        dropped = check_options(config, options)
+        if dropped != ["CONFIG_MISSING: ожидалось y, получено n"]:
+            print(f"[kernel-config] проверка после olddefconfig: {dropped}")
+            return False
+    print("[kernel-config] OK — конфликты фрагментов и потерянные опции обнаруживаются.")
+    return True
+
+
+def check_profiles_survive_olddefconfig():
+    from adapters.kernel_config import PROFILES, apply_options, check_options, merge_fragments, profile_fragments
+
+    if not (KERNEL_SRC / "Kconfig").exists():
+        print(f"[kernel-config] дерево ядра {KERNEL_SRC} не найдено (KERNEL_SRC), проверка Kconfig пропущена")
+        return True
+    ok = True
+    for profile in PROFILES:
+        options = merge_fragments(profile_fragments(profile))
+        with tempfile.TemporaryDirectory() as build:
+            make = ["make", "-s", "ARCH=arm64", f"O={build}"]
+            subprocess.run(make + [RPI_MODEL], cwd=KERNEL_SRC, check=True, capture_output=True)
+            apply_options(Path(build) / ".config", options)
+            subprocess.run(make + ["olddefconfig"], cwd=KERNEL_SRC, check=True, capture_output=True)
+            dropped = check_options(Path(build) / ".config", options)
+        if dropped:
+            print(f"[kernel-config] профиль {profile}: Kconfig отбросил опции:\n  " + "\n  ".join(dropped))
+            ok = False
+    if ok:
+        print(f"[kernel-config] OK — опции профилей сохраняются после olddefconfig на {RPI_MODEL}.")
+    return ok
+
+
+def main():
+    ok = True
+    for check in (check_profiles_merge, check_conflict_and_check, check_profiles_survive_olddefconfig):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
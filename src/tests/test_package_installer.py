@@ -0,0 +1,268 @@
+import io
+import logging
+import sys
+import tarfile
+import tempfile
+import threading
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+
+def tar_member(name, kind="file", data=b"", target=""):
+    """(TarInfo, данные) для члена data.tar: file, dir, symlink или hardlink."""
+    info = tarfile.TarInfo(name)
+    info.mode = 0o755 if kind == "dir" else 0o644
+    if kind == "dir":
+        info.type = tarfile.DIRTYPE
+    elif kind == "symlink":
+        info.type, info.linkname = tarfile.SYMTYPE, target
+    elif kind == "hardlink":
+        info.type, info.linkname = tarfile.LNKTYPE, target
+    else:
+        info.size = len(data)
+    return info, data
+
+
+def ar_member(name: str, data: bytes) -> bytes:
+    header = f"{name:<16}{0:<12}{0:<6}{0:<6}{'100644':<8}{len(data):<10}`\n".encode()
+    return header + data + (b"\n" if len(data) & 1 else b"")
+
+
+def build_deb(path: Path, members, compression="gz"):
+    """Минимальный .deb: debian-binary, control.tar.gz и data.tar.<compression>."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=f"w:{compression}") as tar:
+        for info, content in members:
+            tar.addfile(info, io.BytesIO(content) if info.isfile() else None)
+    control = io.BytesIO()
+    with tarfile.open(fileobj=control, mode="w:gz") as tar:
+        info, content = tar_member("./control", data=b"Package: test\n")
+        tar.addfile(info, io.BytesIO(content))
+    path.write_bytes(
+        b"!<arch>\n"
+        + ar_member("debian-binary", b"2.0\n")
+        + ar_member("control.tar.gz", control.getvalue())
+        + ar_member(f"data.tar.{compression}", data.getvalue())
+    )
+    return path
+
+
+def make_installer(tmp: Path, debs, rootfs="rootfs"):
+    from adapters.package_installer import PackageInstaller
+
+    installer = PackageInstaller(str(tmp / "temp"), str(tmp / rootfs), arch="arm64")
+    # Разрешение зависимостей и загрузка не нужны: .deb уже собраны
+    installer.fetch_packages = lambda packages: debs
+    return installer
+
+
+def check_failed_package_fails_stage():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        good = build_deb(tmp / "good.deb", [tar_member("./etc/good", data=b"ok\n")])
+        broken = tmp / "broken.deb"
+        broken.write_bytes(b"not an ar archive")
+        installer = make_installer(tmp, {"good": good, "broken": broken})
+        try:
+            installer.install_base_packages(["good", "broken"])
+        except RuntimeError as exc:
+            if "broken" not in str(exc) or not (tmp / "rootfs/etc/good").exists():
+                print(f"[pkg-install] ошибка без имени пакета или остальные не распакованы: {exc}")
+                return False
+        else:
+            print("[pkg-install] нераспакованный пакет не остановил этап")
+            return False
+    print("[pkg-install] OK — ошибка распаковки пакета завершает этап после остальных пакетов.")
+    return True
+
+
+def install_racing(tmp: Path, debs, order, late: str, rootfs: str):
+    """Установка, в которой пакет late распаковывается после остальных."""
+    import adapters.package_installer as package_installer
+
+    extract = package_installer.extract_deb
+    others_done = threading.Event()
+    pending = [name for name in order if name != late]
+
+    def racing(deb, dest, include=None, exclude=None):
+        name = deb.stem
+        if include is None and name == late:
+            others_done.wait(5)
+        result = extract(deb, dest, include=include, exclude=exclude)
+        if include is None and name in pending:
+            pending.remove(name)
+            if not pending:
+                others_done.set()
+        return result
+
+    saved = package_installer.extract_deb, package_installer.EXTRACT_WORKERS
+    package_installer.extract_deb, package_installer.EXTRACT_WORKERS = racing, len(order)
+    try:
+        installer = make_installer(tmp, {name: debs[name] for name in order}, rootfs)
+        installer.install_base_packages(list(order))
+    finally:
+        package_installer.extract_deb, package_installer.EXTRACT_WORKERS = saved
+    return installer.rootfs_path
+
+
+def check_dir_symlink_conflict():
+    link = [tar_member("./lib", "symlink", target="usr/lib"), tar_member("./usr/lib/", "dir")]
+    tree = [tar_member("./lib/", "dir"), tar_member("./lib/libb.so", data=b"b" * 100)]
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        debs = {
+            "usrmerge": build_deb(tmp / "usrmerge.deb", link),
+            "libb": build_deb(tmp / "libb.deb", tree),
+        }
+        # Итог определяется порядком установки, а не тем, кто распаковался первым
+        for order, lib_is_link in ((("usrmerge", "libb"), True), (("libb", "usrmerge"), False)):
+            for late in order:
+                rootfs = install_racing(tmp, debs, order, late, f"rootfs-{'-'.join(order)}-{late}")
+                lib = rootfs / "lib"
+                if lib.is_symlink() != lib_is_link or not (lib / "libb.so").is_file():
+                    print(f"[pkg-install] порядок {order}, последним {late}: lib ссылка={lib.is_symlink()}")
+                    return False
+                if lib_is_link and not (rootfs / "usr/lib/libb.so").is_file():
+                    print("[pkg-install] файл каталога lib/ не попал в usr/lib через ссылку")
+                    return False
+    print("[pkg-install] OK — конфликт каталога и ссылки решается в порядке установки.")
+    return True
+
+
+def check_ar_members():
+    from adapters.package_installer import _BoundedReader, iter_ar_members
+
+    with tempfile.TemporaryDirectory() as tmp:
+        deb = Path(tmp) / "odd.deb"
+        # Члены нечётной длины выравниваются байтом \n
+        deb.write_bytes(b"!<arch>\n" + ar_member("one", b"abc") + ar_member("two", b"12345678") + ar_member("three", b"z"))
+        seen = []
+        with open(deb, "rb") as f:
+            for name, size in iter_ar_members(f):
+                # Читается только начало члена: итератор сам переходит к следующему
+                reader = _BoundedReader(f, size)
+                buf = bytearray(size + 10)
+                n = reader.readinto(buf)
+                seen.append((name, bytes(buf[:n]), reader.readinto(bytearray(4))))
+        if seen != [("one", b"abc", 0), ("two", b"12345678", 0), ("three", b"z", 0)]:
+            print(f"[pkg-ar] члены ar: {seen}")
+            return False
+        not_ar = Path(tmp) / "bad.deb"
+        not_ar.write_bytes(b"garbage")
+        try:
+            with open(not_ar, "rb") as f:
+                list(iter_ar_members(f))
+            print("[pkg-ar] не ar-архив принят")
+            return False
+        except tarfile.ReadError:
+            pass
+    print("[pkg-ar] OK — члены ar читаются с выравниванием и не дальше своего размера.")
+    return True
+
+
+def check_extract_filters():
+    from adapters.package_installer import extract_deb
+
+    members = [
+        tar_member("./usr/", "dir"),
+        tar_member("./usr/bin/", "dir"),
+        tar_member("./usr/bin/tool", data=b"#!/bin/sh\n"),
+        tar_member("./usr/bin/tool-alias", "hardlink", target="./usr/bin/tool"),
+        tar_member("./usr/share/doc/pkg/changelog", data=b"log\n"),
+        # Жёсткая ссылка на файл из отброшенной документации
+        tar_member("./usr/share/pkg/changelog", "hardlink", target="./usr/share/doc/pkg/changelog"),
+        tar_member("./usr/lib/libpkg.so.1", data=b"elf"),
+        tar_member("./usr/lib/libpkg.so", "symlink", target="libpkg.so.1"),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for compression in ("gz", "xz"):
+            deb = build_deb(tmp / f"pkg-{compression}.deb", members, compression)
+            rootfs = tmp / f"rootfs-{compression}"
+            listed = extract_deb(deb, rootfs, exclude=["usr/share/doc/*"])
+            paths = {path for path, _ in listed}
+            if "usr/share/pkg/changelog" in paths or (rootfs / "usr/share/pkg/changelog").exists():
+                print(f"[pkg-extract] {compression}: ссылка на отброшенный файл распакована")
+                return False
+            if (rootfs / "usr/share/doc").exists() or (rootfs / "usr/bin/tool-alias").stat().st_nlink != 2:
+                print(f"[pkg-extract] {compression}: exclude или жёсткая ссылка не сработали")
+                return False
+            if dict(listed).get("usr/lib/libpkg.so") != "symlink" or dict(listed).get("usr/bin") != "dir":
+                print(f"[pkg-extract] {compression}: типы членов {listed}")
+                return False
+        # include выбирает пути, exclude важнее include
+        rootfs = tmp / "rootfs-include"
+        listed = extract_deb(deb, rootfs, include=["usr/lib/*", "usr/share/*"], exclude=["usr/share/doc/*"])
+        if sorted(path for path, _ in listed) != ["usr/lib/libpkg.so", "usr/lib/libpkg.so.1"]:
+            print(f"[pkg-extract] include/exclude: {listed}")
+            return False
+    print("[pkg-extract] OK — include/exclude и ссылки на отброшенные файлы обрабатываются потоком.")
+    return True
+
+
+def check_zstd_error_preserved():
+    import shutil
+    import subprocess
+
+    from adapters.package_installer import open_data_tar
+
+    if shutil.which("zstd") is None:
+        print("[pkg-zstd] пропущено: нет zstd")
+        return True
+    plain = io.BytesIO()
+    with tarfile.open(fileobj=plain, mode="w") as tar:
+        info, content = tar_member("./etc/file", data=b"x" * 4096)
+        tar.addfile(info, io.BytesIO(content))
+    packed = subprocess.run(["zstd", "-c"], input=plain.getvalue(), capture_output=True, check=True).stdout
+    # Модуль zstandard недоступен: проверяется распаковка через процесс zstd
+    saved = sys.modules.get("zstandard")
+    sys.modules["zstandard"] = None
+    try:
+        with open_data_tar("data.tar.zst", io.BytesIO(packed)) as tar:
+            names = [member.name for member in tar]
+        if names != ["./etc/file"]:
+            print(f"[pkg-zstd] члены архива: {names}")
+            return False
+        try:
+            with open_data_tar("data.tar.zst", io.BytesIO(packed)) as tar:
+                next(iter(tar))
+                raise OSError(28, "No space left on device")
+        except OSError as exc:
+            if exc.errno != 28:
+                print(f"[pkg-zstd] исходная ошибка подменена: {exc!r}")
+                return False
+        try:
+            with open_data_tar("data.tar.zst", io.BytesIO(packed[:40])) as tar:
+                list(tar)
+            print("[pkg-zstd] обрезанный архив прочитан без ошибки")
+            return False
+        except tarfile.TarError:
+            pass
+    finally:
+        if saved is None:
+            sys.modules.pop("zstandard", None)
+        else:
+            sys.modules["zstandard"] = saved
+    print("[pkg-zstd] OK — ошибка чтения архива не подменяется кодом возврата zstd.")
+    return True
+
+
+def main():
+    logging.basicConfig(level=logging.CRITICAL)
+    ok = True
+    for check in (
+        check_ar_members,
+        check_extract_filters,
+        check_zstd_error_preserved,
+        check_failed_package_fails_stage,
+        check_dir_symlink_conflict,
+    ):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,8 @@ from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).parent.parent
 IMG_PATH = PROJECT_ROOT / "raspi.img"
-KERNEL_IMAGE = PROJECT_ROOT / "temp" / "rpi_linux" / "arch/arm64/boot/Image"
-DTB_FILE = PROJECT_ROOT / "temp" / "rpi_linux" / "arch/arm64/boot/dts" / "broadcom" / "bcm2710-rpi-3-b-plus.dtb"
+KERNEL_IMAGE = PROJECT_ROOT / "temp" / "kernel" / "Image"
+DTB_FILE = PROJECT_ROOT / "temp" / "kernel" / "dts" / "broadcom" / "bcm2710-rpi-3-b-plus.dtb"
 
 QEMU_CMD = "qemu-system-aarch64"
 READY_MARKERS = {"OVSDB_STARTED", "NET_AGENT_STARTED"}
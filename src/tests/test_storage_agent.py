@@ -0,0 +1,334 @@
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "agents"))
+
+import storage_agent  # noqa: E402
+
+
+def check_remount_options():
+    cases = [
+        # Профиль не менялся — remount не нужен
+        ({"rw", "noatime", "commit=30"}, ["noatime", "commit=30"], []),
+        # noatime и discard убраны из профиля — снимаются обратными опциями
+        ({"rw", "noatime", "discard"}, [], ["nodiscard", "relatime"]),
+        # commit сменился, а не исчез: commit=0 не добавляется
+        ({"rw", "relatime", "commit=30"}, ["commit=60"], ["commit=60"]),
+        ({"rw", "relatime", "commit=30"}, [], ["commit=0"]),
+        ({"rw", "relatime"}, ["noatime", "discard"], ["noatime", "discard"]),
+    ]
+    for current, desired, expected in cases:
+        changes = storage_agent.remount_options(current, desired)
+        if changes != expected:
+            print(f"[storage-agent] remount {sorted(current)} -> {desired}: {changes}, ожидалось {expected}")
+            return False
+    print("[storage-agent] OK — remount снимает убранные из профиля опции.")
+    return True
+
+
+def fake_session(root: Path, sid: int, target: str, address: str = None):
+    session = root / "iscsi_session" / f"session{sid}"
+    session.mkdir(parents=True)
+    (session / "targetname").write_text(target + "\n")
+    conn = root / "iscsi_connection" / f"connection{sid}:0"
+    conn.mkdir(parents=True)
+    if address is not None:
+        (conn / "persistent_address").write_text(address + "\n")
+
+
+def check_sessions_by_portal():
+    target = "iqn.2024-01.example:disk"
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        fake_session(root, 1, target, "10.0.0.1")
+        fake_session(root, 2, target, "10.0.0.2")
+        # Соединение без адреса в sysfs: портал узнаётся из iscsiadm
+        fake_session(root, 3, target)
+        fake_session(root, 4, "iqn.2024-01.example:other", "10.0.0.1")
+        saved = storage_agent.ISCSI_SESSIONS, storage_agent.ISCSI_CONNECTIONS, storage_agent.iscsiadm_session_portals
+        storage_agent.ISCSI_SESSIONS = root / "iscsi_session"
+        storage_agent.ISCSI_CONNECTIONS = root / "iscsi_connection"
+        storage_agent.iscsiadm_session_portals = lambda: {"3": "10.0.0.2"}
+        try:
+            first = [s.name for s in storage_agent.find_sessions(target, "10.0.0.1:3260")]
+            second = [s.name for s in storage_agent.find_sessions(target, "10.0.0.2")]
+        finally:
+            storage_agent.ISCSI_SESSIONS, storage_agent.ISCSI_CONNECTIONS, storage_agent.iscsiadm_session_portals = saved
+    if first != ["session1"] or second != ["session2", "session3"]:
+        print(f"[storage-agent] сессии по порталам: {first} и {second}")
+        return False
+    print("[storage-agent] OK — сессии сопоставляются по цели и порталу, без дублей.")
+    return True
+
+
+def check_node_records():
+    ports = {"10.0.0.1": 3260, "10.0.0.1:3261": 3261, "[fe80::1]": 3260, "[fe80::1]:3262": 3262, "fe80::1": 3260}
+    for portal, expected in ports.items():
+        if storage_agent.portal_port(portal) != expected:
+            print(f"[storage-agent] порт {portal}: {storage_agent.portal_port(portal)}, ожидался {expected}")
+            return False
+    target = "iqn.2024-01.example:disk"
+    with tempfile.TemporaryDirectory() as tmp, stubbed(ISCSI_NODES=Path(tmp)):
+        (Path(tmp) / target / "10.0.0.1,3260,1").mkdir(parents=True)
+        (Path(tmp) / target / "fe80::1,3262,1").mkdir(parents=True)
+        machine, _ = make_machine(Path(tmp))
+        known = {
+            portal: machine._node_known(portal)
+            for portal in ("10.0.0.1", "10.0.0.1:3260", "10.0.0.1:3261", "10.0.0.2", "[fe80::1]:3262", "[fe80::1]")
+        }
+    expected = {
+        "10.0.0.1": True,
+        "10.0.0.1:3260": True,
+        "10.0.0.1:3261": False,
+        "10.0.0.2": False,
+        "[fe80::1]:3262": True,
+        "[fe80::1]": False,
+    }
+    if known != expected:
+        print(f"[storage-agent] записи узлов: {known}")
+        return False
+    print("[storage-agent] OK — запись узла ищется по адресу и порту, по умолчанию 3260.")
+    return True
+
+
+class FakeUevents:
+    """Монитор без netlink: _wait_device опрашивает sysfs с шагом 0.5 с."""
+    available = False
+
+    def subscribe(self, callback):
+        pass
+
+    def unsubscribe(self, callback):
+        pass
+
+
+@contextmanager
+def stubbed(**attrs):
+    saved = {name: getattr(storage_agent, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(storage_agent, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(storage_agent, name, value)
+
+
+def make_machine(tmp: Path, portals=("10.0.0.1",)):
+    spec = storage_agent.StorageSpec(
+        portals=tuple(portals),
+        sessions_per_portal=1,
+        lun=0,
+        mount_point=str(tmp / "mnt"),
+        path_selector=storage_agent.DEFAULT_PATH_SELECTOR,
+    )
+    machine = storage_agent.TargetMachine("iqn.2024-01.example:disk", spec, FakeUevents())
+    states = [machine.state]
+    set_state = machine._set_state
+
+    def record(state):
+        set_state(state)
+        if states[-1] != machine.state:
+            states.append(machine.state)
+
+    machine._set_state = record
+    return machine, states
+
+
+def check_login_timeout():
+    commands = []
+
+    def run_cmd(cmd):
+        commands.append(cmd)
+        # iscsiadm --login завершается по таймауту с ошибкой
+        return "--login" not in cmd
+
+    with tempfile.TemporaryDirectory() as tmp, stubbed(run_cmd=run_cmd, find_sessions=lambda target, portal: []):
+        machine, states = make_machine(Path(tmp))
+        machine.running = True
+        machine.run()
+    expected = [storage_agent.STATE_DISCOVER, storage_agent.STATE_LOGIN, storage_agent.STATE_DEGRADED]
+    if states != expected or machine.running:
+        print(f"[storage-agent] таймаут логина: переходы {states}, ожидались {expected}")
+        return False
+    if not any("--login" in cmd for cmd in commands):
+        print("[storage-agent] логин не выполнялся")
+        return False
+    print("[storage-agent] OK — таймаут логина переводит цель в degraded.")
+    return True
+
+
+def check_device_never_appears():
+    with tempfile.TemporaryDirectory() as tmp, stubbed(
+        run_cmd=lambda cmd: True,
+        find_sessions=lambda target, portal: [Path(tmp) / "session1"],
+        session_block_device=lambda session, lun: None,
+        DEVICE_TIMEOUT=0.3,
+    ):
+        machine, states = make_machine(Path(tmp))
+        start = time.monotonic()
+        machine.run()
+        elapsed = time.monotonic() - start
+    # Сессии уже есть: логин пропускается, LUN ждётся DEVICE_TIMEOUT
+    expected = [storage_agent.STATE_DISCOVER, storage_agent.STATE_DEVICE_READY, storage_agent.STATE_DEGRADED]
+    if states != expected:
+        print(f"[storage-agent] устройство не появилось: переходы {states}, ожидались {expected}")
+        return False
+    if elapsed > 2.0:
+        print(f"[storage-agent] ожидание устройства {elapsed:.1f} с дольше DEVICE_TIMEOUT")
+        return False
+    print("[storage-agent] OK — без блочного устройства цель уходит в degraded по таймауту.")
+    return True
+
+
+def check_degraded_with_missing_path():
+    commands = []
+
+    def run_cmd(cmd):
+        commands.append(cmd)
+        return True
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        (tmp / "dev").mkdir()
+        (tmp / "dev" / "sda").touch()
+        sessions = {"10.0.0.1": [tmp / "session1"], "10.0.0.2": [tmp / "session2"]}
+        with stubbed(
+            run_cmd=run_cmd,
+            find_sessions=lambda target, portal: sessions[portal],
+            # Путь через второй портал так и не дал блочного устройства
+            session_block_device=lambda session, lun: "sda" if session.name == "session1" else None,
+            read_mountinfo=lambda: {},
+            DEV_DIR=tmp / "dev",
+            DEVICE_TIMEOUT=0.3,
+        ):
+            machine, states = make_machine(tmp, portals=("10.0.0.1", "10.0.0.2"))
+            machine._assemble_multipath = lambda: f"/dev/mapper/{machine.dm_name}"
+            machine.run()
+    expected = [
+        storage_agent.STATE_DISCOVER,
+        storage_agent.STATE_DEVICE_READY,
+        storage_agent.STATE_MOUNTED,
+        storage_agent.STATE_DEGRADED,
+    ]
+    if states != expected or machine.paths != ["sda"]:
+        print(f"[storage-agent] путь из двух: переходы {states}, пути {machine.paths}")
+        return False
+    if not any(cmd[0] == "mount" for cmd in commands):
+        print("[storage-agent] LUN с одним живым путём не смонтирован")
+        return False
+    print("[storage-agent] OK — при неполном наборе путей LUN смонтирован, цель в degraded.")
+    return True
+
+
+def write_stat(root: Path, name: str, read_ios, read_sectors, read_ticks, write_ios, write_sectors, write_ticks, io_ticks):
+    # Формат /sys/block/<dev>/stat: поля выровнены пробелами, в новых ядрах их больше 11
+    fields = [read_ios, 0, read_sectors, read_ticks, write_ios, 0, write_sectors, write_ticks, 0, io_ticks, 0, 0, 0, 0, 0]
+    (root / name).mkdir(exist_ok=True)
+    (root / name / "stat").write_text("".join(f"{value:>8} " for value in fields).rstrip() + "\n")
+
+
+def check_block_stats():
+    with tempfile.TemporaryDirectory() as tmp, stubbed(SYS_BLOCK=Path(tmp)):
+        root = Path(tmp)
+        sampler = storage_agent.BlockStatSampler()
+        write_stat(root, "sda", 1000, 8000, 500, 200, 4000, 300, 2000)
+        if sampler.sample("sda", 10.0) is not None:
+            print("[storage-stats] скорость по одному замеру")
+            return False
+        write_stat(root, "sda", 1100, 10048, 700, 250, 5024, 400, 3000)
+        rates = sampler.sample("sda", 12.0)
+        expected = {
+            "read_iops": 50.0,
+            "write_iops": 25.0,
+            "read_bps": 2048 * 512 / 2,
+            "write_bps": 1024 * 512 / 2,
+            "read_await_ms": 2.0,
+            "write_await_ms": 2.0,
+            "util": 50.0,
+        }
+        if rates != expected:
+            print(f"[storage-stats] скорости {rates}, ожидались {expected}")
+            return False
+        # Без I/O: await не делится на ноль
+        idle = sampler.sample("sda", 14.0)
+        if idle is None or idle["read_await_ms"] != 0.0 or idle["util"] != 0.0:
+            print(f"[storage-stats] простой: {idle}")
+            return False
+        # Счётчики сбросились: замер становится новой точкой отсчёта, а не отрицательной скоростью
+        write_stat(root, "sda", 10, 80, 5, 0, 0, 0, 20)
+        if sampler.sample("sda", 16.0) is not None:
+            print("[storage-stats] после сброса счётчиков посчитана скорость")
+            return False
+        write_stat(root, "sda", 20, 80, 15, 0, 0, 0, 220)
+        after = sampler.sample("sda", 18.0)
+        if after is None or after["read_iops"] != 5.0 or after["util"] != 10.0:
+            print(f"[storage-stats] после сброса: {after}")
+            return False
+
+        # Устройства нет в sysfs — замера нет, дескриптор не заводится
+        if sampler.sample("sdb", 18.0) is not None or "sdb" in sampler.fds:
+            print("[storage-stats] замер несуществующего устройства")
+            return False
+        # Исчезнувшее устройство: чтение открытого дескриптора даёт ошибку (в тесте —
+        # дескриптор каталога вместо файла), дескриптор закрывается и отсчёт забывается
+        dir_fd = os.open(tmp, os.O_RDONLY)
+        os.dup2(dir_fd, sampler.fds["sda"])
+        os.close(dir_fd)
+        if sampler.sample("sda", 20.0) is not None or "sda" in sampler.fds or "sda" in sampler.last:
+            print("[storage-stats] исчезнувшее устройство не забыто")
+            return False
+        # Вернулось — первый замер снова только точка отсчёта
+        if sampler.sample("sda", 22.0) is not None or sampler.sample("sda", 24.0) is None:
+            print("[storage-stats] вернувшееся устройство не отслеживается заново")
+            return False
+        write_stat(root, "sdc", 0, 0, 0, 0, 0, 0, 0)
+        sampler.sample("sdc", 24.0)
+        sampler.retain({"sda"})
+        if set(sampler.fds) != {"sda"}:
+            print(f"[storage-stats] retain оставил {sorted(sampler.fds)}")
+            return False
+        sampler.retain(set())
+    print("[storage-stats] OK — stat разбирается, скорости считаются, сброс и пропажа устройства не дают мусора.")
+    return True
+
+
+def check_stats_deadband():
+    old = {"read_iops": 100.0, "util": 0.5}
+    cases = [
+        ({"read_iops": 104.0, "util": 0.54}, False),
+        ({"read_iops": 106.0, "util": 0.5}, True),
+        ({"read_iops": 100.0, "util": 1.6}, True),
+        ({"read_iops": 100.0}, True),
+    ]
+    for new, expected in cases:
+        if storage_agent.exceeds_deadband(old, new, 0.05) != expected:
+            print(f"[storage-stats] deadband {old} -> {new}: ожидалось {expected}")
+            return False
+    print("[storage-stats] OK — мелкие колебания метрик не публикуются.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (
+        check_remount_options,
+        check_sessions_by_portal,
+        check_node_records,
+        check_login_timeout,
+        check_device_never_appears,
+        check_degraded_with_missing_path,
+        check_block_stats,
+        check_stats_deadband,
+    ):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
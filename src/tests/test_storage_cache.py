@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "agents"))
+
+import storage_agent  # noqa: E402
+
+ORIGIN_MB = 64
+CACHE_MB = 16
+PAYLOAD = os.urandom(1024 * 1024)
+
+
+def run_cmd(cmd, timeout=60):
+    return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout, check=True)
+
+
+def attach_origin(workdir: Path) -> str:
+    # Loop-устройство вместо iSCSI LUN: кэш собирается поверх любого блочного устройства
+    origin = workdir / "origin.img"
+    with open(origin, "wb") as f:
+        f.truncate(ORIGIN_MB * 1024 * 1024)
+    return run_cmd(["losetup", "--find", "--show", str(origin)]).stdout.strip()
+
+
+def check_cache_mode(mode: str) -> bool:
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        storage_agent.CACHE_STATE_DIR = workdir / "state"
+        origin = attach_origin(workdir)
+        name = f"test_cache_{mode}"
+        backing = str(workdir / "cache.img")
+        try:
+            device = storage_agent.setup_cache(name, origin, backing, mode, CACHE_MB)
+            with open(device, "r+b") as dev:
+                dev.write(PAYLOAD)
+                dev.flush()
+                os.fsync(dev.fileno())
+            with open(device, "rb") as dev:
+                dev.read(len(PAYLOAD))
+
+            stats = storage_agent.cache_stats(name, mode)
+            if not stats:
+                print(f"[cache-{mode}] не удалось разобрать dmsetup status")
+                return False
+
+            if not storage_agent.flush_cache(name, mode):
+                print(f"[cache-{mode}] сброс кэша не завершился")
+                return False
+            storage_agent.remove_cache(name, backing)
+
+            with open(origin, "rb") as dev:
+                if dev.read(len(PAYLOAD)) != PAYLOAD:
+                    print(f"[cache-{mode}] данные не дошли до origin после сброса")
+                    return False
+            print(f"[cache-{mode}] OK — статистика {stats}")
+            return True
+        except Exception as e:
+            print(f"[cache-{mode}] ошибка: {e}")
+            return False
+        finally:
+            storage_agent.remove_cache(name, backing)
+            subprocess.run(["losetup", "-d", origin], capture_output=True)
+
+
+def main():
+    if os.geteuid() != 0:
+        print("Тест требует root (losetup, dmsetup)")
+        sys.exit(1)
+    ok = True
+    for mode in storage_agent.CACHE_MODES:
+        if not check_cache_mode(mode):
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+SCHEMA_PATH = PROJECT_ROOT / "src" / "schema" / "system.ovsschema"
+sys.path.insert(0, str(PROJECT_ROOT / "src" / "agents"))
+
+
+class FakeTable:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeRow:
+    """Минимальная строка IDL: uuid, _data и таблица, как в уведомлениях."""
+
+    def __init__(self, uuid, table="Interface", **data):
+        self.uuid = uuid
+        self._data = data
+        self._table = FakeTable(table)
+        for column, value in data.items():
+            setattr(self, column, value)
+
+
+def make_idl(**kwargs):
+    import ovs.db.idl
+
+    from sysdb import SysdbIdl
+
+    helper = ovs.db.idl.SchemaHelper(location=str(SCHEMA_PATH))
+    helper.register_all()
+    # Соединение не нужно: уведомления подаются вручную
+    return SysdbIdl("unix:/nonexistent.sock", helper, **kwargs)
+
+
+def insert(idl, row):
+    import ovs.db.idl
+
+    idl.tables[row._table.name].rows[row.uuid] = row
+    idl.notify(ovs.db.idl.ROW_CREATE, row)
+
+
+def update(idl, row, **data):
+    import ovs.db.idl
+
+    old = FakeRow(row.uuid, row._table.name, **{column: row._data.get(column) for column in data})
+    row._data = {**row._data, **data}
+    for column, value in data.items():
+        setattr(row, column, value)
+    idl.notify(ovs.db.idl.ROW_UPDATE, row, old)
+
+
+def check_resync_without_changes():
+    idl = make_idl()
+    insert(idl, FakeRow("u1", name="eth0", vlan=100))
+    insert(idl, FakeRow("u2", name="eth1", vlan=200))
+    if idl.take_changes() != {"Interface": {"u1", "u2"}}:
+        print("[sysdb-resync] начальный снимок не попал в изменения")
+        return False
+
+    # Полный снимок после перезапуска ovsdb-server: те же строки заново
+    idl.tables["Interface"].rows.clear()
+    insert(idl, FakeRow("u1", name="eth0", vlan=100))
+    insert(idl, FakeRow("u2", name="eth1", vlan=200))
+    idl._check_rows()
+    if idl.take_changes():
+        print("[sysdb-resync] снимок без изменений засчитан как изменение")
+        return False
+
+    # Снимок, в котором eth1 пропала, а у eth0 сменился VLAN
+    idl.tables["Interface"].rows.clear()
+    insert(idl, FakeRow("u1", name="eth0", vlan=101))
+    idl._check_rows()
+    changes = idl.take_changes()
+    if changes != {"Interface": {"u1", "u2"}}:
+        print(f"[sysdb-resync] ожидались u1 и u2, получено {changes}")
+        return False
+    print("[sysdb-resync] OK — пересинхронизация без изменений не даёт событий.")
+    return True
+
+
+def check_debounce_burst():
+    from sysdb import ChangeDebouncer
+
+    debouncer = ChangeDebouncer(("Interface",), quiet=0.2, max_delay=1.0)
+    passes = []
+    now = 0.0
+    # 20 транзакций с шагом 0.1 с: тишины нет, проходы ограничены max_delay
+    for i in range(20):
+        debouncer.add({"Interface": {f"u{i}"}, "Telemetry": {"t"}}, now=now)
+        ready = debouncer.take_ready(now=now)
+        if ready:
+            passes.append(ready)
+        now += 0.1
+    passes.append(debouncer.take_ready(now=now + 0.2))
+    rows = set().union(*(p["Interface"] for p in passes))
+    if len(passes) != 2 or len(rows) != 20 or any("Telemetry" in p for p in passes):
+        print(f"[sysdb-debounce] неожиданные проходы: {passes}")
+        return False
+    if (debouncer.passes, debouncer.saved_passes, debouncer.rows) != (2, 18, 20):
+        print(
+            f"[sysdb-debounce] счётчики {debouncer.passes}/{debouncer.saved_passes}/{debouncer.rows}, "
+            "ожидались 2/18/20"
+        )
+        return False
+    print("[sysdb-debounce] OK — 20 транзакций склеены в 2 прохода.")
+    return True
+
+
+def check_own_columns_ignored():
+    from storage_agent import STATUS_COLUMNS
+
+    idl = make_idl(ignore_columns=STATUS_COLUMNS)
+    row = FakeRow("s1", "Storage", target_iqn="iqn.a", mount_options="noatime", io_stats={})
+    insert(idl, row)
+    idl.take_changes()
+    # Агент сам пишет телеметрию — это не повод для нового прохода
+    update(idl, row, io_stats={"read_iops": 10.0}, path_status={"sda": "active"})
+    if idl.take_changes():
+        print("[sysdb-own-columns] запись io_stats/path_status агентом засчитана как изменение")
+        return False
+    update(idl, row, mount_options="noatime,ro")
+    if idl.take_changes() != {"Storage": {"s1"}}:
+        print("[sysdb-own-columns] изменение mount_options потеряно")
+        return False
+    print("[sysdb-own-columns] OK — собственные колонки агента не запускают согласование.")
+    return True
+
+
+def check_own_writes_no_pass():
+    from storage_agent import STATUS_COLUMNS
+    from sysdb import ChangeDebouncer
+
+    idl = make_idl(ignore_columns=STATUS_COLUMNS)
+    debouncer = ChangeDebouncer(("Storage",), quiet=0.2, max_delay=1.0)
+    row = FakeRow("s1", "Storage", target_iqn="iqn.a", mount_options="noatime", io_stats={})
+    insert(idl, row)
+    debouncer.add(idl.take_changes(), now=0.0)
+    debouncer.take_ready(now=1.0)
+    # Публикации телеметрии раз в 5 с: ни одна не должна запускать проход
+    for i in range(1, 6):
+        update(idl, row, io_stats={"read_iops": float(i)})
+        debouncer.add(idl.take_changes(), now=i * 5.0)
+        if debouncer.take_ready(now=i * 5.0 + 1.0):
+            print("[sysdb-own-writes] обновление только io_stats запустило проход")
+            return False
+    if (debouncer.passes, debouncer.rows) != (1, 1):
+        print(f"[sysdb-own-writes] счётчики {debouncer.passes}/{debouncer.rows} учитывают собственные записи")
+        return False
+    print("[sysdb-own-writes] OK — запись io_stats не даёт проходов и не попадает в счётчики.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (check_resync_without_changes, check_debounce_burst, check_own_columns_ignored,
+                  check_own_writes_no_pass):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import sys
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "agents"))
+
+import vm_agent  # noqa: E402
+
+HOST_CPUS = set(range(8))
+
+
+def check_parse_cpu_list():
+    cases = {
+        "0-3,5,7-8": {0, 1, 2, 3, 5, 7, 8},
+        "0\n": {0},
+        " 2-2 , 4,": {2, 4},
+        "": set(),
+    }
+    for text, expected in cases.items():
+        if vm_agent.parse_cpu_list(text) != expected:
+            print(f"[vm-placement] parse_cpu_list({text!r}) = {vm_agent.parse_cpu_list(text)}, ожидалось {expected}")
+            return False
+    print("[vm-placement] OK — списки ядер с диапазонами разбираются.")
+    return True
+
+
+def check_pack_and_spread():
+    pack = vm_agent.CpuPlacer(HOST_CPUS, {0}, "pack").plan({"small": 1, "big": 2})
+    if pack != {"big": [1, 2], "small": [3]}:
+        print(f"[vm-placement] pack: {pack}")
+        return False
+    shared = vm_agent.CpuPlacer(HOST_CPUS, {0}, "pack", vcpus_per_core=2).plan({"vm": 3})
+    if shared != {"vm": [1, 1, 2]}:
+        print(f"[vm-placement] pack по 2 vCPU на ядро: {shared}")
+        return False
+    spread = vm_agent.CpuPlacer({0, 1, 2, 3, 4}, {0}, "spread").plan({"a": 2, "b": 2, "c": 1})
+    if spread != {"a": [1, 2], "b": [3, 4], "c": [1]}:
+        print(f"[vm-placement] spread: {spread}")
+        return False
+    try:
+        vm_agent.CpuPlacer(HOST_CPUS, {0}, "random")
+        print("[vm-placement] неизвестная политика принята")
+        return False
+    except ValueError:
+        pass
+    print("[vm-placement] OK — pack заполняет ядра по порядку, spread — равномерно.")
+    return True
+
+
+def check_housekeeping_excluded():
+    for policy in ("pack", "spread"):
+        plan = vm_agent.CpuPlacer(HOST_CPUS, {0, 1}, policy).plan({"a": 4, "b": 4, "c": 4})
+        used = {cpu for cpus in plan.values() for cpu in cpus}
+        if used & {0, 1}:
+            print(f"[vm-placement] {policy}: vCPU на housekeeping-ядрах {sorted(used & {0, 1})}")
+            return False
+    # Все ядра помечены housekeeping — VM всё равно должны где-то работать
+    plan = vm_agent.CpuPlacer({0, 1}, {0, 1}).plan({"a": 1})
+    if plan != {"a": [0]}:
+        print(f"[vm-placement] без свободных ядер: {plan}")
+        return False
+    print("[vm-placement] OK — housekeeping-ядра не получают vCPU.")
+    return True
+
+
+def check_oversubscription():
+    cpus = {1, 2, 3}
+    for policy in ("pack", "spread"):
+        plan = vm_agent.CpuPlacer(cpus | {0}, {0}, policy).plan({"a": 4, "b": 3})
+        load = Counter(cpu for vcpus in plan.values() for cpu in vcpus)
+        if set(load) != cpus or max(load.values()) - min(load.values()) > 1:
+            print(f"[vm-placement] {policy}: переподписка неравномерна {dict(load)}")
+            return False
+        # Потоки одной VM по возможности на разных ядрах
+        if len(set(plan["b"])) != 3:
+            print(f"[vm-placement] {policy}: vCPU VM b на одном ядре {plan['b']}")
+            return False
+    print("[vm-placement] OK — при vCPU больше ядер нагрузка распределяется равномерно.")
+    return True
+
+
+def check_rebalance():
+    manager = vm_agent.VMManager(vm_agent.CpuPlacer({0, 1, 2, 3}, {0}, "pack"))
+    manager.vcpus = {"a": 1, "b": 1}
+    manager.rebalance()
+    if manager.placement != {"a": [1], "b": [2]} or manager.pending_pin != {"a", "b"}:
+        print(f"[vm-placement] начальный план {manager.placement}, ждут закрепления {manager.pending_pin}")
+        return False
+    manager.pending_pin.clear()
+    # Остановка a освобождает ядро 1: b переезжает и снова ждёт закрепления
+    manager.vcpus.pop("a")
+    manager.rebalance()
+    if manager.placement != {"b": [1]} or manager.pending_pin != {"b"}:
+        print(f"[vm-placement] после остановки {manager.placement}, ждут закрепления {manager.pending_pin}")
+        return False
+    print("[vm-placement] OK — rebalance переназначает ядра и помечает VM для закрепления.")
+    return True
+
+
+def main():
+    ok = True
+    for check in (
+        check_parse_cpu_list,
+        check_pack_and_spread,
+        check_housekeeping_excluded,
+        check_oversubscription,
+        check_rebalance,
+    ):
+        if not check():
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()